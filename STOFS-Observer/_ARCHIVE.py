@@ -0,0 +1,210 @@
+import os
+import numpy as np
+import xarray as xr
+import zarr
+from datetime import datetime, timedelta
+try:
+    from ._STOFS import fetch_station_pairs, nowcast_dates
+except ImportError:
+    from _STOFS import fetch_station_pairs, nowcast_dates
+try:
+    from ._CACHE import file_lock
+except ImportError:
+    from _CACHE import file_lock
+
+
+def archive_path(archive_dir, filename, modelname):
+    """
+    Function to get the location of the local nowcast archive of a STOFS station file.
+
+    Parameters:
+    - archive_dir (str): Directory holding the archives
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+
+    Returns:
+    - str: Path of the Zarr store
+    """
+    return os.path.join(archive_dir, f'{modelname}.{filename}.zarr')
+
+
+def archived_cycles(archive_dir, filename, modelname):
+    """
+    Function to list the (date, cycle) pairs held by a nowcast archive.
+
+    Parameters:
+    - archive_dir (str): Directory holding the archives
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+
+    Returns:
+    - set of tuple: (date, cycle) pairs, e.g. ('20240922', '12')
+    """
+    path = archive_path(archive_dir, filename, modelname)
+    if not os.path.exists(path):
+        return set()
+    attrs = zarr.open_group(path, mode='r').attrs
+    return {tuple(pair.split('/')) for pair in attrs.get('nowcast_cycles', [])}
+
+
+def update_nowcast_archive(archive_dir, filename, modelname, directoryname, bucketname, daterange, steps, cycles,
+                           max_workers=1, s3=None, stations=None, batch_size=None):
+    """
+    Function to download the nowcast of the cycles missing from the local archive and append them to it. Each cycle
+    is committed with the length of the time axis, an interrupted update is resumed from the last committed cycle.
+
+    Parameters:
+    - archive_dir (str): Directory holding the archives
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - steps (int): Number of steps to slice as the nowcast period in each STOFS file
+    - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - max_workers (int): Maximum number of files read concurrently from S3
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices, fixed for the lifetime of the archive
+    - batch_size (int): Number of cycles held in memory before they are appended (default 4 * max_workers)
+
+    Returns:
+    - list of tuple: (date, cycle) pairs appended to the archive
+    - list of dict: Files that could not be read (e.g. cycles not published yet), retried on the next update
+    """
+    path = archive_path(archive_dir, filename, modelname)
+    appended = []
+    failures = []
+    # Concurrent updates of the same archive run one after the other
+    with file_lock(f'{path}.lock'):
+        held = archived_cycles(archive_dir, filename, modelname)
+        _check_archive(path, steps, stations)
+
+        missing = [(date, cycle) for date in nowcast_dates(daterange) for cycle in cycles if (date, cycle) not in held]
+        batch_size = batch_size or 4 * max(max_workers, 1)
+
+        for start in range(0, len(missing), batch_size):
+            read_pairs, batch_failures = fetch_station_pairs(filename, modelname, directoryname, bucketname,
+                                                             missing[start:start + batch_size], steps=steps,
+                                                             max_workers=max_workers, s3=s3, stations=stations)
+            failures.extend(batch_failures)
+            for date, cycle, nowcast in read_pairs:
+                length = _append_nowcast(path, nowcast, steps, stations)
+                held.add((date, cycle))
+                appended.append((date, cycle))
+                # The cycle and the new length of the time axis are committed in one write of the store
+                # attributes, time steps appended past the committed length are dropped by the next update
+                _write_cycles(path, held, length)
+
+    return appended, failures
+
+
+def read_nowcast_archive(archive_dir, filename, modelname, daterange):
+    """
+    Function to read STOFS Nowcast data over a date range from the local archive.
+
+    Parameters:
+    - archive_dir (str): Directory holding the archives
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+
+    Returns:
+    - xarray.Dataset: Lazy (dask-backed) dataset containing the STOFS Nowcast data, ordered by time
+    """
+    path = archive_path(archive_dir, filename, modelname)
+    start_date = datetime.strptime(daterange[0], '%Y%m%d')
+    end_date = datetime.strptime(daterange[1], '%Y%m%d') + timedelta(days=1)  # Include the last day
+
+    # Cycles are appended in the order they were downloaded, late ones can be older than the rest
+    # (time steps of an interrupted update, past the committed length, are left out)
+    nowcast_all = xr.open_zarr(path, consolidated=False)
+    nowcast_all = nowcast_all.isel(time=slice(0, _committed_length(zarr.open_group(path, mode='r'))))
+    if not nowcast_all.indexes['time'].is_monotonic_increasing:
+        nowcast_all = nowcast_all.isel(time=np.argsort(nowcast_all['time'].values, kind='stable'))
+    return nowcast_all.sel(time=slice(start_date, end_date))
+
+
+def get_station_nowcast_archive(archive_dir, filename, modelname, directoryname, bucketname, daterange, steps, cycles,
+                                max_workers=1, s3=None, stations=None):
+    """
+    Function to bring the local archive up to date and read STOFS Nowcast data from it.
+
+    Parameters:
+    - archive_dir (str): Directory holding the archives
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - steps (int): Number of steps to slice as the nowcast period in each STOFS file
+    - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - max_workers (int): Maximum number of files read concurrently from S3
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices, fixed for the lifetime of the archive
+
+    Returns:
+    - xarray.Dataset: Dataset containing the STOFS Nowcast data
+    """
+    update_nowcast_archive(archive_dir, filename, modelname, directoryname, bucketname, daterange, steps, cycles,
+                           max_workers=max_workers, s3=s3, stations=stations)
+    return read_nowcast_archive(archive_dir, filename, modelname, daterange)
+
+
+def _append_nowcast(path, nowcast, steps, stations):
+    # Append the nowcast of a cycle after the committed time steps, returns the new length of the time axis
+    committed = _committed_length(zarr.open_group(path, mode='r')) if os.path.exists(path) else 0
+    if not committed:
+        # A store without any committed cycle (e.g. interrupted while it was created) is written again
+        nowcast.attrs['nowcast_steps'] = steps if steps is not None else -1
+        nowcast.attrs['nowcast_stations'] = [str(station) for station in stations] if stations is not None else []
+        nowcast.to_zarr(path, mode='w', consolidated=False)
+    else:
+        _truncate_time(path, committed)
+        # Only the time-dependent variables grow, the station metadata is stored once
+        static = [name for name, variable in nowcast.variables.items() if 'time' not in variable.dims]
+        appended = nowcast.drop_vars(static)
+        # Appending rewrites the store attributes, keep the archive record as it is
+        appended.attrs = dict(zarr.open_group(path, mode='r').attrs)
+        appended.to_zarr(path, append_dim='time', consolidated=False)
+    return zarr.open_group(path, mode='r')['time'].shape[0]
+
+
+def _write_cycles(path, held, length):
+    group = zarr.open_group(path, mode='a')
+    record = {'nowcast_cycles': sorted(f'{date}/{cycle}' for date, cycle in held), 'nowcast_time_length': length}
+    # One write of the attributes (zarr 3 writes them key by key through attrs.update)
+    if hasattr(group, 'update_attributes'):
+        group.update_attributes(record)
+    else:
+        group.attrs.update(record)
+
+
+def _committed_length(group):
+    # Archives written before the length was recorded trust the length of their time axis
+    if 'nowcast_time_length' in group.attrs:
+        return group.attrs['nowcast_time_length']
+    return group['time'].shape[0] if group.attrs.get('nowcast_cycles') else 0
+
+
+def _truncate_time(path, length):
+    # Resize every time-dependent array back to the committed length of the time axis
+    for _, array in zarr.open_group(path, mode='a').arrays():
+        dims = list(getattr(getattr(array, 'metadata', None), 'dimension_names', None) or
+                    array.attrs.get('_ARRAY_DIMENSIONS', []))
+        if 'time' in dims and array.shape[dims.index('time')] != length:
+            shape = list(array.shape)
+            shape[dims.index('time')] = length
+            array.resize(tuple(shape))
+
+
+def _check_archive(path, steps, stations):
+    # An archive only makes sense for one nowcast length and one station set
+    if not os.path.exists(path):
+        return
+    attrs = zarr.open_group(path, mode='r').attrs
+    held_steps = attrs.get('nowcast_steps', -1)
+    held_stations = list(attrs.get('nowcast_stations', []))
+    if held_steps != (steps if steps is not None else -1):
+        raise ValueError(f'The archive {path} holds {held_steps} nowcast steps per cycle, not {steps}')
+    if held_stations != ([str(station) for station in stations] if stations is not None else []):
+        raise ValueError(f'The archive {path} holds a different set of stations')
@@ -0,0 +1,400 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from contextlib import contextmanager
+try:
+    import fcntl  # Inter-process locking (POSIX only)
+except ImportError:
+    fcntl = None
+
+
+# Settings of the local object cache; the cache is disabled while the directory is None
+_cache_options = {
+    'directory': os.environ.get('STOFS_OBSERVER_CACHE_DIR') or None,
+    'max_bytes': int(os.environ.get('STOFS_OBSERVER_CACHE_BYTES', 20 * 1024**3)),
+    'revalidate': False,
+}
+_cache_stats = {'hits': 0, 'misses': 0, 'bytes_read': 0, 'bytes_downloaded': 0, 'evictions': 0}
+_cache_lock = threading.Lock()
+
+
+def configure_cache(directory, max_bytes=20 * 1024**3, revalidate=False):
+    """
+    Function to enable (or disable) the local on-disk cache of S3 objects.
+
+    Parameters:
+    - directory (str): Cache directory, shared safely by several processes (None disables the cache)
+    - max_bytes (int): Total size of the cached objects above which least-recently-used objects are evicted
+    - revalidate (bool): Ask S3 for the ETag of every object instead of trusting the one recorded
+      when it was cached (published cycle files never change, so the default stays fully local)
+    """
+    _cache_options['directory'] = directory
+    _cache_options['max_bytes'] = int(max_bytes)
+    _cache_options['revalidate'] = revalidate
+
+
+def cache_configuration():
+    """
+    Function to get the current settings of the local object cache (e.g. to apply them in a worker process).
+
+    Returns:
+    - dict: directory, max_bytes and revalidate, as accepted by configure_cache
+    """
+    return dict(_cache_options)
+
+
+def cache_enabled():
+    """
+    Function to check whether the local object cache is enabled.
+
+    Returns:
+    - bool: True if a cache directory is configured
+    """
+    return _cache_options['directory'] is not None
+
+
+def cache_subdirectory(name):
+    """
+    Function to get a directory of the local cache for data derived from S3 objects (e.g. grid geometries).
+    Derived data is small and is not counted in max_bytes nor evicted.
+
+    Parameters:
+    - name (str): Name of the directory
+
+    Returns:
+    - str: Path of the directory, created if needed (None while the cache is disabled)
+    """
+    if not cache_enabled():
+        return None
+    path = os.path.join(_cache_options['directory'], name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def memoized_artifact(memory, key, subdirectory, name, build, load, save, mode='wb'):
+    """
+    Function to get data derived from S3 objects (e.g. a grid geometry), built once and kept in memory and, when
+    the local cache is enabled, on disk.
+
+    Parameters:
+    - memory (dict): Artifacts already held by this process, by key (filled on a miss)
+    - key: Key of the artifact in memory
+    - subdirectory (str): Directory of the local cache for this kind of artifact
+    - name (str): File name of the artifact in that directory
+    - build (callable): Called without arguments to build the artifact
+    - load (callable): Called with the path of the file to read the artifact
+    - save (callable): Called with the artifact and an open file to write it
+    - mode (str): Mode of the file written by save ('wb' or 'w')
+
+    Returns:
+    - The artifact
+    """
+    if key in memory:
+        return memory[key]
+    directory = cache_subdirectory(subdirectory)
+    path = os.path.join(directory, name) if directory else None
+    if path and os.path.exists(path):
+        artifact = load(path)
+    else:
+        artifact = build()
+        if path:
+            atomic_write(path, lambda tmp_file: save(artifact, tmp_file), mode=mode)
+    memory[key] = artifact
+    return artifact
+
+
+def atomic_write(path, writer, mode='wb'):
+    """
+    Function to write a file under a temporary name next to its final location and rename it, so other processes
+    only see complete files. The temporary file is removed if writer fails.
+
+    Parameters:
+    - path (str): Final path of the file
+    - writer (callable): Called with the open temporary file
+    - mode (str): Mode of the temporary file ('wb' or 'w')
+
+    Returns:
+    - str: path
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.part')
+    try:
+        with os.fdopen(fd, mode) as tmp_file:
+            writer(tmp_file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove(tmp_path)
+        raise
+    return path
+
+
+@contextmanager
+def atomic_directory(path):
+    """
+    Function to build a directory (e.g. a Zarr store) under a temporary name next to its final location, renamed
+    when the block completes and removed if it fails.
+
+    Parameters:
+    - path (str): Final path of the directory
+
+    Returns:
+    - str: Path of the temporary directory to write to
+    """
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path) or '.', suffix='.part')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def coordinates_id(latitudes, longitudes):
+    """
+    Function to get an identifier of a set of points (e.g. a grid or a set of stations), used to name the data
+    derived from them.
+
+    Parameters:
+    - latitudes (array-like): Latitudes of the points
+    - longitudes (array-like): Longitudes of the points
+
+    Returns:
+    - str: 32 hexadecimal characters of the SHA-256 of the coordinates
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    return hashlib.sha256(latitudes.tobytes() + longitudes.tobytes()).hexdigest()[:32]
+
+
+def cache_stats():
+    """
+    Function to report the hit/miss statistics of this process and the current content of the cache.
+
+    Returns:
+    - dict: hits, misses, hit_rate, bytes_read, bytes_downloaded, evictions, entries and size (bytes)
+    """
+    with _cache_lock:
+        stats = dict(_cache_stats)
+    requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+    entries = _list_objects() if cache_enabled() else []
+    stats['entries'] = len(entries)
+    stats['size'] = sum(size for _, size, _ in entries)
+    return stats
+
+
+def clear_cache():
+    """
+    Function to remove every cached object and reset the statistics.
+    """
+    if cache_enabled():
+        with _eviction_lock():
+            for path, _, _ in _list_objects():
+                _remove(path)
+    with _cache_lock:
+        for name in _cache_stats:
+            _cache_stats[name] = 0
+
+
+def cached_path(s3, url):
+    """
+    Function to get a local copy of an S3 object, downloading it on a cache miss.
+
+    Parameters:
+    - s3: S3 filesystem used on a cache miss
+    - url (str): s3:// url of the object
+
+    Returns:
+    - str: Path of the cached object
+    """
+    def download(tmp_file):
+        with s3.open(url, 'rb') as f:
+            while True:
+                block = f.read(8 * 1024**2)
+                if not block:
+                    break
+                tmp_file.write(block)
+
+    return _cached_entry(s3, url, '', download)
+
+
+def open_cached(s3, url, opener):
+    """
+    Function to open the local copy of an S3 object, downloading it again if another process evicts it before
+    it is opened.
+
+    Parameters:
+    - s3: S3 filesystem used on a cache miss
+    - url (str): s3:// url of the object
+    - opener (callable): Called with the path of the cached object (e.g. xarray.open_dataset)
+
+    Returns:
+    - The result of opener (an open file handle keeps the content readable after an eviction)
+    """
+    return _open_entry(lambda: cached_path(s3, url), opener)
+
+
+def read_object(s3, url):
+    """
+    Function to read the content of an S3 object, through the local cache when it is enabled.
+
+    Parameters:
+    - s3: S3 filesystem
+    - url (str): s3:// url of the object
+
+    Returns:
+    - bytes: Content of the object
+    """
+    if not cache_enabled():
+        return s3.cat_file(url)
+    return open_cached(s3, url, _read_file)
+
+
+def read_object_ranges(s3, url, ranges):
+    """
+    Function to read byte ranges of an S3 object, through the local cache when it is enabled.
+
+    Parameters:
+    - s3: S3 filesystem
+    - url (str): s3:// url of the object
+    - ranges (list of tuple): (start, end) byte ranges, end excluded (None reads to the end of the object)
+
+    Returns:
+    - bytes: Content of the ranges, concatenated in order
+    """
+    def fetch():
+        starts = [start for start, _ in ranges]
+        ends = [end for _, end in ranges]
+        return b''.join(s3.cat_ranges([url] * len(ranges), starts, ends))
+
+    if not cache_enabled():
+        return fetch()
+    variant = ','.join(f'{start}-{end}' for start, end in ranges)
+    return _open_entry(lambda: _cached_entry(s3, url, variant, lambda tmp_file: tmp_file.write(fetch())),
+                       _read_file)
+
+
+def _open_entry(lookup, opener):
+    # Open a cached entry, looking it up again once if it is evicted by another process in the meantime
+    for attempt in range(2):
+        try:
+            return opener(lookup())
+        except FileNotFoundError:
+            if attempt:
+                raise
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _cached_entry(s3, url, variant, download):
+    # Cached file of an object (or of a variant of it, e.g. byte ranges), written by download on a miss
+    etag = _object_etag(s3, url)
+    entry = f'{url}|{etag}|{variant}' if variant else f'{url}|{etag}'
+    name = hashlib.sha256(entry.encode()).hexdigest()
+    path = os.path.join(_cache_options['directory'], 'objects', name[:2], name)
+
+    if os.path.exists(path):
+        try:
+            os.utime(path)  # Mark the object as recently used
+            size = os.path.getsize(path)
+            _count(hits=1, bytes_read=size)
+            return path
+        except FileNotFoundError:
+            pass  # Evicted by another process in the meantime
+
+    # Download next to the final location and rename, so readers never see a partial object
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write(path, download)
+    size = os.path.getsize(path)
+    _count(misses=1, bytes_read=size, bytes_downloaded=size)
+    _evict(keep=path)
+    return path
+
+
+def _object_etag(s3, url):
+    # The ETag seen when the object was first cached is recorded next to the objects
+    name = hashlib.sha256(url.encode()).hexdigest()
+    ref_path = os.path.join(_cache_options['directory'], 'etags', name[:2], name)
+    if not _cache_options['revalidate']:
+        try:
+            with open(ref_path) as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+    etag = str(s3.info(url).get('ETag', '')).strip('"')
+    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+    atomic_write(ref_path, lambda f: f.write(etag), mode='w')
+    return etag
+
+
+def _list_objects():
+    # (path, size, last use) of every complete object in the cache
+    entries = []
+    for root, _, files in os.walk(os.path.join(_cache_options['directory'], 'objects')):
+        for file in files:
+            if file.endswith('.part'):
+                continue
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def _evict(keep=None):
+    # Remove least-recently-used objects until the cache fits in max_bytes
+    with _eviction_lock():
+        entries = sorted(_list_objects(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= _cache_options['max_bytes']:
+                break
+            if path == keep:
+                continue
+            if _remove(path):
+                _count(evictions=1)
+            total -= size
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Function to hold an exclusive lock shared by the processes of the machine (POSIX only, a no-op elsewhere).
+
+    Parameters:
+    - path (str): Path of the lock file, created if needed
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _eviction_lock():
+    return file_lock(os.path.join(_cache_options['directory'], '.lock'))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _count(**counts):
+    with _cache_lock:
+        for name, value in counts.items():
+            _cache_stats[name] += value
@@ -0,0 +1,362 @@
+import json
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+import numcodecs
+try:
+    from ._S3 import get_s3_filesystem
+    from ._CACHE import read_object_ranges, memoized_artifact
+    from ._STOFS import RANGE_BLOCK_SIZE
+    from ._INTERP import extract_points
+except ImportError:
+    from _S3 import get_s3_filesystem
+    from _CACHE import read_object_ranges, memoized_artifact
+    from _STOFS import RANGE_BLOCK_SIZE
+    from _INTERP import extract_points
+
+
+# Chunks smaller than this (e.g. the time axis) are stored in the references themselves
+INLINE_THRESHOLD = 500
+
+# Byte ranges of the same object closer than this are fetched with one request
+COALESCE_GAP = 1024**2
+
+# Chunk references already scanned in this process, by url
+_references = {}
+
+# Chunks already fetched in this process, least recently used first, by (url, start, end)
+_chunk_cache_options = {'max_bytes': 256 * 1024**2}
+_chunk_cache = OrderedDict()
+_chunk_cache_size = [0]
+_chunk_cache_lock = threading.Lock()
+
+
+def configure_chunk_cache(max_bytes=256 * 1024**2):
+    """
+    Function to set the size of the in-memory cache of the chunks fetched by read_chunk_points (e.g. the chunks of
+    nearby nodes read again for another set of points).
+
+    Parameters:
+    - max_bytes (int): Total size of the cached chunks above which least-recently-used chunks are dropped
+      (0 disables the cache)
+    """
+    with _chunk_cache_lock:
+        _chunk_cache_options['max_bytes'] = int(max_bytes)
+        _trim_chunk_cache()
+
+
+def chunk_references(url, s3=None):
+    """
+    Function to get the byte ranges of the HDF5 chunks of a netCDF4 file on S3. Only the file metadata is read;
+    the references are kept in memory and, when the local cache is enabled, on disk.
+
+    Parameters:
+    - url (str): s3:// url of the file
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+
+    Returns:
+    - dict: kerchunk references (zarr metadata and [url, offset, size] of every chunk)
+    """
+    def build():
+        from kerchunk.hdf import SingleHdf5ToZarr
+
+        with get_s3_filesystem(s3).open(url, 'rb', block_size=RANGE_BLOCK_SIZE, cache_type='blockcache') as f:
+            return SingleHdf5ToZarr(f, url, inline_threshold=INLINE_THRESHOLD).translate()
+
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+    return memoized_artifact(_references, url, 'references', hashlib.sha256(url.encode()).hexdigest() + '.json',
+                             build, load, json.dump, mode='w')
+
+
+def chunk_layout(references, variable):
+    """
+    Function to describe the chunked storage of a variable from its references.
+
+    Parameters:
+    - references (dict): kerchunk references (from chunk_references)
+    - variable (str): Name of the variable
+
+    Returns:
+    - dict: 'dims', 'shape', 'chunks', 'dtype', 'fill_value', 'codecs' (decoding order), 'separator' and
+      'attrs' (netCDF attributes)
+    """
+    refs = references['refs']
+    if f'{variable}/.zarray' not in refs:
+        raise KeyError(f'No variable {variable!r} in the references')
+    zarray = json.loads(refs[f'{variable}/.zarray'])
+    attrs = json.loads(refs.get(f'{variable}/.zattrs', '{}'))
+    dims = attrs.pop('_ARRAY_DIMENSIONS')
+
+    # Encoding applies the filters in order then the compressor, decoding goes the other way
+    codecs = [numcodecs.get_codec(config) for config in (zarray['filters'] or [])]
+    if zarray['compressor']:
+        codecs.append(numcodecs.get_codec(zarray['compressor']))
+    fill_value = zarray['fill_value']
+    if fill_value in ('NaN', 'Infinity', '-Infinity'):
+        fill_value = float(fill_value.replace('Infinity', 'inf'))
+    if fill_value is not None:
+        attrs.setdefault('_FillValue', fill_value)
+    return {'dims': dims, 'shape': tuple(zarray['shape']), 'chunks': tuple(zarray['chunks']),
+            'dtype': np.dtype(zarray['dtype']), 'fill_value': fill_value, 'codecs': codecs[::-1],
+            'separator': zarray.get('dimension_separator', '.'), 'attrs': attrs}
+
+
+def coalesce_ranges(starts, ends, max_gap=COALESCE_GAP):
+    """
+    Function to merge byte ranges that overlap or are closer than a gap, so that they are fetched with one request.
+
+    Parameters:
+    - starts (array-like): First byte of each range
+    - ends (array-like): End of each range (excluded)
+    - max_gap (int): Largest number of unneeded bytes read to join two ranges
+
+    Returns:
+    - numpy.ndarray: Start of each merged range
+    - numpy.ndarray: End of each merged range
+    - numpy.ndarray: Merged range holding each input range
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if not len(starts):
+        return starts, ends, np.zeros(0, dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    reach = np.maximum.accumulate(ends[order])
+    # A new merged range starts where the gap to everything before is larger than max_gap
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = starts[order][1:] - reach[:-1] > max_gap
+    group = np.cumsum(new) - 1
+    merged_starts = starts[order][new]
+    merged_ends = np.maximum.reduceat(ends[order], np.flatnonzero(new))
+    groups = np.empty(len(order), dtype=np.int64)
+    groups[order] = group
+    return merged_starts, merged_ends, groups
+
+
+def read_chunk_points(url, variables, indexers, s3=None, max_gap=COALESCE_GAP):
+    """
+    Function to read some variables of a chunked netCDF4 file on S3 at a set of points, fetching each HDF5 chunk the
+    points fall in once, with coalesced byte-range requests shared by all the variables.
+
+    Parameters:
+    - url (str): s3:// url of the file
+    - variables (list of str): Names of the variables
+    - indexers (dict): Dimension name -> slice (step 1) or integer array of point indexes; the arrays all have the
+      same length and select points, like a vectorized isel (e.g. {'time': slice(0, 24), 'ny_grid': y, 'nx_grid': x})
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - max_gap (int): Largest number of unneeded bytes read to join two byte ranges
+
+    Returns:
+    - xarray.Dataset: The variables, with a 'point' dimension in place of the dimensions indexed by arrays, and
+      the coordinate variables of their dimensions (e.g. time)
+    """
+    s3 = get_s3_filesystem(s3)
+    references = chunk_references(url, s3=s3)
+
+    # Coordinate variables (named after their dimension) are read along with the variables
+    dims = {dim for name in variables for dim in chunk_layout(references, name)['dims']}
+    coords = [dim for dim in sorted(dims) if f'{dim}/.zarray' in references['refs'] and dim not in variables]
+    names = list(variables) + coords
+
+    plans = [_plan_variable(references, name, indexers) for name in names]
+    pieces = [piece for plan in plans for piece in plan['pieces']]
+    contents = _fetch_pieces(s3, url, pieces, max_gap)
+
+    arrays = {}
+    offset = 0
+    for name, plan in zip(names, plans):
+        values = _assemble_variable(plan, contents[offset:offset + len(plan['pieces'])])
+        offset += len(plan['pieces'])
+        arrays[name] = (plan['out_dims'], values, plan['layout']['attrs'])
+    ds = xr.Dataset({name: arrays[name] for name in variables}, coords={name: arrays[name] for name in coords})
+    return xr.decode_cf(ds)
+
+
+def _plan_variable(references, name, indexers):
+    # Chunks (or, for uncompressed chunks, runs of elements) of a variable needed by the selection
+    layout = chunk_layout(references, name)
+    dims, shape, chunks = layout['dims'], layout['shape'], layout['chunks']
+    selection = [indexers.get(dim, slice(None)) for dim in dims]
+    point_axes = [axis for axis, item in enumerate(selection) if not isinstance(item, slice)]
+    if point_axes and point_axes != list(range(point_axes[0], point_axes[-1] + 1)):
+        raise ValueError(f'The point dimensions of {name!r} must be adjacent, got {[dims[a] for a in point_axes]}')
+
+    # Output: sliced dimensions in order, one 'point' dimension in place of the point dimensions
+    bounds = {}
+    for axis, item in enumerate(selection):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(shape[axis])
+            if step != 1:
+                raise ValueError(f'Only slices with a step of 1 are supported, got {item}')
+            bounds[axis] = (start, max(start, stop))
+    points = [np.asarray(selection[axis], dtype=np.int64) for axis in point_axes]
+    out_dims = [dims[axis] for axis in range(len(dims)) if axis not in point_axes]
+    out_shape = [bounds[axis][1] - bounds[axis][0] for axis in range(len(dims)) if axis not in point_axes]
+    if point_axes:
+        out_dims.insert(point_axes[0], 'point')
+        out_shape.insert(point_axes[0], len(points[0]))
+
+    # Points are grouped by the chunk they fall in, sliced dimensions cover a range of chunks
+    if point_axes:
+        point_chunks = np.stack([points[k] // chunks[axis] for k, axis in enumerate(point_axes)], axis=1)
+        groups, inverse = np.unique(point_chunks, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+    else:
+        groups, inverse = np.zeros((1, 0), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ranges = [range(bounds[axis][0] // chunks[axis], -(-bounds[axis][1] // chunks[axis]))
+              for axis in sorted(bounds)]
+
+    blocks = []
+    pieces = []
+    uncompressed = not layout['codecs']
+    for group, coords in enumerate(groups):
+        members = np.flatnonzero(inverse == group)
+        for sliced in np.ndindex(*[len(r) for r in ranges]):
+            chunk = [0] * len(dims)
+            for k, axis in enumerate(point_axes):
+                chunk[axis] = int(coords[k])
+            for k, axis in enumerate(sorted(bounds)):
+                chunk[axis] = ranges[k][sliced[k]]
+            block = _block_selection(layout, chunk, point_axes, points, members, bounds)
+            reference = references['refs'].get(f"{name}/{layout['separator'].join(map(str, chunk))}")
+            block['reference'] = reference
+            if isinstance(reference, list) and uncompressed:
+                # Only the runs of needed elements of an uncompressed chunk are fetched
+                flat = np.ravel_multi_index(np.broadcast_arrays(*block['local']), chunks).reshape(-1)
+                unique = np.unique(flat)
+                runs = np.flatnonzero(np.diff(unique) != 1) + 1
+                run_starts = unique[np.r_[0, runs]]
+                run_ends = unique[np.r_[runs - 1, len(unique) - 1]] + 1
+                itemsize = layout['dtype'].itemsize
+                block['elements'] = (flat, unique)
+                block['pieces'] = range(len(pieces), len(pieces) + len(run_starts))
+                pieces.extend((reference[1] + start * itemsize, reference[1] + end * itemsize)
+                              for start, end in zip(run_starts, run_ends))
+            elif isinstance(reference, list):
+                block['pieces'] = range(len(pieces), len(pieces) + 1)
+                pieces.append((reference[1], reference[1] + reference[2]))
+            blocks.append(block)
+    return {'layout': layout, 'out_dims': out_dims, 'out_shape': out_shape, 'blocks': blocks, 'pieces': pieces,
+            'point_axes': point_axes}
+
+
+def _block_selection(layout, chunk, point_axes, points, members, bounds):
+    # Indexes of the needed elements inside a chunk (broadcastable to the output block) and their output location
+    chunks = layout['chunks']
+    ndim = len(chunks)
+    out_ndim = ndim - len(point_axes) + (1 if point_axes else 0)
+    position = {}
+    k = 0
+    for axis in range(ndim):
+        if axis in point_axes:
+            if axis == point_axes[0]:
+                position['point'] = k
+                k += 1
+        else:
+            position[axis] = k
+            k += 1
+
+    local = []
+    window = []
+    target = [slice(None)] * out_ndim
+    for axis in range(ndim):
+        origin = chunk[axis] * chunks[axis]
+        shape = [1] * out_ndim
+        if axis in point_axes:
+            index = points[point_axes.index(axis)][members] - origin
+            shape[position['point']] = len(members)
+            target[position['point']] = members
+            window.append(slice(None))
+        else:
+            start, stop = bounds[axis]
+            first, last = max(start, origin), min(stop, origin + chunks[axis])
+            index = np.arange(first - origin, last - origin)
+            shape[position[axis]] = len(index)
+            target[position[axis]] = slice(first - start, last - start)
+            window.append(slice(first - origin, last - origin))
+        local.append(index.reshape(shape))
+    return {'local': local, 'window': tuple(window), 'target': tuple(target)}
+
+
+def _chunk_points(chunk, block, point_axes):
+    # Needed elements of a decoded chunk: the sliced window, then the points selected with extract_points
+    values = chunk[block['window']]
+    if not point_axes:
+        return values
+    values = np.moveaxis(values, point_axes, range(-len(point_axes), 0))
+    indexes = [block['local'][axis].reshape(-1) for axis in point_axes]
+    return np.moveaxis(extract_points({'chunk': values}, ['chunk'], *indexes)['chunk'], -1, point_axes[0])
+
+
+def _assemble_variable(plan, contents):
+    # Output array of a variable filled from the decoded chunks
+    layout = plan['layout']
+    fill_value = layout['fill_value'] if layout['fill_value'] is not None else 0
+    values = np.full(plan['out_shape'], fill_value, dtype=layout['dtype'])
+    for block in plan['blocks']:
+        reference = block['reference']
+        if reference is None:
+            continue  # Chunk never written, left at the fill value
+        if 'elements' in block:
+            flat, unique = block['elements']
+            run_values = np.frombuffer(b''.join(contents[i] for i in block['pieces']), dtype=layout['dtype'])
+            shape = np.broadcast_shapes(*[index.shape for index in block['local']])
+            values[block['target']] = run_values[np.searchsorted(unique, flat)].reshape(shape)
+            continue
+        raw = _inline_bytes(reference) if not isinstance(reference, list) else contents[block['pieces'][0]]
+        for codec in layout['codecs']:
+            raw = codec.decode(raw)
+        chunk = np.frombuffer(raw, dtype=layout['dtype']).reshape(layout['chunks'])
+        values[block['target']] = _chunk_points(chunk, block, plan['point_axes'])
+    return values
+
+
+def _inline_bytes(reference):
+    # Content of a chunk stored in the references (base64 or plain text)
+    if reference.startswith('base64:'):
+        return base64.b64decode(reference[7:])
+    return reference.encode()
+
+
+def _fetch_pieces(s3, url, pieces, max_gap):
+    # Content of every (start, end) byte range of the file: cached chunks first, the others fetched as a few
+    # coalesced ranges
+    contents = [None] * len(pieces)
+    with _chunk_cache_lock:
+        for k, (start, end) in enumerate(pieces):
+            content = _chunk_cache.get((url, start, end))
+            if content is not None:
+                _chunk_cache.move_to_end((url, start, end))
+                contents[k] = content
+    missing = [k for k, content in enumerate(contents) if content is None]
+    if not missing:
+        return contents
+
+    starts, ends = np.array([pieces[k] for k in missing], dtype=np.int64).T
+    merged_starts, merged_ends, groups = coalesce_ranges(starts, ends, max_gap)
+    ranges = [(int(start), int(end)) for start, end in zip(merged_starts, merged_ends)]
+    data = read_object_ranges(s3, url, ranges)
+
+    # The merged ranges come back concatenated in order
+    offsets = np.concatenate([[0], np.cumsum(merged_ends - merged_starts)])
+    begin = offsets[groups] + starts - merged_starts[groups]
+    with _chunk_cache_lock:
+        for k, b, start, end in zip(missing, begin, starts, ends):
+            contents[k] = data[b:b + (end - start)]
+            if _chunk_cache_options['max_bytes'] > 0 and (url, start, end) not in _chunk_cache:
+                _chunk_cache[(url, int(start), int(end))] = contents[k]
+                _chunk_cache_size[0] += len(contents[k])
+        _trim_chunk_cache()
+    return contents
+
+
+def _trim_chunk_cache():
+    # Drop least-recently-used chunks until the cache fits in max_bytes (called with the lock held)
+    while _chunk_cache and _chunk_cache_size[0] > _chunk_cache_options['max_bytes']:
+        _, content = _chunk_cache.popitem(last=False)
+        _chunk_cache_size[0] -= len(content)
@@ -0,0 +1,315 @@
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+import zarr
+import numcodecs
+try:
+    from ._S3 import get_s3_filesystem
+    from ._CACHE import memoized_artifact, atomic_directory, coordinates_id
+    from ._CHUNKS import read_chunk_points, chunk_references, chunk_layout
+    from ._INTERP import nearest_points
+except ImportError:
+    from _S3 import get_s3_filesystem
+    from _CACHE import memoized_artifact, atomic_directory, coordinates_id
+    from _CHUNKS import read_chunk_points, chunk_references, chunk_layout
+    from _INTERP import nearest_points
+
+
+# 3-D (time, node, layer) variables of the STOFS-3D-Atl fields files, one file per variable
+FIELD_VARIABLES = ['temperature', 'salinity', 'zCoordinates']
+
+# Variables of the field2d files describing the nodes of the horizontal grid
+NODE_COORDINATES = {'lon': 'SCHISM_hgrid_node_x', 'lat': 'SCHISM_hgrid_node_y', 'depth': 'depth'}
+
+# Value range of each variable mapped on the int16 values of a quantized store (the precision is about 1/65534 of it)
+QUANTIZATION_RANGES = {'temperature': (-5.0, 45.0), 'salinity': (0.0, 45.0), 'zCoordinates': (-11000.0, 100.0)}
+
+# Node coordinates already read in this process, by url of the field2d file (or path of a rechunked store)
+_nodes = {}
+
+# Directory of the rechunked profile stores read in place of S3 when they exist (None: always read S3)
+_profile_store_options = {'directory': None}
+
+
+def configure_profile_store(directory):
+    """
+    Function to set the directory of the rechunked stores (from rechunk_fields) that the profile readers use
+    instead of the S3 files when the store of a cycle exists.
+
+    Parameters:
+    - directory (str): Directory of the stores (None always reads the S3 files)
+    """
+    _profile_store_options['directory'] = directory
+
+
+def profile_store_path(store_dir, date, cycle, period='f001_012', modelname='stofs_3d_atl'):
+    """
+    Function to get the location of the rechunked store of the 3-D fields of a cycle.
+
+    Parameters:
+    - store_dir (str): Directory of the stores
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g. '12')
+    - period (str): Forecast hours of the files (e.g. 'f001_012')
+    - modelname (str): The STOFS model name
+
+    Returns:
+    - str: Path of the Zarr store
+    """
+    return os.path.join(store_dir, f'{modelname}.{date}.t{cycle}z.fields_{period}.zarr')
+
+
+def field_url(date, cycle, field, period='f001_012', bucketname='noaa-nos-stofs3d-pds', directoryname='STOFS-3D-Atl',
+              modelname='stofs_3d_atl'):
+    """
+    Function to get the url of a STOFS-3D-Atl field file.
+
+    Parameters:
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g. '12')
+    - field (str): 'field2d' or the name of a 3-D variable (e.g. 'temperature')
+    - period (str): Forecast hours of the file (e.g. 'f001_012', 'f013_024')
+    - bucketname (str): The name of the S3 bucket
+    - directoryname (str): Directory name in the S3 bucket
+    - modelname (str): The STOFS model name
+
+    Returns:
+    - str: s3:// url of the file
+    """
+    name = field if field == 'field2d' else f'fields.{field}'
+    return f's3://{bucketname}/{directoryname}/{modelname}.{date}/{modelname}.t{cycle}z.{name}_{period}.nc'
+
+
+def field_nodes(date, cycle, period='f001_012', s3=None, **location):
+    """
+    Function to get the coordinates of the nodes of the STOFS-3D-Atl horizontal grid from a field2d file. They are
+    read once (only the coordinate variables are fetched) and kept in memory and, when the local cache is enabled,
+    on disk.
+
+    Parameters:
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g. '12')
+    - period (str): Forecast hours of the file (e.g. 'f001_012')
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - location: Optional bucketname, directoryname and modelname (see field_url)
+
+    Returns:
+    - dict: 'grid_id' (hash of the coordinates), then 'lat', 'lon' and 'depth' of every node
+    """
+    url = field_url(date, cycle, 'field2d', period, **location)
+
+    def build():
+        coordinates = read_chunk_points(url, list(NODE_COORDINATES.values()), {}, s3=s3)
+        return _with_grid_id({name: np.asarray(coordinates[variable].values, dtype=float)
+                              for name, variable in NODE_COORDINATES.items()})
+
+    def load(path):
+        with np.load(path) as stored:
+            return _with_grid_id({name: stored[name] for name in NODE_COORDINATES})
+
+    def save(nodes, tmp_file):
+        np.savez(tmp_file, **{name: nodes[name] for name in NODE_COORDINATES})
+
+    return memoized_artifact(_nodes, url, 'nodes', hashlib.sha256(url.encode()).hexdigest() + '.npz', build, load,
+                             save)
+
+
+def nearest_nodes(nodes, latitudes, longitudes):
+    """
+    Function to find the nodes of the horizontal grid closest to a set of locations, all at once.
+
+    Parameters:
+    - nodes (dict): Node coordinates from field_nodes
+    - latitudes (array-like): Latitudes of the locations
+    - longitudes (array-like): Longitudes of the locations
+
+    Returns:
+    - numpy.ndarray: Index of the closest node of each location
+    """
+    # The unstructured nodes are located with the KD-tree of the curvilinear grids (built once per grid)
+    geometry = {'grid_id': nodes['grid_id'], 'grid_type': 'curvilinear',
+                'latitudes': nodes['lat'], 'longitudes': nodes['lon']}
+    return nearest_points(geometry, latitudes, longitudes)[0]
+
+
+def read_field_profiles(date, cycle, nodes=None, latitudes=None, longitudes=None, variables=FIELD_VARIABLES,
+                        period='f001_012', s3=None, **location):
+    """
+    Function to read the vertical profiles of STOFS-3D-Atl 3-D fields at a set of nodes, over the time steps of the
+    files. Only the HDF5 chunks holding the nodes are fetched (with coalesced range requests, and kept in the
+    in-memory chunk cache of _CHUNKS), instead of whole variables of several GB. Variables held by the rechunked
+    store of the cycle (see configure_profile_store) are read from it instead.
+
+    Parameters:
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g. '12')
+    - nodes (array-like): Indexes of the nodes, or None to use the nodes closest to latitudes/longitudes
+    - latitudes (array-like): Latitudes of the locations (when nodes is None)
+    - longitudes (array-like): Longitudes of the locations (when nodes is None)
+    - variables (list of str): 3-D variables to read (e.g. ['temperature', 'salinity', 'zCoordinates'])
+    - period (str): Forecast hours of the files (e.g. 'f001_012')
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - location: Optional bucketname, directoryname and modelname (see field_url)
+
+    Returns:
+    - xarray.Dataset: The variables on (time, node, layer), with the node index, lat, lon and depth of each node
+    """
+    s3 = get_s3_filesystem(s3)
+    store = None
+    if _profile_store_options['directory']:
+        path = profile_store_path(_profile_store_options['directory'], date, cycle, period,
+                                  location.get('modelname', 'stofs_3d_atl'))
+        if os.path.isdir(path):
+            store = xr.open_zarr(path, consolidated=False)
+    if store is not None:
+        grid = _store_nodes(path, store)
+    else:
+        grid = field_nodes(date, cycle, period, s3=s3, **location)
+    if nodes is None:
+        if latitudes is None or longitudes is None:
+            raise ValueError('Either nodes or latitudes and longitudes are needed')
+        nodes = nearest_nodes(grid, latitudes, longitudes)
+    nodes = np.atleast_1d(np.asarray(nodes, dtype=np.int64))
+
+    profiles = []
+    for variable in variables:
+        if store is not None and variable in store:
+            # One chunk of the store holds every time step and layer of a block of nodes (quantized stores are read
+            # back as float32 like the files)
+            profile = store[[variable]].drop_vars(['lat', 'lon', 'depth']).isel(node=nodes).load()
+            profiles.append(profile.astype(np.float32) if profile[variable].dtype != np.float32 else profile)
+            continue
+        url = field_url(date, cycle, variable, period, **location)
+        _, node_dim, layer_dim = chunk_layout(chunk_references(url, s3=s3), variable)['dims']
+        profile = read_chunk_points(url, [variable], {node_dim: nodes}, s3=s3)
+        profiles.append(profile.rename({'point': 'node', layer_dim: 'layer'}))
+
+    # The files of a period share their time steps, the profiles are aligned on them
+    ds = xr.merge(profiles, join='exact')
+    return ds.assign_coords(node=nodes, lat=('node', grid['lat'][nodes]), lon=('node', grid['lon'][nodes]),
+                            depth=('node', grid['depth'][nodes]))
+
+
+def rechunk_fields(store_dir, date, cycle, period='f001_012', variables=FIELD_VARIABLES, node_block=8192,
+                   quantize=None, max_bytes=1024**3, clevel=5, s3=None, **location):
+    """
+    Function to rewrite the 3-D field files of a cycle into a local Zarr store chunked for profiles: one chunk holds
+    every time step and layer of a block of nodes, compressed with Blosc/Zstd. The files are streamed a window of
+    nodes at a time, each window sized by the source chunks it touches, so memory stays bounded whatever the size of
+    the grid.
+
+    Parameters:
+    - store_dir (str): Directory of the stores
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g. '12')
+    - period (str): Forecast hours of the files (e.g. 'f001_012')
+    - variables (list of str): 3-D variables to rewrite
+    - node_block (int): Number of nodes per chunk of the store
+    - quantize (str): None (float32 values), 'float16', or 'int16' (values scaled over QUANTIZATION_RANGES)
+    - max_bytes (int): Approximate size of the data held in memory at once: the values of a window and the source
+      chunks it touches (a window holds at least one chunk of the store, whatever the size of the source chunks)
+    - clevel (int): Zstd compression level
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - location: Optional bucketname, directoryname and modelname (see field_url)
+
+    Returns:
+    - str: Path of the store (left as it is when it already exists)
+    """
+    import dask.array
+
+    if quantize not in (None, 'float16', 'int16'):
+        raise ValueError(f"Unknown quantization {quantize!r}, expected None, 'float16' or 'int16'")
+    s3 = get_s3_filesystem(s3)
+    path = profile_store_path(store_dir, date, cycle, period, location.get('modelname', 'stofs_3d_atl'))
+    if os.path.isdir(path):
+        return path
+    os.makedirs(store_dir, exist_ok=True)
+    grid = field_nodes(date, cycle, period, s3=s3, **location)
+    n_nodes = len(grid['lat'])
+
+    # Shape, time steps and layer dimension of each source file
+    urls = {variable: field_url(date, cycle, variable, period, **location) for variable in variables}
+    layouts = {variable: chunk_layout(chunk_references(url, s3=s3), variable) for variable, url in urls.items()}
+    shapes = {layout['shape'] for layout in layouts.values()}
+    if len(shapes) != 1:
+        raise ValueError(f'The field files of {date} t{cycle}z {period} have different shapes: {sorted(shapes)}')
+    n_times, _, n_layers = shapes.pop()
+
+    # zarr-python 3 takes a list of codecs and writes Zarr v3 unless told otherwise, the store stays in the v2
+    # format read by both versions
+    compressor = numcodecs.Blosc(cname='zstd', clevel=clevel, shuffle=numcodecs.Blosc.SHUFFLE)
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        compression, store_options = {'compressors': (compressor,)}, {'zarr_format': 2}
+    else:
+        compression, store_options = {'compressor': compressor}, {}
+    encoding = {}
+    for variable in variables:
+        encoding[variable] = {'chunks': (n_times, node_block, n_layers), **compression}
+        if quantize == 'float16':
+            encoding[variable]['dtype'] = 'float16'
+        elif quantize == 'int16':
+            low, high = QUANTIZATION_RANGES[variable]
+            encoding[variable].update({'dtype': 'int16', 'scale_factor': (high - low) / 65534,
+                                       'add_offset': (high + low) / 2, '_FillValue': np.int16(-32768)})
+
+    # Written under a temporary name first, readers only see complete stores
+    with atomic_directory(path) as tmp_path:
+        for start, stop in _rechunk_windows(layouts.values(), n_nodes, node_block, max_bytes):
+            block = xr.Dataset({variable: read_chunk_points(urls[variable], [variable],
+                                                            {layouts[variable]['dims'][1]: slice(start, stop)},
+                                                            s3=s3)[variable] for variable in variables})
+            block = block.rename({layouts[variables[0]]['dims'][1]: 'node', layouts[variables[0]]['dims'][2]: 'layer'})
+            if quantize == 'int16':
+                # Values outside the range are clipped instead of wrapping around in int16
+                for variable in variables:
+                    block[variable] = block[variable].clip(*QUANTIZATION_RANGES[variable])
+            if start == 0:
+                # Template of the whole store (no data is computed), then each window fills its region
+                template = xr.Dataset(
+                    {variable: (('time', 'node', 'layer'),
+                                dask.array.zeros((n_times, n_nodes, n_layers), chunks=(n_times, node_block, n_layers),
+                                                 dtype=np.float32), block[variable].attrs)
+                     for variable in variables},
+                    coords={'time': block['time'],
+                            'lat': ('node', grid['lat']), 'lon': ('node', grid['lon']),
+                            'depth': ('node', grid['depth'])})
+                template.attrs = {'source': [urls[variable] for variable in variables]}
+                template.to_zarr(tmp_path, mode='w', compute=False, encoding=encoding, consolidated=False,
+                                 **store_options)
+            block.drop_vars('time').to_zarr(tmp_path, region={'node': slice(start, stop)}, consolidated=False)
+    return path
+
+
+def _rechunk_windows(layouts, n_nodes, node_block, max_bytes):
+    # Node windows of whole chunks of the store, grown while the window values and the source chunks they touch
+    # (in full, along every dimension) fit in max_bytes
+    def window_bytes(start, stop):
+        size = 0
+        for layout in layouts:
+            (n_times, _, n_layers), (time_chunk, node_chunk, layer_chunk) = layout['shape'], layout['chunks']
+            touched = -(-stop // node_chunk) * node_chunk - start // node_chunk * node_chunk
+            padded = -(-n_times // time_chunk) * time_chunk * -(-n_layers // layer_chunk) * layer_chunk
+            size += ((stop - start) * n_times * n_layers + touched * padded) * layout['dtype'].itemsize
+        return size
+
+    start = 0
+    while start < n_nodes:
+        stop = min(start + node_block, n_nodes)
+        while stop < n_nodes and window_bytes(start, min(stop + node_block, n_nodes)) <= max_bytes:
+            stop = min(stop + node_block, n_nodes)
+        yield start, stop
+        start = stop
+
+
+def _store_nodes(path, store):
+    # Node coordinates held by a rechunked store, in the form of field_nodes
+    if path not in _nodes:
+        _nodes[path] = _with_grid_id({name: np.asarray(store[name].values, dtype=float) for name in NODE_COORDINATES})
+    return _nodes[path]
+
+
+def _with_grid_id(nodes):
+    # Node coordinates with the identifier of the grid, used to name the KD-tree of the grid
+    nodes['grid_id'] = coordinates_id(nodes['lat'], nodes['lon'])
+    return nodes
\ No newline at end of file
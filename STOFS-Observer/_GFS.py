@@ -1,31 +1,396 @@
+import logging
+import warnings
 import numpy as np
 import pandas as pd
 import xarray as xr
-import tempfile
-import pygrib
-import s3fs
+from collections import deque
 from datetime import datetime, timedelta
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    from ._S3 import (get_s3_filesystem, read_object_async, s3_session_configuration, configure_s3_session,
+                      injected_s3_filesystem, set_s3_filesystem)
+except ImportError:
+    from _S3 import (get_s3_filesystem, read_object_async, s3_session_configuration, configure_s3_session,
+                     injected_s3_filesystem, set_s3_filesystem)
+try:
+    from ._CACHE import read_object, read_object_ranges, cache_configuration, configure_cache
+except ImportError:
+    from _CACHE import read_object, read_object_ranges, cache_configuration, configure_cache
+try:
+    from ._GRIB import (decode_grib, grib_grid_geometry, nearest_grid_points, configure_grib_backend,
+                        configured_grib_backend)
+except ImportError:
+    from _GRIB import (decode_grib, grib_grid_geometry, nearest_grid_points, configure_grib_backend,
+                       configured_grib_backend)
+try:
+    from ._INTERP import interpolation_weights, apply_weights, extract_points
+except ImportError:
+    from _INTERP import interpolation_weights, apply_weights, extract_points
+try:
+    from ._POINTS import read_points, write_points
+except ImportError:
+    from _POINTS import read_points, write_points
+
+logger = logging.getLogger(__name__)
+
+
+# Inventory names (variable:level) of the GRIB2 messages used as STOFS forcing
+GFS_FORCING_MESSAGES = ['PRES:surface', 'UGRD:10 m above ground', 'VGRD:10 m above ground']
+
+# Names of the forcing variables, in the order of the compatibility tuple
+GFS_FORCING_VARIABLES = ['u_wind', 'v_wind', 'surface_pressure']
+
+
+def fetch_gfs_grib(url, s3=None):
+    """
+    Function to fetch a GFS GRIB2 file from S3 (or from the local cache when it is enabled).
+
+    Parameters:
+    - url (str): s3:// url of the GRIB2 file.
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+
+    Returns:
+    - bytes: Content of the GRIB2 file.
+    """
+    return read_object(get_s3_filesystem(s3), url)
+
+
+async def fetch_gfs_grib_async(url, s3=None, semaphore=None):
+    """
+    Function to fetch a GFS GRIB2 file from S3 on the running event loop.
+
+    Parameters:
+    - url (str): s3:// url of the GRIB2 file.
+    - s3: Optional asynchronous S3 filesystem (defaults to the session of the running loop).
+    - semaphore (asyncio.Semaphore): Optional semaphore limiting the number of reads in flight.
+
+    Returns:
+    - bytes: Content of the GRIB2 file.
+    """
+    return await read_object_async(url, s3=s3, semaphore=semaphore)
+
+
+def read_grib_index(url, s3=None):
+    """
+    Function to read the .idx inventory published next to a GRIB2 file.
+
+    Parameters:
+    - url (str): s3:// url of the GRIB2 file.
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+
+    Returns:
+    - list of dict: One entry per message with its 'offset', 'start' and 'end' byte positions (end is None
+      for the last message), 'variable', 'level' and 'forecast'.
+    """
+    lines = fetch_gfs_grib(f'{url}.idx', s3=s3).decode().splitlines()
+
+    # Lines look like '582:441231947:d=2024092200:PRES:surface:6 hour fcst:'
+    entries = []
+    for line in lines:
+        fields = line.split(':')
+        if len(fields) < 6:
+            continue
+        entries.append({'start': int(fields[1]), 'variable': fields[3], 'level': fields[4], 'forecast': fields[5]})
+
+    # A message ends where the next one starts (sub-messages share the offset of their message)
+    offsets = sorted({entry['start'] for entry in entries})
+    next_offset = dict(zip(offsets, offsets[1:] + [None]))
+    for entry in entries:
+        entry['end'] = next_offset[entry['start']]
+    return entries
+
+
+def fetch_gfs_grib_messages(url, messages=GFS_FORCING_MESSAGES, s3=None):
+    """
+    Function to fetch only some messages of a GFS GRIB2 file from S3, using range requests located with its
+    .idx inventory. The whole file is fetched when the inventory is missing or does not list every message.
+
+    Parameters:
+    - url (str): s3:// url of the GRIB2 file.
+    - messages (list of str): Inventory names ('variable:level') of the messages to fetch.
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+
+    Returns:
+    - bytes: GRIB2 messages, in file order (a valid GRIB2 stream).
+    """
+    s3 = get_s3_filesystem(s3)
+    try:
+        entries = read_grib_index(url, s3=s3)
+    except FileNotFoundError:
+        return fetch_gfs_grib(url, s3=s3)
+
+    selected = [entry for entry in entries if f"{entry['variable']}:{entry['level']}" in messages]
+    if {f"{entry['variable']}:{entry['level']}" for entry in selected} != set(messages):
+        return fetch_gfs_grib(url, s3=s3)
+
+    # Adjacent messages are coalesced into one range request
+    ranges = []
+    for start, end in sorted({(entry['start'], entry['end']) for entry in selected}):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    if ranges[-1][1] is None:
+        ranges[-1] = (ranges[-1][0], s3.size(url))
+    return read_object_ranges(s3, url, ranges)
+
+
+def _fetch_forcing_grib(url, s3, byte_ranges):
+    if byte_ranges:
+        return fetch_gfs_grib_messages(url, s3=s3)
+    return fetch_gfs_grib(url, s3=s3)
+
+
+def _gfs_url(date, cycle, hour):
+    return f"s3://noaa-gfs-bdp-pds/gfs.{date}/{cycle}/atmos/gfs.t{cycle}z.sfluxgrbf{hour:03d}.grib2"
+
+
+def _station_forcing(grib_data, grib_backend, latitudes, longitudes, interpolation):
+    # Forcing vectors at the stations: one pointwise selection (nearest) or one sparse product per decoded field
+    arrays = decode_grib(grib_data, backend=grib_backend)
+    geometry = grib_grid_geometry(grib_data)
+    if interpolation == 'nearest':
+        y, x = nearest_grid_points(geometry, latitudes, longitudes)
+        return extract_points(arrays, GFS_FORCING_VARIABLES, y, x)
+    weights = interpolation_weights(geometry, latitudes, longitudes, method=interpolation)
+    return {name: apply_weights(weights, arrays[name]) for name in GFS_FORCING_VARIABLES}
+
+
+def _fetch_station_forcing(file, s3, byte_ranges, grib_backend, latitudes, longitudes, interpolation,
+                           point_store=None, skip_missing=False):
+    # Download, decode and gather one GRIB2 file (date, cycle, hour); only the station vectors leave this function,
+    # returned with None, or None and the failure when a missing file is skipped
+    date, cycle, hour = file
+    url = _gfs_url(date, cycle, hour)
+
+    # Stations already extracted from this file are read from the point store, the file is only needed for the others
+    values = {name: np.full(len(latitudes), np.nan) for name in GFS_FORCING_VARIABLES}
+    found = np.zeros(len(latitudes), dtype=bool)
+    if point_store:
+        partition = {'cycle': f'{date}{cycle}', 'hour': f'{hour:03d}'}
+        values, found = read_points(point_store, partition, interpolation, latitudes, longitudes,
+                                    GFS_FORCING_VARIABLES)
+        if found.all():
+            return values, None
+
+    logger.debug('Fetching %s', url)
+    try:
+        grib_data = _fetch_forcing_grib(url, get_s3_filesystem(s3), byte_ranges)
+    except Exception as e:
+        if not skip_missing:
+            raise
+        logger.debug('Could not fetch %s: %s', url, e)
+        return None, {'date': date, 'cycle': cycle, 'hour': hour, 'url': url, 'error': str(e)}
+
+    # The grid geometry and the interpolation weights are built once per process
+    missing = ~found
+    extracted = _station_forcing(grib_data, grib_backend, latitudes[missing], longitudes[missing], interpolation)
+    if point_store:
+        write_points(point_store, partition, interpolation, grib_grid_geometry(grib_data)['grid_id'],
+                     latitudes[missing], longitudes[missing], extracted)
+    for name in GFS_FORCING_VARIABLES:
+        values[name][missing] = extracted[name]
+    return values, None
+
+
+def _station_forcing_task(stations, s3, byte_ranges, grib_backend, interpolation, point_store, skip_missing):
+    # _fetch_station_forcing with everything but the file bound, picklable for the worker processes
+    return partial(_fetch_station_forcing, s3=s3, byte_ranges=byte_ranges,
+                   grib_backend=grib_backend or configured_grib_backend(),
+                   latitudes=np.asarray(stations['lat'], dtype=float),
+                   longitudes=np.asarray(stations['lon'], dtype=float), interpolation=interpolation,
+                   point_store=point_store, skip_missing=skip_missing)
+
+
+def _map_station_forcing(files, stations, s3, byte_ranges, grib_backend, interpolation, point_store, max_workers,
+                         skip_missing=False):
+    # (station vectors, failure) of every (date, cycle, hour) file, in order, computed in a process pool when
+    # max_workers > 1
+    task = _station_forcing_task(stations, s3, byte_ranges, grib_backend, interpolation, point_store, skip_missing)
+    if max_workers > 1:
+        # Workers get the S3 session options (or the injected filesystem) and the cache settings of this process
+        # (they are not inherited when processes are spawned)
+        initargs = (s3_session_configuration(), injected_s3_filesystem(), cache_configuration(),
+                    grib_backend or configured_grib_backend())
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_configure_worker,
+                                 initargs=initargs) as executor:
+            return list(executor.map(task, files))
+    return [task(file) for file in files]
+
+
+def _iter_station_forcing(files, stations, s3, byte_ranges, grib_backend, interpolation, point_store, prefetch,
+                          skip_missing=False):
+    # (station vectors, failure) of every (date, cycle, hour) file, in order, as they become available; up to prefetch
+    # files ahead are downloaded and decoded in background threads, so memory is bounded by the read-ahead window
+    task = _station_forcing_task(stations, s3, byte_ranges, grib_backend, interpolation, point_store, skip_missing)
+    if prefetch < 1:
+        for file in files:
+            yield task(file)
+        return
+
+    files = iter(files)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    try:
+        for file in files:
+            pending.append(executor.submit(task, file))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Files read ahead for a consumer that stopped early are not fetched
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _configure_worker(s3_options, s3, cache_options, grib_backend):
+    configure_s3_session(**s3_options)
+    if s3 is not None:
+        set_s3_filesystem(s3)
+    configure_cache(**cache_options)
+    configure_grib_backend(grib_backend)
+
+
+def _forcing_dataset(times, stations, data):
+    # Labelled (time, station) Dataset of the forcing arrays
+    return xr.Dataset(
+        data_vars={name: (('time', 'station'), data[name]) for name in GFS_FORCING_VARIABLES},
+        coords={
+            'time': pd.DatetimeIndex(times),
+            'station': [int(nos_id) for nos_id in stations['nos_id']],
+            'lat': ('station', np.asarray(stations['lat'], dtype=float)),
+            'lon': ('station', np.asarray(stations['lon'], dtype=float))},
+        attrs={'description': 'GFS forcing at the stations'})
+
+
+def resample_station_forcing(sources, output_times, n_stations):
+    """
+    Function to interpolate station forcing linearly in time, keeping only two source fields in memory.
+
+    Parameters:
+    - sources (iterable of tuple): (time, dict of station vectors) in time order, e.g. decoded GFS files.
+    - output_times (pd.DatetimeIndex): Sorted output times, within the time span of the sources.
+    - n_stations (int): Number of stations.
+
+    Returns:
+    - dict: Variable name -> (n_times, n_stations) array, rounded to 2 decimals.
+    """
+    output_times = pd.DatetimeIndex(output_times)
+    data = {name: np.full((len(output_times), n_stations), np.nan) for name in GFS_FORCING_VARIABLES}
+    for start, end, block in _resampled_blocks(sources, output_times):
+        for name in GFS_FORCING_VARIABLES:
+            data[name][start:end] = block[name]
+    return data
+
+
+def _resampled_blocks(sources, output_times):
+    # Sliding window of two fields: every output time in (time_0, time_1] is interpolated at once and yielded as
+    # (start, end, dict of (end - start, n_stations) arrays rounded to 2 decimals) as soon as time_1 is read
+    time_0 = values_0 = None
+    for time_1, values_1 in sources:
+        time_1 = pd.Timestamp(time_1)
+        end = output_times.searchsorted(time_1, side='right')
+        if time_0 is None:
+            start = output_times.searchsorted(time_1, side='left')
+            block = {name: np.broadcast_to(values_1[name], (end - start, len(values_1[name])))
+                     for name in GFS_FORCING_VARIABLES}
+        else:
+            start = output_times.searchsorted(time_0, side='right')
+            weights = np.asarray((output_times[start:end] - time_0) / (time_1 - time_0))[:, np.newaxis]
+            block = {name: values_0[name] + weights * (values_1[name] - values_0[name])
+                     for name in GFS_FORCING_VARIABLES}
+        if end > start:
+            yield start, end, {name: np.round(block[name], 2) for name in GFS_FORCING_VARIABLES}
+        time_0, values_0 = time_1, values_1
+
+
+def gfs_forcing_frames(ds):
+    """
+    Function to convert a GFS forcing Dataset into the DataFrames returned by fetch_gfs_Nowcast_data and
+    fetch_gfs_Forecast_data.
+
+    Parameters:
+    - ds (xarray.Dataset): (time, station) Dataset from fetch_gfs_Nowcast_dataset or fetch_gfs_Forecast_dataset.
+
+    Returns:
+    - pd.DataFrame: u_wind, one column per NOS id.
+    - pd.DataFrame: v_wind, one column per NOS id.
+    - pd.DataFrame: surface pressure, one column per NOS id.
+    - list of datetime: Time of each row.
+    """
+    columns = [int(nos_id) for nos_id in ds['station'].values]
+    frames = [pd.DataFrame(ds[name].values, columns=columns) for name in GFS_FORCING_VARIABLES]
+    return (*frames, list(ds.indexes['time'].to_pydatetime()))
+
 
+def fetch_gfs_Nowcast_dataset(start_date, end_date, cycles, stations, num_time_steps, s3=None, byte_ranges=True,
+                              grib_backend=None, max_workers=1, interpolation='nearest', point_store=None,
+                              return_failures=False):
+    """
+    Function to fetch GFS data for specified dates and cycles and return the wind and pressure at the stations.
 
+    Parameters:
+    - start_date (str): The start date in 'YYYYMMDD' format.
+    - end_date (str): The end date in 'YYYYMMDD' format.
+    - cycles (list of str): List of cycles (e.g., ['00', '06', '12', '18']).
+    - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id).
+    - num_time_steps (int): Number of time steps to retrieve from each cycle.
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+    - byte_ranges (bool): Only fetch the pressure and 10 m wind messages, located with the .idx inventories.
+    - grib_backend (str): GRIB decoder, 'pygrib', 'eccodes' or 'cfgrib' (default: the configured backend).
+    - max_workers (int): Number of worker processes downloading and decoding files in parallel.
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'.
+    - point_store (str): Optional directory of a Parquet store of the extracted station values, consulted before S3.
+    - return_failures (bool): Also return the files that could not be fetched instead of warning about them.
 
-def find_index_closest_data(ds, stations):
-    lat_indices = {}
-    lon_indices = {}
-    
-    for y_val, x_val, nos_id in zip(stations['lat'], stations['lon'], stations['nos_id']): 
-        longitude_adjusted = float(x_val) + 360 if float(x_val) < 0 else float(x_val)
-        
-        # Get the nearest indices for latitude and longitude
-        lat_idx = np.where((np.abs(ds['latitude'][0:4718592:3072] - float(y_val))) == np.min(np.abs(ds['latitude'][0:4718592:3072] -                          float(y_val))))
-        lon_idx = np.where((np.abs(ds['longitude'][0:3072] - longitude_adjusted)) == np.min(np.abs(ds['longitude'][0:3072] -                                  longitude_adjusted)))
-       
-        # Store indices in dictionaries 
-        lat_indices[nos_id] = lat_idx 
-        lon_indices[nos_id] = lon_idx
+    Returns:
+    - xarray.Dataset: u_wind, v_wind and surface_pressure on (time, station), with the NOS ids as station labels.
+      Hours that could not be fetched are left out.
+    - list of dict: Files that could not be fetched, with their 'date', 'cycle', 'hour', 'url' and 'error' (only if
+      return_failures is True).
+    """
 
-    return lat_indices, lon_indices
+    # Generate the list of files and their times
+    files = []
+    current_date = datetime.strptime(start_date, '%Y%m%d')
+    while current_date <= datetime.strptime(end_date, '%Y%m%d'):
+        date = current_date.strftime('%Y%m%d')
+        for cycle in cycles:
+            for hour in range(0, num_time_steps, 1):  # Loop over specified number of time steps
+                time = current_date + timedelta(hours=int(cycle)) + timedelta(hours=hour)
+                files.append(((date, cycle, hour), time))
+        current_date += timedelta(days=1)
 
-def fetch_gfs_Nowcast_data(start_date, end_date, cycles, stations, num_time_steps):
+    # Preallocate the (time, station) arrays, each file fills one row
+    data = {name: np.full((len(files), len(stations)), np.nan) for name in GFS_FORCING_VARIABLES}
+    fetched = np.zeros(len(files), dtype=bool)
+
+    results = _map_station_forcing([file for file, time in files], stations, s3, byte_ranges, grib_backend,
+                                   interpolation, point_store, max_workers, skip_missing=True)
+    failures = []
+    for row, (values, failure) in enumerate(results):
+        if values is None:
+            failures.append(failure)
+            continue
+        for name in GFS_FORCING_VARIABLES:
+            data[name][row] = np.round(values[name], 2)
+        fetched[row] = True
+    if failures and not return_failures:
+        warnings.warn(f'{len(failures)} GFS file(s) could not be fetched from S3: '
+                      + ', '.join(failure['url'] for failure in failures))
+
+    times = [time for file, time in files]
+    ds = _forcing_dataset(np.array(times)[fetched], stations, {name: data[name][fetched] for name in data})
+    if return_failures:
+        return ds, failures
+    return ds
+
+
+def fetch_gfs_Nowcast_data(start_date, end_date, cycles, stations, num_time_steps, s3=None, byte_ranges=True,
+                           grib_backend=None, max_workers=1, interpolation='nearest', point_store=None):
     """
     Function to fetch GFS data for specified dates and cycles and return a DataFrame with wind and pressure information.
 
@@ -35,122 +400,85 @@ def fetch_gfs_Nowcast_data(start_date, end_date, cycles, stations, num_time_step
     - cycles (list of str): List of cycles (e.g., ['00', '06', '12', '18']).
     - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id).
     - num_time_steps (int): Number of time steps to retrieve from each cycle.
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+    - byte_ranges (bool): Only fetch the pressure and 10 m wind messages, located with the .idx inventories.
+    - grib_backend (str): GRIB decoder, 'pygrib', 'eccodes' or 'cfgrib' (default: the configured backend).
+    - max_workers (int): Number of worker processes downloading and decoding files in parallel.
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'.
+    - point_store (str): Optional directory of a Parquet store of the extracted station values, consulted before S3.
 
     Returns:
-    - pd.DataFrame: DataFrame containing the time, u_wind, v_wind, and surface pressure.
+    - pd.DataFrame: DataFrame containing the time, u_wind, v_wind, and surface pressure
+      (see fetch_gfs_Nowcast_dataset for the same data as a labelled Dataset).
     """
-    
-    # Initialize a list to store data for the DataFrame
-    u_wind_dfs = pd.DataFrame()
-    v_wind_dfs = pd.DataFrame()
-    surface_pressure_dfs = pd.DataFrame()
+    return gfs_forcing_frames(fetch_gfs_Nowcast_dataset(start_date, end_date, cycles, stations, num_time_steps,
+                                                        s3=s3, byte_ranges=byte_ranges, grib_backend=grib_backend,
+                                                        max_workers=max_workers, interpolation=interpolation,
+                                                        point_store=point_store))
 
-    # Initialize list to store all time information 
-    all_times = []
 
+def _forecast_files(date, cycle):
+    # (date, cycle, hour) source files of the forcing of a STOFS cycle and their valid times
+    # list of cycles in STOFS-2dd-Global
+    cycles_2d = ['00', '06', '12', '18']
+
+    cycle_time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(cycle))
+
+    # Source files: hourly up to 120 h (the first 6 hours from the previous cycle), then 3-hourly up to 180 h
+    files = []
+    times = []
+    for hour in range(0, 121, 1):
+        if hour < 6:
+            # The first 6 hours come from the previous cycle (of the day before for cycle 00)
+            previous_time = cycle_time - timedelta(hours=6)
+            previous_cycle = cycles_2d[cycles_2d.index(cycle) - 1]
+            files.append((previous_time.strftime('%Y%m%d'), previous_cycle, hour))
+            times.append(previous_time + timedelta(hours=hour))
+        else:
+            files.append((date, cycle, hour - 6))
+            times.append(cycle_time + timedelta(hours=hour - 6))
+    for hour in range(123, 187, 3):  # Assuming data is available 3-hourly
+        files.append((date, cycle, hour - 6))
+        times.append(cycle_time + timedelta(hours=hour - 6))
+    return files, times
+
+
+def fetch_gfs_Forecast_dataset(date, cycle, stations, s3=None, byte_ranges=True, grib_backend=None, max_workers=1,
+                               freq='1h', interpolation='nearest', point_store=None):
+    """
+    Function to fetch GFS data for date and cycle used as the STOFS forcing data and return the wind and pressure
+    at the stations.
 
-    # Generate date list
-    dates = []
-    current_date = datetime.strptime(start_date, '%Y%m%d')
-    end_date = datetime.strptime(end_date, '%Y%m%d')
+    Parameters:
+    - date (str): The date in 'YYYYMMDD' format.
+    - cycle (str): cycle (e.g., ['00', '06', '12', '18']).
+    - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id).
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+    - byte_ranges (bool): Only fetch the pressure and 10 m wind messages, located with the .idx inventories.
+    - grib_backend (str): GRIB decoder, 'pygrib', 'eccodes' or 'cfgrib' (default: the configured backend).
+    - max_workers (int): Number of worker processes downloading and decoding files in parallel.
+    - freq (str): Output time step (e.g. '1h', or '6min' to match the STOFS station output); the GFS files are
+      linearly interpolated in time.
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'.
+    - point_store (str): Optional directory of a Parquet store of the extracted station values, consulted before S3.
 
-    while current_date <= end_date:
-        dates.append(current_date.strftime('%Y%m%d'))
-        current_date += timedelta(days=1)
+    Returns:
+    - xarray.Dataset: u_wind, v_wind and surface_pressure on (time, station), with the NOS ids as station labels.
+    """
 
-    for date in dates:
-        print(date)
-        for i, cycle in enumerate(cycles):
-            for hour in range(0, num_time_steps, 1):  # Loop over specified number of time steps
-                # Adjust date for the previous cycle if needed
-
-                key = f'gfs.{date}/{cycle}/atmos/gfs.t{cycle}z.sfluxgrbf{hour:03d}.grib2'
-                time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(cycle)) + timedelta(hours=hour)
-
-                print(key)    
-                url = f"s3://noaa-gfs-bdp-pds/{key}"
-
-                # Fetch the GRIB2 data from S3
-                try:
-                    s3 = s3fs.S3FileSystem(anon=True)
-                    with s3.open(url, 'rb') as f:
-                        grib_data = f.read()
-                except Exception as e:
-                    print(f"Error fetching data from {url}: {e}")
-                    continue
-
-                # Define variable names of interest
-                variable_names = ['Surface pressure', '10 metre U wind component', '10 metre V wind component']
-                data_arrays = {var_name: [] for var_name in variable_names}
-
-                # Read GRIB2 data
-                with tempfile.NamedTemporaryFile(suffix=".grib2") as tmp_file:
-                    tmp_file.write(grib_data)
-                    tmp_file.seek(0)
-                    grbs = pygrib.open(tmp_file.name)
-
-                    for grb in grbs:
-                        if grb['name'] in variable_names:
-                            data_arrays[grb['name']].append(grb.values)
-
-                    grbs.close()
-
-
-                # Convert data arrays to xarray DataArrays
-                pressure_data = xr.DataArray(np.array(data_arrays['Surface pressure']), name='surface_pressure')
-                u_wind_data = xr.DataArray(np.array(data_arrays['10 metre U wind component']), name='u_wind')
-                v_wind_data = xr.DataArray(np.array(data_arrays['10 metre V wind component']), name='v_wind')
-
-                print(hour)
-                # Create an xarray Dataset
-                ds = xr.Dataset(
-                data_vars={
-                'surface_pressure': pressure_data,
-                'u_wind': u_wind_data,
-                'v_wind': v_wind_data},
-                coords={
-                'latitude': grb.latitudes,  # Assuming latitudes are the same for all messages
-                'longitude': grb.longitudes,},
-                attrs={
-                'description': 'GRIB Data Example'})
-
-
-                # Rename the dimensions 'dim_0', 'dim_1', 'dim_2' to 'time', 'y', 'x'
-                ds = ds.rename({'dim_0': 'time', 'dim_1': 'y', 'dim_2': 'x'})
-                # Initialize empty DataFrames to store wind and pressure data for this hour
-                u_wind_df = pd.DataFrame()
-                v_wind_df = pd.DataFrame()
-                surface_pressure_df = pd.DataFrame()
-                   
-                # Extract values for  stations
-                if not all_times:
-                    lat_indices, lon_indices = find_index_closest_data(ds, stations)  
-                    print(lat_indices)
-             
-                for nos_id in  stations['nos_id']:
-                    # Extract the forcing data using the index
-                    u_wind_value = ds.u_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    v_wind_value = ds.v_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    surface_pressure_value = ds.surface_pressure[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-
-
-                    # Append the values to the respective DataFrames as columns with NOS ids as column names
-                    u_wind_df[int(nos_id)] = [np.round(u_wind_value, 2)]
-                    v_wind_df[int(nos_id)]= [np.round(v_wind_value, 2)]
-                    surface_pressure_df[int(nos_id)] = [np.round(surface_pressure_value, 2)]
-            
-                # Append data for each station to the list
-                u_wind_dfs = pd.concat([u_wind_dfs, u_wind_df], ignore_index=True)
-                v_wind_dfs = pd.concat([v_wind_dfs, v_wind_df], ignore_index=True)
-                surface_pressure_dfs = pd.concat([surface_pressure_dfs, surface_pressure_df], ignore_index=True)
-            
-                # Store the time information 
-                all_times.append(time) 
-
-    return u_wind_dfs, v_wind_dfs, surface_pressure_dfs, all_times
-
-
-def fetch_gfs_Forecast_data(date, cycle, stations):
+    files, times = _forecast_files(date, cycle)
+
+    # Each file is fetched and decoded once, then resampled to the output time step
+    results = [values for values, _ in _map_station_forcing(files, stations, s3, byte_ranges, grib_backend,
+                                                            interpolation, point_store, max_workers)]
+    output_times = pd.date_range(times[0], times[-1], freq=freq)
+    data = resample_station_forcing(zip(times, results), output_times, len(stations))
+
+    return _forcing_dataset(output_times, stations, data)
+
+
+def fetch_gfs_Forecast_data(date, cycle, stations, s3=None, byte_ranges=True, grib_backend=None, max_workers=1,
+                            freq='1h', interpolation='nearest', point_store=None):
     """
     Function to fetch GFS data for date and cycle used as the STOFS forcing data and return a DataFrame with wind and pressure information.
 
@@ -158,297 +486,55 @@ def fetch_gfs_Forecast_data(date, cycle, stations):
     - date (str): The date in 'YYYYMMDD' format.
     - cycle (str): cycle (e.g., ['00', '06', '12', '18']).
     - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id).
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+    - byte_ranges (bool): Only fetch the pressure and 10 m wind messages, located with the .idx inventories.
+    - grib_backend (str): GRIB decoder, 'pygrib', 'eccodes' or 'cfgrib' (default: the configured backend).
+    - max_workers (int): Number of worker processes downloading and decoding files in parallel.
+    - freq (str): Output time step (e.g. '1h', or '6min' to match the STOFS station output).
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'.
+    - point_store (str): Optional directory of a Parquet store of the extracted station values, consulted before S3.
 
     Returns:
-    - pd.DataFrames: DataFrame containing the time, u_wind, v_wind, and surface pressure.
+    - pd.DataFrames: DataFrame containing the time, u_wind, v_wind, and surface pressure
+      (see fetch_gfs_Forecast_dataset for the same data as a labelled Dataset).
     """
-    
-    # Initialize a list to store data for the DataFrame
-    u_wind_dfs = pd.DataFrame()
-    v_wind_dfs = pd.DataFrame()
-    surface_pressure_dfs = pd.DataFrame()
+    return gfs_forcing_frames(fetch_gfs_Forecast_dataset(date, cycle, stations, s3=s3, byte_ranges=byte_ranges,
+                                                         grib_backend=grib_backend, max_workers=max_workers,
+                                                         freq=freq, interpolation=interpolation,
+                                                         point_store=point_store))
 
-    # Initialize list to store all time information 
-    all_times = []
-
-    # list of cycles in STOFS-2dd-Global
-    cycles_2d = ['00', '06', '12', '18']  
-
-
-    # Generate date list
-    for hour in range(0, 121, 1):  # Assuming we want to loop from 0 to 120 hours
-            print(hour)
-            if hour < 6:
-                if cycle == '00':
-                        current_date = datetime.strptime(date, '%Y%m%d') 
-                        current_date -= timedelta(days=1) # Go back one day 
-                        date_one_day_back = current_date.strftime('%Y%m%d')
-                        previous_cycle = '18'
-
-                        # Define the filename and the location of the GRIB2 file
-                        key = f'gfs.{date_one_day_back}/{previous_cycle}/atmos/gfs.t{previous_cycle}z.sfluxgrbf{hour:03d}.grib2'
-                        url = f"s3://noaa-gfs-bdp-pds/{key}"
-                        time = datetime.strptime(date_one_day_back, '%Y%m%d') + timedelta(hours=int(previous_cycle)) + timedelta(hours=hour) 
-                        print(time)
-                else:
-                        
-                        
-                        previous_cycle = cycles_2d[cycles_2d.index(cycle) - 1] 
-                         
-                        # Define the filename and the location of the GRIB2 file
-                        key = f'gfs.{date}/{previous_cycle}/atmos/gfs.t{previous_cycle}z.sfluxgrbf{(hour):03d}.grib2'
-                        url = f"s3://noaa-gfs-bdp-pds/{key}"
-                        print(url)
-                        #time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(previous_cycle)) + timedelta(hours=hour) 
-                        time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(previous_cycle)) + timedelta(hours=hour)
-                        print(time)
-            else: 
-                
-                # Define the filename and the location of the GRIB2 file
-                key = f'gfs.{date}/{cycle}/atmos/gfs.t{cycle}z.sfluxgrbf{(hour-6):03d}.grib2'
-                url = f"s3://noaa-gfs-bdp-pds/{key}"
-                print(url)
-                time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(cycle))+ timedelta(hours=hour-6) 
-                print(time)
-                
-
-            # Fetch the GRIB2 data from S3
-            s3 = s3fs.S3FileSystem(anon=True)
-            with s3.open(url, 'rb') as f:
-                 grib_data = f.read()
-
-
-            # Define the variable names of interest
-            variable_names = ['Surface pressure', '10 metre U wind component', '10 metre V wind component']
-
-
-            # Initialize empty arrays to store data
-            data_arrays = {var_name: [] for var_name in variable_names}
-
-
-            # Save the GRIB2 data to a temporary file
-            with tempfile.NamedTemporaryFile(suffix=".grib2") as tmp_file:
-                 tmp_file.write(grib_data)
-                 tmp_file.seek(0)  # Reset file pointer to the beginning
-                 # Read the GRIB2 data using pygrib from the temporary file
-                 grbs = pygrib.open(tmp_file.name)
-
-
-                 # Iterate over each message in the GRIB2 file
-                 for grb in grbs:
-                     # Check if the message corresponds to one of the variables of interest
-                 
-                     if grb['name'] in variable_names:
-                        # Append data to the corresponding array
-                        data_arrays[grb['name']].append(grb.values)
-
-                 # Close the GRIB2 file
-                 grbs.close()
-
-            # Convert data arrays to xarray DataArrays
-            pressdata_arraysure_data = xr.DataArray(np.array(data_arrays['Surface pressure']), name='surface_pressure')
-            u_wind_data = xr.DataArray(np.array(data_arrays['10 metre U wind component']), name='u_wind')
-            v_wind_data = xr.DataArray(np.array(data_arrays['10 metre V wind component']), name='v_wind')
-
-
-            # Create an xarray Dataset
-            ds = xr.Dataset(
-            data_vars={
-            'surface_pressure': pressdata_arraysure_data,
-            'u_wind': u_wind_data,
-            'v_wind': v_wind_data},
-             coords={
-            'latitude': grb.latitudes,  # Assuming latitudes are the same for all messages
-            'longitude': grb.longitudes,},
-             attrs={
-            'description': 'GRIB Data Example'})
-
-
-            # Rename the dimensions 'dim_0', 'dim_1', 'dim_2' to 'time', 'y', 'x'
-            ds = ds.rename({'dim_0': 'time', 'dim_1': 'y', 'dim_2': 'x'})
-    
-            # Initialize empty DataFrames to store wind and pressure data for this hour
-            u_wind_df = pd.DataFrame()
-            v_wind_df = pd.DataFrame()
-            surface_pressure_df = pd.DataFrame()
-    
-            # Extract values for  stations
-            if not all_times:
-                    lat_indices, lon_indices = find_index_closest_data(ds, stations)  
-                    
-             
-            for nos_id in  stations['nos_id']:
-                    
-                    # Extract the forcing data using the index
-                    u_wind_value = ds.u_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    v_wind_value = ds.v_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    surface_pressure_value = ds.surface_pressure[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-
-
-                    # Append the values to the respective DataFrames as columns with NOS ids as column names
-                    u_wind_df[int(nos_id)] = [np.round(u_wind_value, 2)]
-                    v_wind_df[int(nos_id)]= [np.round(v_wind_value, 2)]
-                    surface_pressure_df[int(nos_id)] = [np.round(surface_pressure_value, 2)]
-
-
-            u_wind_dfs = pd.concat([u_wind_dfs, u_wind_df], ignore_index=True)
-            
-            v_wind_dfs = pd.concat([v_wind_dfs, v_wind_df], ignore_index=True)
-            surface_pressure_dfs = pd.concat([surface_pressure_dfs, surface_pressure_df], ignore_index=True)
-            
-            # Store the time information 
-            all_times.append(time) 
-
-    # Loop over different files for different hours
-    for hour in range(120, 184, 3):  
-            print(hour)
-            
-            # Define the filename and the location of the GRIB2 file for the current hour
-
-            key_current = f'gfs.{date}/{cycle}/atmos/gfs.t{cycle}z.sfluxgrbf{(hour-6):03d}.grib2'
-            url_current = f"s3://noaa-gfs-bdp-pds/{key_current}"
-             
-            print(url_current)
-            # Fetch the GRIB2 data from S3 for the current hour
-            s3_current = s3fs.S3FileSystem(anon=True)
-            with s3_current.open(url_current, 'rb') as f_current:
-                 grib_data_current = f_current.read()
-
-            # Define the variable names of interest
-            variable_names = ['Surface pressure', '10 metre U wind component', '10 metre V wind component']
-
-            # Initialize empty arrays to store current data
-            data_arrays_current = {var_name: [] for var_name in variable_names}
- 
-            # Save the current GRIB2 data to a temporary file
-            with tempfile.NamedTemporaryFile(suffix=".grib2") as tmp_file:
-                 tmp_file.write(grib_data_current)
-                 tmp_file.seek(0)  # Reset file pointer to the beginning
-                 # Read the GRIB2 data using pygrib from the temporary file
-                 grbs = pygrib.open(tmp_file.name)
-
-                 # Iterate over each message in the GRIB2 file
-                 for grb in grbs:
-                     # Check if the message corresponds to one of the variables of interest
-                     if grb['name'] in variable_names:
-                        # Append data to the corresponding array
-                        data_arrays_current[grb['name']].append(grb.values)
-
-                 # Close the GRIB2 file
-                 grbs.close()
-
-    
-            # Convert data arrays to xarray DataArrays for current data
-            pressure_data_current = xr.DataArray(np.array(data_arrays_current['Surface pressure']), name='surface_pressure')
-            u_wind_data_current = xr.DataArray(np.array(data_arrays_current['10 metre U wind component']), name='u_wind')
-            v_wind_data_current = xr.DataArray(np.array(data_arrays_current['10 metre V wind component']), name='v_wind')
-
-            # Create an xarray Dataset for current data
-            ds_current = xr.Dataset(
-            data_vars={
-               'surface_pressure': pressure_data_current,
-               'u_wind': u_wind_data_current,
-               'v_wind': v_wind_data_current,},
-            coords={
-            'latitude': grb.latitudes,  # Assuming latitudes are the same for all messages
-            'longitude': grb.longitudes,},  # Assuming longitudes are the same for all messages 
-            attrs={ 'description': 'GRIB Data Example', }, )
-
-            # Rename the dimensions 'dim_0', 'dim_1', 'dim_2' to 'time', 'y', 'x'
-            ds_current = ds_current.rename({'dim_0': 'time', 'dim_1': 'y', 'dim_2': 'x'})
-    
-            # Define the filename and the location of the GRIB2 file for the next hour
-            hour_next = hour + 3  # Assuming data is available 3-hourly
-            key_next = f'gfs.{date}/{cycle}/atmos/gfs.t{cycle}z.sfluxgrbf{(hour_next-6):03d}.grib2'
-            url_next = f"s3://noaa-gfs-bdp-pds/{key_next}"
-  
-            # Fetch the GRIB2 data from S3 for the next hour
-            s3_next = s3fs.S3FileSystem(anon=True)
-            with s3_next.open(url_next, 'rb') as f_next:
-                grib_data_next = f_next.read()
-
-            # Initialize empty arrays to store current data
-            data_arrays_next = {var_name: [] for var_name in variable_names}
-
-            # Save the current GRIB2 data to a temporary file
-            with tempfile.NamedTemporaryFile(suffix=".grib2") as tmp_file:
-                 tmp_file.write(grib_data_next)
-                 tmp_file.seek(0)  # Reset file pointer to the beginning
-                 # Read the GRIB2 data using pygrib from the temporary file
-                 grbs = pygrib.open(tmp_file.name)
-
-                 # Iterate over each message in the GRIB2 file
-                 for grb in grbs:
-                     # Check if the message corresponds to one of the variables of interest
-                     if grb['name'] in variable_names:
-                        # Append data to the corresponding array
-                        data_arrays_next[grb['name']].append(grb.values)
-
-                 # Close the GRIB2 file
-                 grbs.close()
-
-
-            # Convert data arrays to xarray DataArrays for next file data
-            pressure_data_next = xr.DataArray(np.array(data_arrays_next['Surface pressure']), name='surface_pressure')
-            u_wind_data_next = xr.DataArray(np.array(data_arrays_next['10 metre U wind component']), name='u_wind')
-            v_wind_data_next = xr.DataArray(np.array(data_arrays_next['10 metre V wind component']), name='v_wind')
-
-            # Create an xarray Dataset for next file data
-            ds_next = xr.Dataset(
-            data_vars={
-            'surface_pressure': pressure_data_next,
-            'u_wind': u_wind_data_next,
-            'v_wind': v_wind_data_next,    },
-            coords={
-            'latitude': grb.latitudes,  # Assuming latitudes are the same for all messages
-            'longitude': grb.longitudes,  # Assuming longitudes are the same for all messages
-            },
-            attrs={
-            'description': 'GRIB Data Example',    },
-            )
-
-            # Rename the dimensions 'dim_0', 'dim_1', 'dim_2' to 'time', 'y', 'x'
-            ds_next = ds_next.rename({'dim_0': 'time', 'dim_1': 'y', 'dim_2': 'x'})
-
-            # Initialize empty DataFrames to store wind and pressure data for this hour
-            for hour_1 in range(1, 4, 1): 
-         
-                u_wind_df = pd.DataFrame()
-                v_wind_df = pd.DataFrame()
-                surface_pressure_df = pd.DataFrame()
-    
-                # Loop over the elements of station_ds['y'] and station_ds['x']
-                for nos_id in stations['nos_id']:
-
-                    # Extract the current forcing data using the index 
-                    u_wind_value_0 = ds_current.u_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    v_wind_value_0 = ds_current.v_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    surface_pressure_value_0 = ds_current.surface_pressure[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-
-                    # Extract the next forcing data using the index 
-                    u_wind_value_3 = ds_next.u_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    v_wind_value_3 = ds_next.v_wind[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-                    surface_pressure_value_3 = ds_next.surface_pressure[0, lat_indices[nos_id][0][0], lon_indices[nos_id][0][0]].values
-             
-                    # Calculate interpolation coefficient
-                    u_wind_coeff = (u_wind_value_3 - u_wind_value_0) / 3
-                    v_wind_coeff = (v_wind_value_3 - v_wind_value_0) / 3 
-                    surface_pressure_coeff = (surface_pressure_value_3 - surface_pressure_value_0) / 3 
-                           
-                    # Append the values to the respective DataFrames as columns with NOS ids as column names
-                    u_wind_df[int(nos_id)] = [np.round(u_wind_value_0, 2)] + hour_1*u_wind_coeff
-                    v_wind_df[int(nos_id)]= [np.round(v_wind_value_0, 2)] + hour_1*v_wind_coeff
-                    surface_pressure_df[int(nos_id)] = [np.round(surface_pressure_value_0, 2)] + hour_1*surface_pressure_coeff
-
-                u_wind_dfs = pd.concat([u_wind_dfs, u_wind_df], ignore_index=True)
-                v_wind_dfs = pd.concat([v_wind_dfs, v_wind_df], ignore_index=True)
-                surface_pressure_dfs = pd.concat([surface_pressure_dfs, surface_pressure_df], ignore_index=True)
-                time = datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(previous_cycle)) + timedelta(hours=hour)+timedelta(hours=hour_1)
-                all_times.append(time) 
-
-
-    
-
-    return u_wind_dfs, v_wind_dfs, surface_pressure_dfs, all_times
 
+def iter_gfs_Forecast_data(date, cycle, stations, s3=None, byte_ranges=True, grib_backend=None, prefetch=2,
+                           freq='1h', interpolation='nearest', point_store=None):
+    """
+    Function to stream the GFS data for date and cycle used as the STOFS forcing data, one output time at a time,
+    as soon as the files it depends on are decoded (e.g. for live dashboards).
 
+    Parameters:
+    - date (str): The date in 'YYYYMMDD' format.
+    - cycle (str): cycle (e.g., ['00', '06', '12', '18']).
+    - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id).
+    - s3: Optional S3 filesystem (defaults to the shared package session).
+    - byte_ranges (bool): Only fetch the pressure and 10 m wind messages, located with the .idx inventories.
+    - grib_backend (str): GRIB decoder, 'pygrib', 'eccodes' or 'cfgrib' (default: the configured backend).
+    - prefetch (int): Number of files downloaded and decoded ahead in background threads (0 reads them one by
+      one); memory is bounded by this window, not by the length of the forecast.
+    - freq (str): Output time step (e.g. '1h', or '6min' to match the STOFS station output).
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'.
+    - point_store (str): Optional directory of a Parquet store of the extracted station values, consulted before S3.
+
+    Yields:
+    - dict: 'time' (pd.Timestamp), 'station' (NOS ids), then 'u_wind', 'v_wind' and 'surface_pressure' (one
+      value per station), with the same values as the rows of fetch_gfs_Forecast_dataset.
+    """
+    files, times = _forecast_files(date, cycle)
+    output_times = pd.date_range(times[0], times[-1], freq=freq)
+    station_ids = np.array([int(nos_id) for nos_id in stations['nos_id']])
+
+    results = (values for values, _ in _iter_station_forcing(files, stations, s3, byte_ranges, grib_backend,
+                                                             interpolation, point_store, prefetch))
+    for start, end, block in _resampled_blocks(zip(times, results), output_times):
+        for row in range(end - start):
+            record = {'time': output_times[start + row], 'station': station_ids}
+            record.update({name: block[name][row] for name in GFS_FORCING_VARIABLES})
+            yield record
\ No newline at end of file
@@ -0,0 +1,275 @@
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pygrib
+try:
+    from ._CACHE import memoized_artifact
+except ImportError:
+    from _CACHE import memoized_artifact
+
+
+# GRIB keys (shortName, typeOfLevel, level) of the GFS fields used as STOFS forcing
+GFS_FORCING_FIELDS = {
+    'surface_pressure': ('sp', 'surface', 0),
+    'u_wind': ('10u', 'heightAboveGround', 10),
+    'v_wind': ('10v', 'heightAboveGround', 10),
+}
+
+GRIB_BACKENDS = ('pygrib', 'eccodes', 'cfgrib')
+
+# Backend used when a reader does not ask for one
+_grib_options = {'backend': 'pygrib'}
+
+# Grid geometries already built in this process, by grid definition
+_geometries = {}
+
+
+def configure_grib_backend(backend='pygrib'):
+    """
+    Function to set the GRIB decoder used by default by the GFS readers.
+
+    Parameters:
+    - backend (str): 'pygrib' or 'eccodes' (in-memory decoding) or 'cfgrib' (needs the optional cfgrib package)
+    """
+    if backend not in GRIB_BACKENDS:
+        raise ValueError(f'Unknown GRIB backend {backend!r}, expected one of {GRIB_BACKENDS}')
+    _grib_options['backend'] = backend
+
+
+def configured_grib_backend():
+    """
+    Function to get the GRIB decoder used by default by the GFS readers.
+
+    Returns:
+    - str: Name of the backend
+    """
+    return _grib_options['backend']
+
+
+def split_grib_messages(data):
+    """
+    Function to split a GRIB stream (e.g. a downloaded file or a set of byte ranges) into its messages.
+
+    Parameters:
+    - data (bytes): GRIB1 or GRIB2 messages, one after the other
+
+    Returns:
+    - list of bytes: One item per message
+    """
+    messages = []
+    offset = data.find(b'GRIB')
+    while offset != -1:
+        edition = data[offset + 7]
+        # The total length is in section 0: 8 bytes for GRIB2, 3 bytes for GRIB1
+        if edition == 2:
+            length = int.from_bytes(data[offset + 8:offset + 16], 'big')
+        else:
+            length = int.from_bytes(data[offset + 4:offset + 7], 'big')
+        messages.append(data[offset:offset + length])
+        offset = data.find(b'GRIB', offset + length)
+    return messages
+
+
+def decode_grib(data, fields=GFS_FORCING_FIELDS, backend=None):
+    """
+    Function to decode some fields of a GRIB stream held in memory, selected by their GRIB keys.
+
+    Parameters:
+    - data (bytes): GRIB messages
+    - fields (dict): Name given to each field -> (shortName, typeOfLevel, level) of its message
+    - backend (str): 'pygrib', 'eccodes' or 'cfgrib' (default: the configured backend)
+
+    Returns:
+    - dict: Name -> 2-D numpy array (y, x) of the field (the first matching message is used)
+    """
+    backend = backend or _grib_options['backend']
+    if backend == 'pygrib':
+        arrays = _decode_pygrib(data, fields)
+    elif backend == 'eccodes':
+        arrays = _decode_eccodes(data, fields)
+    elif backend == 'cfgrib':
+        arrays = _decode_cfgrib(data, fields)
+    else:
+        raise ValueError(f'Unknown GRIB backend {backend!r}, expected one of {GRIB_BACKENDS}')
+
+    missing = [name for name in fields if name not in arrays]
+    if missing:
+        raise KeyError(f'GRIB data without the messages of {missing}')
+    return arrays
+
+
+def grib_grid_geometry(data):
+    """
+    Function to get the geometry of the grid of a GRIB stream. It is built once per grid definition and kept in
+    memory and, when the local cache is enabled, on disk.
+
+    Parameters:
+    - data (bytes): GRIB messages on a regular latitude/longitude or Gaussian grid
+
+    Returns:
+    - dict: 'grid_id' (hash of the grid definition section), 'grid_type', 'latitudes' (one per row of the
+      decoded fields) and 'longitudes' (one per column of the decoded fields)
+    """
+    grb = pygrib.fromstring(split_grib_messages(data)[0])
+    grid_id = grb['md5GridSection']
+
+    def load(path):
+        with np.load(path) as stored:
+            return {'grid_id': grid_id, 'grid_type': str(stored['grid_type']),
+                    'latitudes': stored['latitudes'], 'longitudes': stored['longitudes']}
+
+    def save(geometry, tmp_file):
+        np.savez(tmp_file, grid_type=geometry['grid_type'], latitudes=geometry['latitudes'],
+                 longitudes=geometry['longitudes'])
+
+    return memoized_artifact(_geometries, grid_id, 'grids', f'{grid_id}.npz',
+                             lambda: _rectilinear_geometry(grb, grid_id), load, save)
+
+
+def nearest_grid_points(geometry, latitudes, longitudes):
+    """
+    Function to find the grid points closest to a set of locations (on the sphere), all at once. Locations outside
+    a regional grid take a point of its edge.
+
+    Parameters:
+    - geometry (dict): Grid geometry from grib_grid_geometry
+    - latitudes (array-like): Latitudes of the locations
+    - longitudes (array-like): Longitudes of the locations, in [-180, 180) or [0, 360)
+
+    Returns:
+    - numpy.ndarray: Row (y) index of each location in the decoded fields
+    - numpy.ndarray: Column (x) index of each location in the decoded fields
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+
+    # Rows: the two grid rows around each location and the next ones, as meridians converge the closest point of
+    # a column can be in the row beyond the closest latitude
+    grid_latitudes = geometry['latitudes']
+    order = np.argsort(grid_latitudes, kind='stable')
+    axis = grid_latitudes[order]
+    position = np.searchsorted(axis, latitudes)
+    rows = order[np.clip(position[:, np.newaxis] + np.arange(-2, 2), 0, len(axis) - 1)]
+
+    # Columns: the two grid columns around each location on a circle, the first and last columns are neighbours
+    # across the dateline
+    grid_longitudes = np.mod(geometry['longitudes'], 360)
+    order = np.argsort(grid_longitudes, kind='stable')
+    axis = grid_longitudes[order]
+    position = np.searchsorted(axis, np.mod(longitudes, 360))
+    columns = order[np.stack([(position - 1) % len(axis), position % len(axis)], axis=1)]
+
+    # The closest of these grid points on the sphere
+    y = np.repeat(rows, 2, axis=1)
+    x = np.tile(columns, (1, 4))
+    distance = _haversine(latitudes[:, np.newaxis], longitudes[:, np.newaxis],
+                          grid_latitudes[y], geometry['longitudes'][x])
+    closest = np.argmin(distance, axis=1)[:, np.newaxis]
+    return np.take_along_axis(y, closest, axis=1)[:, 0], np.take_along_axis(x, closest, axis=1)[:, 0]
+
+
+def _haversine(latitudes_0, longitudes_0, latitudes_1, longitudes_1):
+    # Haversine of the angle between two points (increases with their great-circle distance)
+    latitudes_0, longitudes_0 = np.radians(latitudes_0), np.radians(longitudes_0)
+    latitudes_1, longitudes_1 = np.radians(latitudes_1), np.radians(longitudes_1)
+    return np.sin((latitudes_1 - latitudes_0) / 2) ** 2 + \
+        np.cos(latitudes_0) * np.cos(latitudes_1) * np.sin((longitudes_1 - longitudes_0) / 2) ** 2
+
+
+def benchmark_grib_backends(data, fields=GFS_FORCING_FIELDS, backends=GRIB_BACKENDS, repeat=3):
+    """
+    Function to time the decoding of the same GRIB data with each backend available on this host.
+
+    Parameters:
+    - data (bytes): GRIB messages (e.g. from _GFS.fetch_gfs_grib_messages)
+    - fields (dict): Name given to each field -> (shortName, typeOfLevel, level) of its message
+    - backends (list of str): Backends to compare
+    - repeat (int): Number of timed decodes per backend
+
+    Returns:
+    - pd.DataFrame: best and mean decode time (seconds) per backend, fastest first, with the error
+      of the backends that could not run (e.g. not installed)
+    """
+    rows = []
+    for backend in backends:
+        timings = []
+        error = None
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                decode_grib(data, fields=fields, backend=backend)
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            error = str(e)
+        rows.append({'backend': backend,
+                     'best': min(timings) if timings and error is None else np.nan,
+                     'mean': np.mean(timings) if timings and error is None else np.nan,
+                     'error': error})
+    return pd.DataFrame(rows).set_index('backend').sort_values('best')
+
+
+def _rectilinear_geometry(grb, grid_id):
+    if grb['gridType'] not in ('regular_ll', 'regular_gg'):
+        raise ValueError(f"Unsupported GRIB grid type {grb['gridType']!r}, expected a regular or Gaussian grid")
+    # Rows and columns in the order of the decoded values (which follows the scanning mode)
+    latitudes, longitudes = grb.latlons()
+    return {'grid_id': grid_id, 'grid_type': grb['gridType'],
+            'latitudes': np.ascontiguousarray(latitudes[:, 0]), 'longitudes': np.ascontiguousarray(longitudes[0, :])}
+
+
+def _decode_pygrib(data, fields):
+    wanted = {keys: name for name, keys in fields.items()}
+    arrays = {}
+    for message in split_grib_messages(data):
+        # Only the header is parsed here, values are decoded for the selected messages
+        grb = pygrib.fromstring(message)
+        name = wanted.get((grb['shortName'], grb['typeOfLevel'], grb['level']))
+        if name is not None and name not in arrays:
+            arrays[name] = grb.values
+    return arrays
+
+
+def _decode_eccodes(data, fields):
+    import eccodes
+
+    wanted = {keys: name for name, keys in fields.items()}
+    arrays = {}
+    for message in split_grib_messages(data):
+        handle = eccodes.codes_new_from_message(message)
+        try:
+            keys = tuple(eccodes.codes_get(handle, key) for key in ('shortName', 'typeOfLevel', 'level'))
+            name = wanted.get(keys)
+            if name is None or name in arrays:
+                continue
+            values = eccodes.codes_get_values(handle).reshape(eccodes.codes_get(handle, 'Nj'),
+                                                              eccodes.codes_get(handle, 'Ni'))
+            if eccodes.codes_get(handle, 'bitmapPresent'):
+                values = np.ma.masked_values(values, eccodes.codes_get(handle, 'missingValue'))
+            arrays[name] = values
+        finally:
+            eccodes.codes_release(handle)
+    return arrays
+
+
+def _decode_cfgrib(data, fields):
+    import cfgrib  # noqa: F401, optional dependency of the cfgrib backend
+
+    # cfgrib only reads files, the data goes through a temporary file
+    fd, path = tempfile.mkstemp(suffix='.grib2')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        arrays = {}
+        for name, (short_name, type_of_level, level) in fields.items():
+            filter_by_keys = {'shortName': short_name, 'typeOfLevel': type_of_level, 'level': level}
+            with xr.open_dataset(path, engine='cfgrib',
+                                 backend_kwargs={'filter_by_keys': filter_by_keys, 'indexpath': ''}) as ds:
+                if ds.data_vars:
+                    # cfgrib decodes in single precision, the other backends in double precision
+                    arrays[name] = next(iter(ds.data_vars.values())).values.astype(np.float64)
+        return arrays
+    finally:
+        os.remove(path)
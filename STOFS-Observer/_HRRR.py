@@ -1,135 +1,273 @@
+import io
+import logging
+import warnings
 import pandas as pd
 import numpy as np
 import xarray as xr
 from datetime import datetime, timedelta
 from typing import List
-import s3fs  # Importing the s3fs library for accessing S3 buckets
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from ._S3 import get_s3_filesystem, read_object_async
+except ImportError:
+    from _S3 import get_s3_filesystem, read_object_async
+try:
+    from ._CACHE import cache_enabled, open_cached
+except ImportError:
+    from _CACHE import cache_enabled, open_cached
+try:
+    from ._INTERP import dataset_grid_geometry, interpolation_weights, nearest_points
+except ImportError:
+    from _INTERP import dataset_grid_geometry, interpolation_weights, nearest_points
+try:
+    from ._CHUNKS import read_chunk_points, chunk_references, chunk_layout
+except ImportError:
+    from _CHUNKS import read_chunk_points, chunk_references, chunk_layout
 
+logger = logging.getLogger(__name__)
 
 
-def read_STOFS_from_s3(bucket_name, key):
+# Forcing variables of the STOFS-3D-Atl HRRR files
+HRRR_FORCING_VARIABLES = ['uwind', 'vwind', 'prmsl']
+
+
+def read_STOFS_from_s3(bucket_name, key, s3=None):
     """
     Function to read a STOFS nc files from an S3 bucket.
     
     Parameters:
     - bucket_name: Name of the S3 bucket
     - key: Key/path to the NetCDF file in the bucket
+    - s3: Optional S3 filesystem (defaults to the shared package session)
     
     Returns:
     - ds: xarray Dataset containing the NetCDF data
     """
-    s3 = s3fs.S3FileSystem(anon=True)
+    s3 = get_s3_filesystem(s3)
     url = f"s3://{bucket_name}/{key}"
-    ds = xr.open_dataset(s3.open(url, 'rb'), drop_variables=['nvel'])
+    if cache_enabled():
+        ds = open_cached(s3, url, lambda path: xr.open_dataset(path, drop_variables=['nvel']))
+    else:
+        ds = xr.open_dataset(s3.open(url, 'rb'), drop_variables=['nvel'])
     return ds
 
 
-
-def fetch_saved_HRRR_Nowcast_data(filename, modelname, directoryname, directoryname2, bucketname, daterange, stations, steps):
-    
-    date = daterange[0]
-    base_key = f'{modelname}.{date}'
-    dataname = f'{filename}.nc'
-    if directoryname:
-        if directoryname2:
-          key = f'{directoryname}/{base_key}/{directoryname2}/{modelname}.{dataname}'
-        else: 
-          key = f'{directoryname}/{base_key}/{modelname}.{dataname}'
-    else:
-        if directoryname2:
-          key = f'{base_key}/{directoryname2}/{modelname}.{dataname}'
-        else:
-          key = f'{base_key}/{modelname}.{dataname}'
-    try:
-        print(key)
-        dataset = read_STOFS_from_s3(bucketname, key)
-    except Exception as e:
-        print(f"Error fetching data from {bucketname}: {e}")
-        
-    def find_index_closest_data(ds, stations):
-        lat_indices = {}
-        lon_indices = {}
+async def read_STOFS_from_s3_async(bucket_name, key, s3=None, semaphore=None):
+    """
+    Function to read a STOFS nc files from an S3 bucket on the running event loop.
     
-        for y_val, x_val, nos_id in zip(stations['lat'], stations['lon'], stations['nos_id']): 
-        
-            # Get the nearest indices for latitude and longitude
-            lat_idx = np.where((np.abs(ds['lat'][0:1059][0] - float(y_val))) == np.min(np.abs(ds['lat'][0:1059][0] - float(y_val))))
-            lon_idx = np.where((np.abs(ds['lon'][0][0:934] - x_val)) == np.min(np.abs(ds['lon'][0][0:934] - x_val)))
-       
-            # Store indices in dictionaries 
-            lat_indices[nos_id] = lat_idx
-            lon_indices[nos_id] = lon_idx
-        return lat_indices, lon_indices
-    lat_indices, lon_indices = find_index_closest_data(dataset, stations)
+    Parameters:
+    - bucket_name: Name of the S3 bucket
+    - key: Key/path to the NetCDF file in the bucket
+    - s3: Optional asynchronous S3 filesystem (defaults to the session of the running loop)
+    - semaphore (asyncio.Semaphore): Optional semaphore limiting the number of reads in flight
     
+    Returns:
+    - ds: xarray Dataset containing the NetCDF data
+    """
+    data = await read_object_async(f"s3://{bucket_name}/{key}", s3=s3, semaphore=semaphore)
+    ds = xr.open_dataset(io.BytesIO(data), drop_variables=['nvel'])
+    return ds
+
+
+def read_HRRR_points(bucket_name, key, y, x, steps, s3=None, variables=HRRR_FORCING_VARIABLES):
+    """
+    Function to read the forcing of a STOFS-3D-Atl HRRR file at a set of grid points. The points are grouped by the
+    HDF5 chunk they fall in, and each chunk is fetched once for all the points and variables (and kept in the local
+    cache when it is enabled).
+
+    Parameters:
+    - bucket_name: Name of the S3 bucket
+    - key: Key/path to the NetCDF file in the bucket
+    - y (array-like): Row index of each grid point
+    - x (array-like): Column index of each grid point
+    - steps (int): Number of time steps to read
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - variables (list of str): Forcing variables on (time, y, x)
+
+    Returns:
+    - ds: xarray Dataset of the variables on (time, point)
+    """
+    url = f"s3://{bucket_name}/{key}"
+    time_dim, y_dim, x_dim = chunk_layout(chunk_references(url, s3=s3), variables[0])['dims']
+    return read_chunk_points(url, variables, {time_dim: slice(0, steps), y_dim: np.asarray(y), x_dim: np.asarray(x)},
+                             s3=s3)
+
+
+
+def HRRR_key(filename, modelname, directoryname, directoryname2, date):
+    """
+    Function to get the key of the HRRR forcing file of a STOFS-3D-Atl date.
+
+    Parameters:
+    - filename: The base filename of the forcing (e.g. 't12z.hrrr.prc')
+    - modelname: The STOFS model name (e.g. 'stofs_3d_atl')
+    - directoryname: Optional directory name in the S3 bucket
+    - directoryname2: Optional sub-directory of the date (e.g. 'rerun')
+    - date: date in 'YYYYMMDD' format
+
+    Returns:
+    - key: Key/path to the NetCDF file in the bucket
+    """
+    parts = [directoryname, f'{modelname}.{date}', directoryname2, f'{modelname}.{filename}.nc']
+    return '/'.join(part for part in parts if part)
+
+
+def _read_HRRR_stations(bucketname, key, y, x, steps, weights, s3):
+    # Times and (time, station) values of one file, at the nearest grid points or with the interpolation weights
+    logger.debug('Reading %s', key)
+    nowcast = read_HRRR_points(bucketname, key, y, x, steps, s3=s3)
+    if weights is None:
+        values = {variable: nowcast[variable].values for variable in HRRR_FORCING_VARIABLES}
+    else:
+        values = {variable: (weights @ nowcast[variable].values.T).T for variable in HRRR_FORCING_VARIABLES}
+    return nowcast.indexes['time'], values
+
+
+def fetch_saved_HRRR_Nowcast_dataset(filename, modelname, directoryname, directoryname2, bucketname, daterange,
+                                     stations, steps, s3=None, interpolation='nearest', max_workers=8,
+                                     return_failures=False):
+    """
+    Function to fetch the HRRR forcing of STOFS-3D-Atl at the stations for a date range. The files of all the dates
+    are read concurrently and each one fills its time steps of preallocated (time, station) arrays.
+
+    Parameters:
+    - filename: The base filename of the forcing (e.g. 't12z.hrrr.prc')
+    - modelname: The STOFS model name (e.g. 'stofs_3d_atl')
+    - directoryname: Optional directory name in the S3 bucket
+    - directoryname2: Optional sub-directory of the date (e.g. 'rerun')
+    - bucketname: The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id)
+    - steps (int): Number of time steps to read from each file
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'
+    - max_workers (int): Maximum number of files read concurrently
+    - return_failures (bool): Also return the files that could not be read instead of warning about them
+
+    Returns:
+    - ds: xarray Dataset of uwind, vwind and prmsl on (time, station), with the NOS ids as station labels
+    - list of dict: Files that could not be read, with their 'key' and 'error' (only if return_failures is True)
+
+    Raises:
+    - FileNotFoundError: If no file of the date range could be read
+    """
+    s3 = get_s3_filesystem(s3)
+
+    # The forcing of a date is in the file of the day before, from the day before the start to the end date
     start_date = datetime.strptime(daterange[0], '%Y%m%d')
     end_date = datetime.strptime(daterange[1], '%Y%m%d') + timedelta(days=1)
-    
-    dates = []
+    keys = []
     current_date = start_date
     while current_date <= end_date:
-        dates.append(current_date.strftime('%Y%m%d'))
+        previous_date = current_date - timedelta(days=1)
+        keys.append(HRRR_key(filename, modelname, directoryname, directoryname2, previous_date.strftime('%Y%m%d')))
         current_date += timedelta(days=1)
-    
-    # Initialize a list to store data for the DataFrame
-    u_wind_dfs = []
-    v_wind_dfs = []
-    surface_pressure_dfs = []
-    
-    for date in dates:
-        previous_date = datetime.strptime(date, '%Y%m%d') - timedelta(days=1)
-        print(previous_date)
-        base_key = f'{modelname}.{previous_date.strftime("%Y%m%d")}'
-        dataname = f'{modelname}.{filename}.nc'
-        if directoryname:
-            if directoryname2:
-               key = f'{directoryname}/{base_key}/{directoryname2}/{modelname}.{dataname}'
-            else: 
-               key = f'{directoryname}/{base_key}/{modelname}.{dataname}'
-        else:
-            if directoryname2:
-              key = f'{base_key}/{directoryname2}/{modelname}.{dataname}'
-            else:
-              key = f'{base_key}/{modelname}.{dataname}'
-                
-    
+
+    # The grid is read from the first file available, only its lat/lon variables are fetched
+    geometry = None
+    failures = {}
+    for key in keys:
         try:
-            nowcast = read_netcdf_from_s3(bucketname, key)
-
-            # Initialize empty DataFrames to store wind and pressure data for this hour
-            u_wind_df = []
-            v_wind_df = []
-            surface_pressure_df = []
-            
-            for nos_id in  stations['nos_id']:
-                    
-                    # Extract the forcing data using the index
-                    u_wind_values = nowcast.uwind[:steps, lat_indices[int(nos_id)][0][0], lon_indices[int(nos_id)][0][0]]
-                    v_wind_values = nowcast.vwind[:steps, lat_indices[int(nos_id)][0][0], lon_indices[int(nos_id)][0][0]]
-                    surface_pressure_values = nowcast.prmsl[:steps, lat_indices[int(nos_id)][0][0], lon_indices[int(nos_id)][0][0]]
-
-
-                    # Append the values to the respective DataFrames as columns with NOS ids as column names
-                    u_wind_df.append(u_wind_values)
-                    v_wind_df.append(v_wind_values)
-                    surface_pressure_df.append(surface_pressure_values)
-            
-            # Append data for each station to the list
-            u_wind_dfs = xr.concat(u_wind_df, dim='time')
-            v_wind_dfs = xr.concat(v_wind_df, dim='time')
-            surface_pressure_dfs = xr.concat(surface_pressure_df, dim='time')
-
-        
+            grid = read_chunk_points(f"s3://{bucketname}/{key}", ['lat', 'lon'], {}, s3=s3)
         except Exception as e:
-            print(f'Error reading file {key} from S3: {str(e)}')
+            failures[key] = {'key': key, 'error': str(e)}
+            continue
+        # The curvilinear HRRR grid is located with a KD-tree built once per grid (and kept in the local cache)
+        geometry = dataset_grid_geometry(grid)
+        break
+    if geometry is None:
+        raise FileNotFoundError(f'No {modelname} {filename} file could be read between {daterange[0]} and '
+                                f'{daterange[1]}: ' + ', '.join(failures))
 
-    
+    # Grid points read from every file: the nearest ones, or those with a non-zero bilinear or inverse-distance
+    # weight (the weights are computed once and applied to every file)
+    if interpolation != 'nearest':
+        weights = interpolation_weights(geometry, stations['lat'], stations['lon'], method=interpolation)
+        columns = np.unique(weights.indices)
+        weights = weights[:, columns]
+        y, x = np.unravel_index(columns, grid['lat'].shape)
+    else:
+        weights = None
+        y, x = nearest_points(geometry, stations['lat'], stations['lon'])
+
+    def read(key):
+        try:
+            return _read_HRRR_stations(bucketname, key, y, x, steps, weights, s3), None
+        except Exception as e:
+            return None, {'key': key, 'error': str(e)}
 
-    if u_wind_dfs:
-        return u_wind_dfs, v_wind_dfs, surface_pressure_dfs
+    # A file that failed while the grid was looked up is tried again with the others
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            outcomes = list(executor.map(read, keys))
     else:
-        print("No valid data found.")
+        outcomes = [read(key) for key in keys]
+    results = [result for result, failure in outcomes if result is not None]
+    failures = [failure for result, failure in outcomes if failure is not None]
+    if not results:
+        raise FileNotFoundError(f'No {modelname} {filename} file could be read between {daterange[0]} and '
+                                f'{daterange[1]}: ' + ', '.join(failure['key'] for failure in failures))
+    if failures and not return_failures:
+        warnings.warn(f'{len(failures)} HRRR file(s) could not be read from S3: '
+                      + ', '.join(failure['key'] for failure in failures))
+
+    # Preallocate the (time, station) arrays over every time step, each file fills its own rows
+    # (a later file overwrites the time steps it shares with the one before)
+    times = pd.DatetimeIndex(np.unique(np.concatenate([file_times.values for file_times, _ in results])))
+    data = {variable: np.full((len(times), len(stations)), np.nan) for variable in HRRR_FORCING_VARIABLES}
+    for file_times, values in results:
+        rows = times.get_indexer(file_times)
+        for variable in HRRR_FORCING_VARIABLES:
+            data[variable][rows] = values[variable]
+
+    ds = xr.Dataset(
+        data_vars={variable: (('time', 'station'), data[variable]) for variable in HRRR_FORCING_VARIABLES},
+        coords={
+            'time': times,
+            'station': [int(nos_id) for nos_id in stations['nos_id']],
+            'lat': ('station', np.asarray(stations['lat'], dtype=float)),
+            'lon': ('station', np.asarray(stations['lon'], dtype=float))},
+        attrs={'description': 'HRRR forcing at the stations'})
+    if return_failures:
+        return ds, failures
+    return ds
+
+
+def fetch_saved_HRRR_Nowcast_data(filename, modelname, directoryname, directoryname2, bucketname, daterange, stations, steps, s3=None,
+                                  interpolation='nearest', max_workers=1):
+    """
+    Function to fetch the HRRR forcing of STOFS-3D-Atl at the stations for a date range, as series concatenated
+    station after station (see fetch_saved_HRRR_Nowcast_dataset for the same data as a labelled Dataset).
+
+    Parameters:
+    - filename: The base filename of the forcing (e.g. 't12z.hrrr.prc')
+    - modelname: The STOFS model name (e.g. 'stofs_3d_atl')
+    - directoryname: Optional directory name in the S3 bucket
+    - directoryname2: Optional sub-directory of the date (e.g. 'rerun')
+    - bucketname: The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - stations (DataFrame): DataFrame containing station information (lat, lon, nos_id)
+    - steps (int): Number of time steps to read from each file
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - interpolation (str): Spatial interpolation at the stations, 'nearest' grid point, 'bilinear' or 'idw'
+    - max_workers (int): Maximum number of files read concurrently (1 reads them one at a time, as before)
+
+    Returns:
+    - u_wind, v_wind, surface pressure: xarray DataArrays along time, one full series per station in turn
+      (None if no file could be read)
+    """
+    try:
+        ds = fetch_saved_HRRR_Nowcast_dataset(filename, modelname, directoryname, directoryname2, bucketname,
+                                              daterange, stations, steps, s3=s3, interpolation=interpolation,
+                                              max_workers=max_workers)
+    except FileNotFoundError as e:
+        warnings.warn(str(e))
         return None
+    # The series of all the stations laid end to end, in one array per variable
+    times = np.tile(ds['time'].values, ds.sizes['station'])
+    return tuple(xr.DataArray(ds[variable].values.T.reshape(-1), coords={'time': times}, dims='time', name=variable)
+                 for variable in HRRR_FORCING_VARIABLES)
 
 # Example usage:
 # result = retrieve_wind_forecast(date_range, filtered_wind_stations, bucket_name_3d)
@@ -0,0 +1,288 @@
+import pickle
+import numpy as np
+import xarray as xr
+import scipy.sparse
+from scipy.spatial import cKDTree
+try:
+    from ._CACHE import memoized_artifact, coordinates_id
+    from ._GRIB import nearest_grid_points
+except ImportError:
+    from _CACHE import memoized_artifact, coordinates_id
+    from _GRIB import nearest_grid_points
+
+
+INTERPOLATION_METHODS = ('nearest', 'bilinear', 'idw')
+
+# Weight matrices already built in this process, by grid, station set and method
+_weights = {}
+
+# KD-trees of the curvilinear grids already built in this process, by grid
+_trees = {}
+
+
+def dataset_grid_geometry(ds, lat='lat', lon='lon'):
+    """
+    Function to get the geometry of the grid of a gridded netCDF dataset (e.g. the HRRR forcing of STOFS-3D-Atl).
+
+    Parameters:
+    - ds (xarray.Dataset): Dataset with the grid coordinates
+    - lat (str): Name of the latitude variable (1-D or 2-D (y, x))
+    - lon (str): Name of the longitude variable (1-D or 2-D (y, x))
+
+    Returns:
+    - dict: 'grid_id' (hash of the coordinates) and 'grid_type'; 'latitudes' (one per row) and 'longitudes'
+      (one per column) for a rectilinear grid, 2-D 'latitudes' and 'longitudes' for a curvilinear grid
+    """
+    latitudes = np.asarray(ds[lat].values, dtype=float)
+    longitudes = np.asarray(ds[lon].values, dtype=float)
+    grid_id = coordinates_id(latitudes, longitudes)
+
+    if latitudes.ndim == 1:
+        return {'grid_id': grid_id, 'grid_type': 'rectilinear', 'latitudes': latitudes, 'longitudes': longitudes}
+    # 2-D coordinates of a grid that is rectilinear after all are reduced to their axes
+    if np.all(latitudes == latitudes[:, :1]) and np.all(longitudes == longitudes[:1, :]):
+        return {'grid_id': grid_id, 'grid_type': 'rectilinear',
+                'latitudes': latitudes[:, 0].copy(), 'longitudes': longitudes[0, :].copy()}
+    return {'grid_id': grid_id, 'grid_type': 'curvilinear', 'latitudes': latitudes, 'longitudes': longitudes}
+
+
+def curvilinear_tree(geometry):
+    """
+    Function to get a KD-tree of the points of a curvilinear grid, on 3-D unit-sphere coordinates (so distances do
+    not depend on the projection of the grid nor break at the dateline). It is built once per grid and kept in
+    memory and, when the local cache is enabled, on disk.
+
+    Parameters:
+    - geometry (dict): Curvilinear grid geometry (from dataset_grid_geometry)
+
+    Returns:
+    - scipy.spatial.cKDTree: Tree of the flattened (y, x) grid points
+    """
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    return memoized_artifact(
+        _trees, geometry['grid_id'], 'trees', f"{geometry['grid_id']}.pkl",
+        lambda: cKDTree(_unit_vectors(geometry['latitudes'].reshape(-1), geometry['longitudes'].reshape(-1))),
+        load, lambda tree, tmp_file: pickle.dump(tree, tmp_file, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def nearest_points(geometry, latitudes, longitudes):
+    """
+    Function to find the grid points closest to a set of locations, all at once, on a rectilinear or curvilinear
+    grid.
+
+    Parameters:
+    - geometry (dict): Grid geometry (from _GRIB.grib_grid_geometry or dataset_grid_geometry)
+    - latitudes (array-like): Latitudes of the locations
+    - longitudes (array-like): Longitudes of the locations, in [-180, 180) or [0, 360)
+
+    Returns:
+    - numpy.ndarray: Row (y) index of each location
+    - numpy.ndarray: Column (x) index of each location
+    """
+    if geometry['grid_type'] != 'curvilinear':
+        return nearest_grid_points(geometry, latitudes, longitudes)
+    _, nearest = curvilinear_tree(geometry).query(_unit_vectors(np.asarray(latitudes, dtype=float),
+                                                                np.asarray(longitudes, dtype=float)))
+    return np.unravel_index(nearest, geometry['latitudes'].shape)
+
+
+def extract_points(ds, variables, *indexes):
+    """
+    Function to select a set of grid points of several variables at once (one vectorized selection for all the
+    points, variables and leading dimensions such as time). This is the point selection of both the decoded GFS
+    fields and the HDF5 chunks read by _CHUNKS.read_chunk_points.
+
+    Parameters:
+    - ds (xarray.Dataset or dict): Dataset, or variable name -> numpy array, with the grid as the last dimensions
+    - variables (list of str): Names of the variables
+    - indexes (array-like): Index of each point along each grid dimension, e.g. y, x (row and column) for a 2-D grid
+
+    Returns:
+    - xarray.Dataset or dict: The variables with a 'point' dimension in place of the grid, (..., point)
+    """
+    indexes = [np.asarray(index) for index in indexes]
+    if isinstance(ds, xr.Dataset):
+        grid_dims = ds[variables[0]].dims[-len(indexes):]
+        return ds[list(variables)].isel({dim: xr.DataArray(index, dims='point')
+                                         for dim, index in zip(grid_dims, indexes)})
+    return {name: np.asarray(ds[name])[(Ellipsis, *indexes)] for name in variables}
+
+
+def interpolation_weights(geometry, latitudes, longitudes, method='bilinear', power=2):
+    """
+    Function to get the sparse matrix interpolating a gridded field at a set of stations. It is built once per grid,
+    station set and method, and kept in memory and, when the local cache is enabled, on disk.
+
+    Parameters:
+    - geometry (dict): Grid geometry (from _GRIB.grib_grid_geometry or dataset_grid_geometry)
+    - latitudes (array-like): Latitudes of the stations
+    - longitudes (array-like): Longitudes of the stations, in [-180, 180) or [0, 360)
+    - method (str): 'nearest', 'bilinear' or 'idw' (inverse-distance weighting of the 4 surrounding grid points)
+    - power (float): Power of the distance in the 'idw' weights
+
+    Returns:
+    - scipy.sparse.csr_matrix: (n_stations, n_gridpoints) weights, each row sums to 1
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError(f'Unknown interpolation method {method!r}, expected one of {INTERPOLATION_METHODS}')
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    name = f"{geometry['grid_id']}.{coordinates_id(latitudes, longitudes)}.{method}" + \
+        (f'.p{power:g}' if method == 'idw' else '')
+
+    def build():
+        if geometry['grid_type'] == 'curvilinear':
+            rows, columns, values = _curvilinear_weights(geometry, latitudes, longitudes, method, power)
+        else:
+            rows, columns, values = _rectilinear_weights(geometry, latitudes, longitudes, method, power)
+        n_gridpoints = np.size(geometry['latitudes']) if geometry['grid_type'] == 'curvilinear' else \
+            len(geometry['latitudes']) * len(geometry['longitudes'])
+        weights = scipy.sparse.csr_matrix((values, (rows, columns)), shape=(len(latitudes), n_gridpoints))
+        weights.eliminate_zeros()
+        return weights
+
+    return memoized_artifact(_weights, name, 'weights', f'{name}.npz', build,
+                             lambda path: scipy.sparse.load_npz(path).tocsr(),
+                             lambda weights, tmp_file: scipy.sparse.save_npz(tmp_file, weights))
+
+
+def apply_weights(weights, field):
+    """
+    Function to interpolate gridded fields at the stations with a weight matrix.
+
+    Parameters:
+    - weights (scipy.sparse.csr_matrix): (n_stations, n_gridpoints) weights from interpolation_weights
+    - field (numpy.ndarray): Field (y, x), or fields (..., y, x) e.g. (time, y, x)
+
+    Returns:
+    - numpy.ndarray: Values at the stations, (n_stations,) or (..., n_stations)
+    """
+    field = np.asarray(field)
+    if field.ndim == 2:
+        return weights @ field.reshape(-1)
+    flat = field.reshape(-1, field.shape[-2] * field.shape[-1])
+    return (weights @ flat.T).T.reshape(field.shape[:-2] + (weights.shape[0],))
+
+
+def _rectilinear_weights(geometry, latitudes, longitudes, method, power):
+    n_columns = len(geometry['longitudes'])
+    if method == 'nearest':
+        y, x = nearest_grid_points(geometry, latitudes, longitudes)
+        return np.arange(len(latitudes)), y * n_columns + x, np.ones(len(latitudes))
+
+    # Rows around each station, clamped to the first/last row outside the grid
+    grid_latitudes = geometry['latitudes']
+    order = np.argsort(grid_latitudes, kind='stable')
+    axis = grid_latitudes[order]
+    position = np.clip(np.searchsorted(axis, latitudes), 1, len(axis) - 1)
+    t = np.clip((latitudes - axis[position - 1]) / (axis[position] - axis[position - 1]), 0, 1)
+    y0, y1 = order[position - 1], order[position]
+
+    # Columns around each station on a circle of longitudes
+    grid_longitudes = np.mod(geometry['longitudes'], 360)
+    order = np.argsort(grid_longitudes, kind='stable')
+    axis = grid_longitudes[order]
+    longitudes = np.mod(longitudes, 360)
+    position = np.searchsorted(axis, longitudes)
+    before, after = (position - 1) % len(axis), position % len(axis)
+    span = np.mod(axis[after] - axis[before], 360)
+    s = np.divide(np.mod(longitudes - axis[before], 360), span, out=np.zeros_like(span), where=span > 0)
+    # Between the edges of a regional grid the station takes the closest edge column
+    outside = span > 1.5 * np.median(np.diff(axis)) if len(axis) > 1 else np.ones(len(span), dtype=bool)
+    s = np.where(outside, np.where(s < 0.5, 0.0, 1.0), s)
+    x0, x1 = order[before], order[after]
+
+    corners_y = np.stack([y0, y0, y1, y1], axis=1)
+    corners_x = np.stack([x0, x1, x0, x1], axis=1)
+    if method == 'bilinear':
+        values = np.stack([(1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t], axis=1)
+    else:
+        distance = _chord(latitudes[:, np.newaxis], longitudes[:, np.newaxis],
+                          grid_latitudes[corners_y], geometry['longitudes'][corners_x])
+        values = _inverse_distance(distance, power)
+
+    rows = np.repeat(np.arange(len(latitudes)), 4)
+    return rows, (corners_y * n_columns + corners_x).reshape(-1), values.reshape(-1)
+
+
+def _curvilinear_weights(geometry, latitudes, longitudes, method, power):
+    grid_latitudes = geometry['latitudes']
+    grid_longitudes = geometry['longitudes']
+    shape = grid_latitudes.shape
+    tree = curvilinear_tree(geometry)
+    points = _unit_vectors(latitudes, longitudes)
+    stations = np.arange(len(latitudes))
+
+    if method == 'nearest':
+        _, nearest = tree.query(points)
+        return stations, nearest, np.ones(len(latitudes))
+    if method == 'idw':
+        distance, nearest = tree.query(points, k=4)
+        return np.repeat(stations, 4), nearest.reshape(-1), _inverse_distance(distance, power).reshape(-1)
+
+    # Bilinear: among the 4 cells around the nearest grid point, the one whose inverse mapping falls inside
+    _, nearest = tree.query(points)
+    j, i = np.unravel_index(nearest, shape)
+    rows = np.repeat(stations, 4)
+    columns = np.repeat(nearest, 4).reshape(-1, 4)
+    values = np.tile([1.0, 0.0, 0.0, 0.0], (len(stations), 1))
+    found = np.zeros(len(stations), dtype=bool)
+    for dj, di in [(0, 0), (-1, 0), (0, -1), (-1, -1)]:
+        j0 = np.clip(j + dj, 0, shape[0] - 2)
+        i0 = np.clip(i + di, 0, shape[1] - 2)
+        corners = [(j0, i0), (j0, i0 + 1), (j0 + 1, i0), (j0 + 1, i0 + 1)]
+        # Local plane around each station (degrees, longitudes scaled by cos(latitude))
+        x = [np.mod(grid_longitudes[c] - longitudes + 180, 360) - 180 for c in corners]
+        x = [value * np.cos(np.radians(latitudes)) for value in x]
+        y = [grid_latitudes[c] - latitudes for c in corners]
+        s, t = _inverse_bilinear(x, y)
+        inside = ~found & (s >= -1e-9) & (s <= 1 + 1e-9) & (t >= -1e-9) & (t <= 1 + 1e-9)
+        s, t = np.clip(s, 0, 1), np.clip(t, 0, 1)
+        cell = np.stack([np.ravel_multi_index(c, shape) for c in corners], axis=1)
+        weights = np.stack([(1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t], axis=1)
+        columns[inside] = cell[inside]
+        values[inside] = weights[inside]
+        found |= inside
+    # Stations outside the grid keep the weight 1 on their nearest grid point
+    return rows, columns.reshape(-1), values.reshape(-1)
+
+
+def _inverse_bilinear(x, y, iterations=10):
+    # (s, t) cell coordinates of the origin in the cells with corners (x, y) = [p00, p10, p01, p11], by Newton
+    s = np.full(len(x[0]), 0.5)
+    t = np.full(len(x[0]), 0.5)
+    for _ in range(iterations):
+        residual_x = (1 - s) * (1 - t) * x[0] + s * (1 - t) * x[1] + (1 - s) * t * x[2] + s * t * x[3]
+        residual_y = (1 - s) * (1 - t) * y[0] + s * (1 - t) * y[1] + (1 - s) * t * y[2] + s * t * y[3]
+        dx_ds = (1 - t) * (x[1] - x[0]) + t * (x[3] - x[2])
+        dx_dt = (1 - s) * (x[2] - x[0]) + s * (x[3] - x[1])
+        dy_ds = (1 - t) * (y[1] - y[0]) + t * (y[3] - y[2])
+        dy_dt = (1 - s) * (y[2] - y[0]) + s * (y[3] - y[1])
+        determinant = dx_ds * dy_dt - dx_dt * dy_ds
+        determinant = np.where(determinant == 0, np.nan, determinant)
+        s = s - (residual_x * dy_dt - residual_y * dx_dt) / determinant
+        t = t - (residual_y * dx_ds - residual_x * dy_ds) / determinant
+    return s, t
+
+
+def _inverse_distance(distance, power):
+    # Rows of weights 1/d**power, a station on a grid point takes its value
+    with np.errstate(divide='ignore'):
+        weights = 1.0 / distance ** power
+    exact = np.isinf(weights)
+    weights = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), weights)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def _unit_vectors(latitudes, longitudes):
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    return np.stack([np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes),
+                     np.sin(latitudes)], axis=-1)
+
+
+def _chord(latitudes_0, longitudes_0, latitudes_1, longitudes_1):
+    return np.linalg.norm(_unit_vectors(latitudes_0, longitudes_0) - _unit_vectors(latitudes_1, longitudes_1), axis=-1)
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pandas as pd
+try:
+    from ._CACHE import atomic_write, coordinates_id
+except ImportError:
+    from _CACHE import atomic_write, coordinates_id
+
+
+def point_partition(store_dir, partition):
+    """
+    Function to get the directory of a partition of a point store.
+
+    Parameters:
+    - store_dir (str): Directory of the point store
+    - partition (dict): Partition keys in order, e.g. {'cycle': '2024092200', 'hour': '006'}
+
+    Returns:
+    - str: Directory of the partition (hive layout, e.g. cycle=2024092200/hour=006)
+    """
+    return os.path.join(store_dir, *[f'{key}={value}' for key, value in partition.items()])
+
+
+def read_points(store_dir, partition, method, latitudes, longitudes, variables):
+    """
+    Function to look up values already extracted at a set of stations in a partitioned Parquet point store.
+
+    Parameters:
+    - store_dir (str): Directory of the point store
+    - partition (dict): Partition keys, e.g. {'cycle': '2024092200', 'hour': '006'}
+    - method (str): Spatial interpolation the values were extracted with
+    - latitudes (array-like): Latitudes of the stations
+    - longitudes (array-like): Longitudes of the stations
+    - variables (list of str): Names of the variables
+
+    Returns:
+    - dict: Variable name -> station vector (NaN where the station is not stored)
+    - numpy.ndarray: Boolean mask of the stations found in the store
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    values = {name: np.full(len(latitudes), np.nan) for name in variables}
+    found = np.zeros(len(latitudes), dtype=bool)
+
+    path = point_partition(store_dir, partition)
+    files = sorted(name for name in os.listdir(path) if name.startswith(f'{method}.') and name.endswith('.parquet')) \
+        if os.path.isdir(path) else []
+    if not files:
+        return values, found
+
+    # Values only depend on the location of a station, stations are matched on their coordinates
+    stored = pd.concat([pd.read_parquet(os.path.join(path, name)) for name in files], ignore_index=True)
+    stored = stored.drop_duplicates(subset=['lat', 'lon'])
+    index = pd.MultiIndex.from_arrays([stored['lat'], stored['lon']])
+    rows = index.get_indexer(pd.MultiIndex.from_arrays([latitudes, longitudes]))
+    found = rows >= 0
+    for name in variables:
+        values[name][found] = stored[name].to_numpy()[rows[found]]
+    return values, found
+
+
+def write_points(store_dir, partition, method, grid_id, latitudes, longitudes, values):
+    """
+    Function to add values extracted at a set of stations to a partitioned Parquet point store.
+
+    Parameters:
+    - store_dir (str): Directory of the point store
+    - partition (dict): Partition keys, e.g. {'cycle': '2024092200', 'hour': '006'}
+    - method (str): Spatial interpolation the values were extracted with
+    - grid_id (str): Identifier of the grid the values were extracted from
+    - latitudes (array-like): Latitudes of the stations
+    - longitudes (array-like): Longitudes of the stations
+    - values (dict): Variable name -> station vector
+
+    Returns:
+    - str: Path of the Parquet file, named after the method, the grid and the hash of the station set
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    stations_id = coordinates_id(latitudes, longitudes)
+    path = point_partition(store_dir, partition)
+    os.makedirs(path, exist_ok=True)
+    target = os.path.join(path, f'{method}.{grid_id}.{stations_id}.parquet')
+
+    points = pd.DataFrame({'lat': latitudes, 'lon': longitudes,
+                           **{name: np.asarray(vector) for name, vector in values.items()}})
+    # Readers only see complete files
+    return atomic_write(target, lambda tmp_file: points.to_parquet(tmp_file, index=False))
@@ -0,0 +1,167 @@
+import os
+import json
+import fsspec
+import xarray as xr
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from ._S3 import get_s3_filesystem
+    from ._STOFS import station_key, nowcast_dates, RANGE_BLOCK_SIZE
+except ImportError:
+    from _S3 import get_s3_filesystem
+    from _STOFS import station_key, nowcast_dates, RANGE_BLOCK_SIZE
+try:
+    from ._CACHE import atomic_write
+except ImportError:
+    from _CACHE import atomic_write
+
+
+# Variables smaller than this (time, station coordinates and names) are stored in the index itself
+INLINE_THRESHOLD = 100_000
+
+
+def reference_dir(index_dir, filename, modelname):
+    """
+    Function to get the location of the reference index of a STOFS station file.
+
+    Parameters:
+    - index_dir (str): Directory holding the reference indexes
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+
+    Returns:
+    - str: Directory of the index (one JSON reference file per cycle)
+    """
+    return os.path.join(index_dir, f'{modelname}.{filename}.refs')
+
+
+def indexed_cycles(index_dir, filename, modelname):
+    """
+    Function to list the (date, cycle) pairs covered by a reference index.
+
+    Parameters:
+    - index_dir (str): Directory holding the reference indexes
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+
+    Returns:
+    - set of tuple: (date, cycle) pairs, e.g. ('20240922', '12')
+    """
+    path = reference_dir(index_dir, filename, modelname)
+    if not os.path.isdir(path):
+        return set()
+    # Reference files are named YYYYMMDD.tCCz.json
+    return {(name[0:8], name[10:12]) for name in os.listdir(path) if name.endswith('z.json')}
+
+
+def update_reference_index(index_dir, filename, modelname, directoryname, bucketname, daterange, cycles,
+                           max_workers=1, s3=None):
+    """
+    Function to scan the HDF5 chunk layout of the station files missing from a reference index and add them to it.
+    Only the file metadata is read, the data chunks are not downloaded.
+
+    Parameters:
+    - index_dir (str): Directory holding the reference indexes
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - max_workers (int): Maximum number of files scanned concurrently
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+
+    Returns:
+    - list of tuple: (date, cycle) pairs added to the index
+    - list of dict: Files that could not be scanned (e.g. cycles not published yet), retried on the next update
+    """
+    from kerchunk.hdf import SingleHdf5ToZarr
+
+    s3 = get_s3_filesystem(s3)
+    path = reference_dir(index_dir, filename, modelname)
+    os.makedirs(path, exist_ok=True)
+    held = indexed_cycles(index_dir, filename, modelname)
+    missing = [(date, cycle) for date in nowcast_dates(daterange) for cycle in cycles if (date, cycle) not in held]
+
+    def scan(pair):
+        date, cycle = pair
+        key = station_key(filename, modelname, directoryname, date, cycle)
+        url = f's3://{bucketname}/{key}'
+        try:
+            with s3.open(url, 'rb', block_size=RANGE_BLOCK_SIZE, cache_type='blockcache') as f:
+                references = SingleHdf5ToZarr(f, url, inline_threshold=INLINE_THRESHOLD).translate()
+        except Exception as e:
+            return None, {'date': date, 'cycle': cycle, 'key': key, 'error': str(e)}
+
+        # A cycle is only indexed once its references are complete
+        atomic_write(os.path.join(path, f'{date}.t{cycle}z.json'), lambda tmp_file: json.dump(references, tmp_file),
+                     mode='w')
+        return pair, None
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(scan, missing))
+    else:
+        results = [scan(pair) for pair in missing]
+
+    added = [pair for pair, failure in results if pair is not None]
+    failures = [failure for pair, failure in results if failure is not None]
+    return added, failures
+
+
+def open_reference_cycle(index_dir, filename, modelname, date, cycle, s3=None, chunks=None):
+    """
+    Function to open one indexed station file as a lazy xarray Dataset.
+
+    Parameters:
+    - index_dir (str): Directory holding the reference indexes
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g.'12')
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - chunks (dict): Dask chunks (default: the native HDF5 chunks)
+
+    Returns:
+    - xarray.Dataset: Dask-backed dataset, chunks are fetched with range requests when computed
+    """
+    references = os.path.join(reference_dir(index_dir, filename, modelname), f'{date}.t{cycle}z.json')
+    # The reference filesystem is built here and handed over as a mapper: zarr 2 does not take both a filesystem
+    # and storage_options
+    fs = fsspec.filesystem('reference', fo=references, remote_protocol='s3', fs={'s3': get_s3_filesystem(s3)})
+    return xr.open_dataset(fs.get_mapper(''), engine='zarr', chunks=chunks if chunks is not None else {},
+                           backend_kwargs={'consolidated': False})
+
+
+def open_reference_index(index_dir, filename, modelname, daterange, steps, cycles=None, s3=None, chunks=None):
+    """
+    Function to open the STOFS Nowcast data of a date range as one lazy xarray Dataset from a reference index.
+
+    Parameters:
+    - index_dir (str): Directory holding the reference indexes
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - steps (int): Number of steps to slice as the nowcast period in each STOFS file
+    - cycles (list of str): Optional list of cycles to use (default: every indexed cycle)
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - chunks (dict): Dask chunks (default: the native HDF5 chunks)
+
+    Returns:
+    - xarray.Dataset: Dask-backed dataset containing the STOFS Nowcast data; only the chunks a
+      computation touches are fetched from S3
+    """
+    held = indexed_cycles(index_dir, filename, modelname)
+    dates = nowcast_dates(daterange)
+    pairs = sorted(pair for pair in held if pair[0] in dates and (cycles is None or pair[1] in cycles))
+    if not pairs:
+        raise FileNotFoundError(f'No indexed {modelname} {filename} cycle between {daterange[0]} and {daterange[1]}')
+
+    nowcast_all_list = [open_reference_cycle(index_dir, filename, modelname, date, cycle, s3=s3, chunks=chunks)
+                        .isel(time=slice(0, steps)) for date, cycle in pairs]
+
+    # Same stitching as get_station_nowcast_data, built as a graph without loading data
+    nowcast_all_out_of_range = xr.concat(nowcast_all_list, dim='time')
+    start_date = datetime.strptime(daterange[0], '%Y%m%d')
+    end_date = datetime.strptime(daterange[1], '%Y%m%d') + timedelta(days=1)  # Include the last day
+    return nowcast_all_out_of_range.sel(time=slice(start_date, end_date))
@@ -0,0 +1,176 @@
+import os
+import asyncio
+import threading
+from contextlib import nullcontext, asynccontextmanager
+import s3fs  # Importing the s3fs library for accessing S3 buckets
+
+
+# Package-level S3 session shared by the STOFS, GFS and HRRR readers
+_s3 = None
+_s3_pid = None
+_s3_injected = False
+_s3_lock = threading.Lock()
+_async_s3 = {}  # Asynchronous session open on each running event loop, by id of the loop
+_s3_options = {
+    'max_pool_connections': 50,
+    'tcp_keepalive': True,
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    'storage_options': {},
+}
+
+
+def configure_s3_session(max_pool_connections=50, tcp_keepalive=True, connect_timeout=10, read_timeout=60, **storage_options):
+    """
+    Function to set the options of the shared S3 session. The session is rebuilt on its next use.
+
+    Parameters:
+    - max_pool_connections (int): Size of the HTTP connection pool (should be >= the number of concurrent readers)
+    - tcp_keepalive (bool): Keep idle pooled connections alive
+    - connect_timeout (float): Seconds to wait for a new connection
+    - read_timeout (float): Seconds to wait for data on an open connection
+    - storage_options: Extra keyword arguments passed to s3fs.S3FileSystem
+    """
+    global _s3, _s3_injected
+    with _s3_lock:
+        _s3_options.update({
+            'max_pool_connections': max_pool_connections,
+            'tcp_keepalive': tcp_keepalive,
+            'connect_timeout': connect_timeout,
+            'read_timeout': read_timeout,
+            'storage_options': storage_options,
+        })
+        _s3 = None
+        _s3_injected = False
+
+
+def s3_session_configuration():
+    """
+    Function to get the current options of the shared S3 session (e.g. to apply them in a worker process).
+
+    Returns:
+    - dict: Keyword arguments of configure_s3_session
+    """
+    with _s3_lock:
+        options = {name: value for name, value in _s3_options.items() if name != 'storage_options'}
+        return {**options, **_s3_options['storage_options']}
+
+
+def injected_s3_filesystem():
+    """
+    Function to get the filesystem injected with set_s3_filesystem (e.g. to inject it in a worker process too).
+
+    Returns:
+    - The injected filesystem, or None when the default session is used
+    """
+    with _s3_lock:
+        return _s3 if _s3_injected else None
+
+
+def set_s3_filesystem(s3):
+    """
+    Function to inject the filesystem used by every reader of the package (None restores the default session).
+
+    Parameters:
+    - s3: fsspec filesystem (e.g. an s3fs.S3FileSystem with credentials) or None
+    """
+    global _s3, _s3_pid, _s3_injected
+    with _s3_lock:
+        _s3 = s3
+        _s3_pid = os.getpid()
+        _s3_injected = s3 is not None
+
+
+def get_s3_filesystem(s3=None):
+    """
+    Function to get the shared S3 filesystem, creating it on first use.
+
+    Parameters:
+    - s3: Optional filesystem given by the caller, returned unchanged
+
+    Returns:
+    - s3fs.S3FileSystem: Filesystem with a pooled, keep-alive connection pool
+    """
+    global _s3, _s3_pid
+    if s3 is not None:
+        return s3
+    with _s3_lock:
+        # Connection pools can not be shared with a forked process, each process builds its own
+        if _s3 is None or (_s3_pid != os.getpid() and not _s3_injected):
+            _s3 = s3fs.S3FileSystem(skip_instance_cache=True, **_session_kwargs())
+            _s3_pid = os.getpid()
+        return _s3
+
+
+@asynccontextmanager
+async def async_s3_session(s3=None):
+    """
+    Function to open the asynchronous S3 session of the running event loop for the duration of an
+    `async with` block. Blocks nested or running concurrently on the same loop share one session, which is
+    closed when the last of them exits.
+
+    Parameters:
+    - s3: Optional asynchronous filesystem given by the caller, used unchanged and left open
+
+    Returns:
+    - s3fs.S3FileSystem: Asynchronous filesystem sharing the options of the synchronous session
+    """
+    if s3 is not None:
+        yield s3
+        return
+    loop_id = id(asyncio.get_running_loop())
+    entry = _async_s3.get(loop_id)
+    if entry is None:
+        # Registered before the first await, so concurrent blocks can not open a second session
+        s3 = s3fs.S3FileSystem(asynchronous=True, loop=asyncio.get_running_loop(), skip_instance_cache=True,
+                               **_session_kwargs())
+        entry = _async_s3[loop_id] = {'s3': s3, 'connected': asyncio.ensure_future(s3.set_session()), 'users': 0}
+    entry['users'] += 1
+    try:
+        await entry['connected']
+        yield entry['s3']
+    finally:
+        entry['users'] -= 1
+        if not entry['users']:
+            del _async_s3[loop_id]
+            await _close_async_session(entry)
+
+
+async def read_object_async(url, s3=None, semaphore=None):
+    """
+    Function to read the content of an S3 object on the running event loop.
+
+    Parameters:
+    - url (str): s3:// url of the object
+    - s3: Optional asynchronous S3 filesystem (defaults to the session of the running loop)
+    - semaphore (asyncio.Semaphore): Optional semaphore limiting the number of reads in flight
+
+    Returns:
+    - bytes: Content of the object
+    """
+    async with async_s3_session(s3) as s3, semaphore or nullcontext():
+        return await s3._cat_file(url)
+
+
+async def _close_async_session(entry):
+    # Close the aiobotocore client of a session, once it is connected
+    try:
+        await entry['connected']
+    except Exception:
+        return
+    if entry['s3']._s3 is not None:
+        await entry['s3']._s3.close()
+
+
+def _session_kwargs():
+    # Keyword arguments of s3fs.S3FileSystem built from the session options
+    return {
+        'anon': True,
+        'config_kwargs': {
+            'max_pool_connections': _s3_options['max_pool_connections'],
+            'tcp_keepalive': _s3_options['tcp_keepalive'],
+            'connect_timeout': _s3_options['connect_timeout'],
+            'read_timeout': _s3_options['read_timeout'],
+        },
+        **_s3_options['storage_options'],
+    }
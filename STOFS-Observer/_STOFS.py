@@ -1,29 +1,396 @@
-import s3fs  # Importing the s3fs library for accessing S3 buckets
+import io
+import asyncio
+import warnings
 import numpy as np
 import pandas as pd
 import xarray as xr
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+try:
+    from ._S3 import get_s3_filesystem, read_object_async, async_s3_session
+except ImportError:
+    from _S3 import get_s3_filesystem, read_object_async, async_s3_session
+try:
+    from ._CACHE import cache_enabled, open_cached
+except ImportError:
+    from _CACHE import cache_enabled, open_cached
 
 
+# Size of the byte ranges requested when only a subset of stations is read
+RANGE_BLOCK_SIZE = 256 * 1024
+
 #STOFS.py functions
-def read_STOFS_from_s3(bucket_name, key):
+def read_STOFS_from_s3(bucket_name, key, prefetch=False, s3=None, stations=None, chunks=None):
     """
     Function to read a STOFS station files from an S3 bucket.
     
     Parameters:
     - bucket_name: Name of the S3 bucket
     - key: Key/path to the NetCDF file in the bucket
+    - prefetch (bool): Download the whole object before opening it, so the transfer
+      does not happen while holding the HDF5 library lock (used by concurrent reads)
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices to keep; the file is then
+      read with small range requests so only the chunks of these stations are transferred
+    - chunks (dict): Optional dask chunk sizes (e.g. {'time': 240, 'station': 500}, {} for the file chunks)
     
     Returns:
     - ds: xarray Dataset containing the NetCDF data
     """
-    s3 = s3fs.S3FileSystem(anon=True)
+    s3 = get_s3_filesystem(s3)
     url = f"s3://{bucket_name}/{key}"
-    ds = xr.open_dataset(s3.open(url, 'rb'))
+    if cache_enabled():
+        ds = open_cached(s3, url, lambda path: xr.open_dataset(path, chunks=chunks))
+    elif stations is not None:
+        ds = xr.open_dataset(s3.open(url, 'rb', block_size=RANGE_BLOCK_SIZE, cache_type='blockcache'), chunks=chunks)
+    elif prefetch:
+        ds = xr.open_dataset(io.BytesIO(s3.cat_file(url)), chunks=chunks)
+    else:
+        ds = xr.open_dataset(s3.open(url, 'rb'), chunks=chunks)
+    if stations is not None:
+        # Lazy selection, the data of the other stations is never read
+        ds = ds.isel(station=station_indices(ds, stations))
+    return ds
+
+
+async def read_STOFS_from_s3_async(bucket_name, key, s3=None, semaphore=None, stations=None):
+    """
+    Function to read a STOFS station files from an S3 bucket on the running event loop.
+    
+    Parameters:
+    - bucket_name: Name of the S3 bucket
+    - key: Key/path to the NetCDF file in the bucket
+    - s3: Optional asynchronous S3 filesystem (defaults to the session of the running loop)
+    - semaphore (asyncio.Semaphore): Optional semaphore limiting the number of reads in flight
+    - stations (list of str or int): Optional station names or indices to keep
+    
+    Returns:
+    - ds: xarray Dataset containing the NetCDF data
+    """
+    data = await read_object_async(f"s3://{bucket_name}/{key}", s3=s3, semaphore=semaphore)
+    ds = xr.open_dataset(io.BytesIO(data))
+    if stations is not None:
+        ds = ds.isel(station=station_indices(ds, stations))
     return ds
 
 
-def get_station_nowcast_data(filename, modelname, directoryname, bucketname, daterange, steps, cycles):
+def station_indices(dataset, stations):
+    """
+    Function to find the positions of stations in a STOFS station dataset.
+    
+    Parameters:
+    - dataset (xarray.Dataset): STOFS station dataset
+    - stations (list of str or int): Station names (full name or leading station id, e.g. '8410140') or indices
+    
+    Returns:
+    - list of int: Positions of the stations along the 'station' dimension
+    """
+    lookup = None
+    indices = []
+    for station in stations:
+        if isinstance(station, (int, np.integer)):
+            indices.append(int(station))
+            continue
+        if lookup is None:
+            lookup = {}
+            for i, name in enumerate(_station_names(dataset)):
+                lookup.setdefault(name, i)
+                if name.split():
+                    lookup.setdefault(name.split()[0], i)
+        if str(station).strip() not in lookup:
+            raise KeyError(f'Station {station} not found in the station file')
+        indices.append(lookup[str(station).strip()])
+    return indices
+
+
+def _station_names(dataset):
+    # Station names are stored as bytes or as a (station, namelen) character array
+    names = dataset['station_name'].values
+    if names.ndim == 2:
+        names = [b''.join(row) if isinstance(row[0], bytes) else ''.join(row) for row in names]
+    return [name.decode(errors='ignore').strip() if isinstance(name, bytes) else str(name).strip() for name in names]
+
+
+def _fill_value(dtype, name):
+    # Value of the time steps and cycles that could not be read
+    if dtype.kind in 'fc':
+        return np.nan
+    if dtype.kind in 'mM':
+        return np.array('NaT', dtype=dtype)
+    if dtype.kind == 'i':
+        return np.iinfo(dtype).min
+    if dtype.kind == 'u':
+        return np.iinfo(dtype).max
+    raise ValueError(f'{name!r} ({dtype}) can not be gathered into a forecast cube, only numeric variables can')
+
+
+def station_key(filename, modelname, directoryname, date, cycle):
+    """
+    Function to build the S3 key of a STOFS station file.
+    
+    Parameters:
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name 
+    - directoryname (str): Optional directory name in the S3 bucket
+    - date (str): date in 'YYYYMMDD' format
+    - cycle (str): cycle of the data (e.g.'12')
+    
+    Returns:
+    - str: Key/path of the NetCDF file in the bucket
+    """
+    base_key = f'{modelname}.{date}'
+    dataname = f't{cycle}z.{filename}.nc'
+    if directoryname:
+        key = f'{directoryname}/{base_key}/{modelname}.{dataname}'
+    else:
+        key = f'{base_key}/{modelname}.{dataname}'
+    return key
+
+
+def _read_station_cycle(bucketname, key, steps, prefetch, s3, stations, chunks):
+    # Lazy mode only opens the file, its nowcast slice stays a dask graph
+    if chunks is not None:
+        dataset = read_STOFS_from_s3(bucketname, key, s3=s3, stations=stations, chunks=chunks)
+        return dataset.isel(time=slice(0, steps))
+
+    # Read one cycle and keep its first 'steps' time steps (nowcast data) in memory
+    dataset = read_STOFS_from_s3(bucketname, key, prefetch=prefetch and stations is None, s3=s3, stations=stations)
+    nowcast = dataset.isel(time=slice(0, steps)).load()
+    dataset.close()
+    return nowcast
+
+
+def fetch_station_pairs(filename, modelname, directoryname, bucketname, pairs, steps=None, max_workers=1, s3=None,
+                        stations=None, chunks=None):
+    """
+    Function to read the STOFS station files of a list of (date, cycle) pairs from an S3 bucket.
+    
+    Parameters:
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name 
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - pairs (list of tuple): (date, cycle) pairs, with dates in 'YYYYMMDD' format and cycles like '12'
+    - steps (int): Number of steps to keep from each file (None keeps all of them)
+    - max_workers (int): Maximum number of files read concurrently (1 reads them one at a time)
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
+    - chunks (dict): Dask chunk sizes; when given the files are only opened and the datasets stay lazy
+    
+    Returns:
+    - list of tuple: (date, cycle, xarray.Dataset) of the files that were read, in the order of pairs
+    - list of dict: One entry per file that could not be read, with its 'date', 'cycle', 'key' and 'error'
+    """
+    s3 = get_s3_filesystem(s3)
+    requests = [(date, cycle, station_key(filename, modelname, directoryname, date, cycle)) for date, cycle in pairs]
+
+    def read(request):
+        date, cycle, key = request
+        try:
+            return (date, cycle, _read_station_cycle(bucketname, key, steps, max_workers > 1, s3, stations, chunks)), None
+        except Exception as e:
+            return None, {'date': date, 'cycle': cycle, 'key': key, 'error': str(e)}
+
+    # The pool bounds the number of requests in flight, map keeps the order of the pairs
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(read, requests))
+    else:
+        results = [read(request) for request in requests]
+
+    read_pairs = [result for result, failure in results if result is not None]
+    failures = [failure for result, failure in results if failure is not None]
+    return read_pairs, failures
+
+
+def fetch_station_cycles(filename, modelname, directoryname, bucketname, dates, cycles, steps=None, max_workers=1, s3=None,
+                         stations=None, chunks=None):
+    """
+    Function to read the STOFS station files of many dates and cycles from an S3 bucket.
+    
+    Parameters:
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name 
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - dates (list of str): Dates in 'YYYYMMDD' format
+    - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - steps (int): Number of steps to keep from each file (None keeps all of them)
+    - max_workers (int): Maximum number of files read concurrently (1 reads them one at a time)
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
+    - chunks (dict): Dask chunk sizes; when given the files are only opened and the datasets stay lazy
+    
+    Returns:
+    - list of xarray.Dataset: Datasets of the files that were read, in (date, cycle) order
+    - list of dict: One entry per file that could not be read, with its 'date', 'cycle', 'key' and 'error'
+    """
+    pairs = [(date, cycle) for date in dates for cycle in cycles]
+    read_pairs, failures = fetch_station_pairs(filename, modelname, directoryname, bucketname, pairs, steps=steps,
+                                               max_workers=max_workers, s3=s3, stations=stations, chunks=chunks)
+    return [dataset for _, _, dataset in read_pairs], failures
+
+
+def _open_chunks(chunks):
+    # Chunks used to open each cycle, the time chunks are evened out after the concatenation
+    if not chunks:
+        return {}
+    return {dim: size for dim, size in chunks.items() if dim != 'time'}
+
+
+async def fetch_station_cycles_async(filename, modelname, directoryname, bucketname, dates, cycles, steps=None,
+                                     max_concurrency=64, s3=None, stations=None):
+    """
+    Function to read the STOFS station files of many dates and cycles from an S3 bucket on the running event loop.
+    
+    Parameters:
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name 
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - dates (list of str): Dates in 'YYYYMMDD' format
+    - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - steps (int): Number of steps to keep from each file (None keeps all of them)
+    - max_concurrency (int): Maximum number of object reads in flight
+    - s3: Optional asynchronous S3 filesystem (defaults to the session of the running loop)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
+    
+    Returns:
+    - list of xarray.Dataset: Datasets of the files that were read, in (date, cycle) order
+    - list of dict: One entry per file that could not be read, with its 'date', 'cycle', 'key' and 'error'
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    requests = [(date, cycle, station_key(filename, modelname, directoryname, date, cycle))
+                for date in dates for cycle in cycles]
+
+    async def read(request):
+        date, cycle, key = request
+        try:
+            dataset = await read_STOFS_from_s3_async(bucketname, key, s3=s3, semaphore=semaphore, stations=stations)
+            nowcast = dataset.isel(time=slice(0, steps)).load()
+            dataset.close()
+            return nowcast, None
+        except Exception as e:
+            return None, {'date': date, 'cycle': cycle, 'key': key, 'error': str(e)}
+
+    # gather keeps the (date, cycle) order, every read shares one session closed at the end
+    async with async_s3_session(s3) as s3:
+        results = await asyncio.gather(*(read(request) for request in requests))
+    datasets = [dataset for dataset, failure in results if dataset is not None]
+    failures = [failure for dataset, failure in results if failure is not None]
+    return datasets, failures
+
+
+def nowcast_dates(daterange):
+    """
+    Function to list the dates whose cycles are needed to cover a nowcast date range.
+    
+    Parameters:
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    
+    Returns:
+    - list of str: Dates in 'YYYYMMDD' format, up to the day after the end date
+    """
+    start_date = datetime.strptime(daterange[0], '%Y%m%d')
+    end_date = datetime.strptime(daterange[1], '%Y%m%d') + timedelta(days=1)  # Include the last day
+    
+    dates = []
+    current_date = start_date
+    while current_date <= end_date:
+        dates.append(current_date.strftime('%Y%m%d'))  # Format as YYYYMMDD
+        current_date += timedelta(days=1)
+    return dates
+
+
+def stitch_nowcast(nowcasts, start_date=None, end_date=None, overlap='newest', max_workers=1):
+    """
+    Function to stitch the nowcast windows of several cycles into one dataset with a strictly increasing time axis.
+    The time axis is computed first, one (time, ...) array is allocated per variable and every cycle
+    only writes the time steps it owns, so the data is copied once.
+    
+    Parameters:
+    - nowcasts (list of xarray.Dataset): Nowcast window of each cycle, eager or lazy, in any order
+    - start_date (datetime): Optional first time step to keep
+    - end_date (datetime): Optional last time step to keep
+    - overlap (str): Where windows overlap, 'newest' keeps the most recent cycle and 'oldest' the earliest one
+    - max_workers (int): Maximum number of lazy cycles loaded concurrently
+    
+    Returns:
+    - xarray.Dataset: Dataset containing the stitched STOFS Nowcast data
+    """
+    if overlap not in ('newest', 'oldest'):
+        raise ValueError(f"overlap must be 'newest' or 'oldest', not {overlap!r}")
+
+    nowcasts = [nowcast for nowcast in nowcasts if nowcast.sizes.get('time', 0)]
+    if not nowcasts:
+        raise ValueError('No nowcast data to stitch')
+
+    # Target time axis: every time step of every window inside the requested range
+    cycle_times = [nowcast['time'].values for nowcast in nowcasts]
+    times = np.unique(np.concatenate(cycle_times))
+    if start_date is not None:
+        times = times[times >= np.datetime64(start_date)]
+    if end_date is not None:
+        times = times[times <= np.datetime64(end_date)]
+
+    # Each time step is owned by one cycle, cycles are ranked by the start of their window
+    order = sorted(range(len(nowcasts)), key=lambda i: cycle_times[i].min())
+    if overlap == 'oldest':
+        order = order[::-1]
+    owner = np.full(len(times), -1)
+    for i in order:
+        positions, inside = _window_positions(times, cycle_times[i])
+        owner[positions[inside]] = i
+
+    template = nowcasts[order[-1]]
+    names = [name for name, variable in template.variables.items() if 'time' in variable.dims and name != 'time']
+    stitched = {}
+    for name in names:
+        variable = template[name].transpose('time', ...)
+        stitched[name] = np.empty((len(times),) + variable.shape[1:], dtype=variable.dtype)
+
+    def scatter(i):
+        positions, inside = _window_positions(times, cycle_times[i])
+        owned = inside.copy()
+        owned[inside] = owner[positions[inside]] == i
+        if not owned.any():
+            return
+        # Only the owned time steps of a lazy cycle are read
+        window = nowcasts[i].isel(time=np.flatnonzero(owned))
+        for name in names:
+            stitched[name][positions[owned]] = window[name].transpose('time', ...).values
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(scatter, range(len(nowcasts))))
+    else:
+        for i in range(len(nowcasts)):
+            scatter(i)
+
+    # The station metadata is loaded so the result does not depend on the files staying open
+    nowcast_all = template.drop_vars(names + ['time']).load().assign_coords(time=times)
+    for name in names:
+        variable = template[name].transpose('time', ...)
+        data = xr.Variable(variable.dims, stitched[name], attrs=variable.attrs)
+        if name in template.coords:
+            nowcast_all = nowcast_all.assign_coords({name: data})
+        else:
+            nowcast_all[name] = data
+    nowcast_all['time'].attrs = template['time'].attrs
+    return nowcast_all
+
+
+def _window_positions(times, window_times):
+    # Positions of a cycle's time steps on the target axis, and which of them are on it
+    positions = np.searchsorted(times, window_times)
+    inside = positions < len(times)
+    inside[inside] = times[positions[inside]] == window_times[inside]
+    return positions, inside
+
+
+def get_station_nowcast_data(filename, modelname, directoryname, bucketname, daterange, steps, cycles,
+                             max_workers=1, return_failures=False, s3=None, stations=None, lazy=False, chunks=None,
+                             overlap=None):
     """
     Function to read STOFS Nowcast data from a station file on an S3 bucket.
     
@@ -35,9 +402,18 @@ def get_station_nowcast_data(filename, modelname, directoryname, bucketname, dat
     - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
     - steps (int): Number of steps to slice as the nowcast period in each STOFS file
     - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - max_workers (int): Maximum number of files read concurrently from S3 (1 reads them one at a time)
+    - return_failures (bool): Also return the files that could not be read instead of warning about them
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
+    - lazy (bool): Open every cycle as dask arrays and return the sliced, concatenated dataset without loading data
+    - chunks (dict): Dask chunk sizes of the lazy result (e.g. {'time': 1440, 'station': 500})
+    - overlap (str): Stitch the cycles with stitch_nowcast ('newest' or 'oldest' cycle wins where windows
+      overlap) instead of concatenating them, which gives a strictly increasing time axis
     
     Returns:
     - xarray.Dataset: Dataset containing the STOFS Nowcast data
+    - list of dict: Files that could not be read (only if return_failures is True)
     """
 
     # Parse the start and end dates from the date range
@@ -45,41 +421,83 @@ def get_station_nowcast_data(filename, modelname, directoryname, bucketname, dat
     end_date = datetime.strptime(daterange[1], '%Y%m%d') + timedelta(days=1)  # Include the last day
     
     # Generate a list of dates in the specified range
-    dates = []
-    current_date = start_date
-    while current_date <= end_date:
-        dates.append(current_date.strftime('%Y%m%d'))  # Format as YYYYMMDD
-        current_date += timedelta(days=1)
+    dates = nowcast_dates(daterange)
 
-    nowcast_all_list = []
-    
-    for date in dates:
-        for cycle in cycles:
-            base_key = f'{modelname}.{date}'
-            dataname = f't{cycle}z.{filename}.nc'
-            if directoryname:
-                key = f'{directoryname}/{base_key}/{modelname}.{dataname}'
-            else:
-                key = f'{base_key}/{modelname}.{dataname}'
-                
-            try:
-                dataset = read_STOFS_from_s3(bucketname, key)
-
-                # Check if dataset exists and has data
-                if dataset is not None:
-                    nowcast = dataset.isel(time=slice(0, steps))  # First 'steps' time steps (nowcast data)
-                    nowcast_all_list.append(nowcast)
-            except Exception as e:
-                print(f'Error reading file {key} from S3: {str(e)}')
+    if overlap is not None and lazy:
+        raise ValueError('overlap resolution builds the result in memory and can not be combined with lazy=True')
+    if overlap is not None:
+        # Cycles are only opened here, stitch_nowcast reads the time steps each one contributes
+        open_chunks = {}
+    else:
+        open_chunks = _open_chunks(chunks) if lazy else None
+
+    nowcast_all_list, failures = fetch_station_cycles(filename, modelname, directoryname, bucketname,
+                                                      dates, cycles, steps=steps, max_workers=max_workers, s3=s3,
+                                                      stations=stations, chunks=open_chunks)
+    if failures and not return_failures:
+        warnings.warn(f'{len(failures)} STOFS file(s) could not be read from S3: '
+                      + ', '.join(failure['key'] for failure in failures))
+
+    if overlap is not None:
+        nowcast_all = stitch_nowcast(nowcast_all_list, start_date, end_date, overlap=overlap, max_workers=max_workers)
+        for nowcast in nowcast_all_list:
+            nowcast.close()
+    else:
+        # Concatenate all nowcast data and filter by date range
+        nowcast_all_out_of_range = xr.concat(nowcast_all_list, dim='time')
+        nowcast_all = nowcast_all_out_of_range.sel(time=slice(start_date, end_date))  # Filtered dataset
+        if lazy and chunks:
+            nowcast_all = nowcast_all.chunk(chunks)  # Even chunks across the concatenated cycles
+
+    if return_failures:
+        return nowcast_all, failures
+    return nowcast_all
+
+
+async def get_station_nowcast_data_async(filename, modelname, directoryname, bucketname, daterange, steps, cycles,
+                                         max_concurrency=64, return_failures=False, s3=None, stations=None):
+    """
+    Function to read STOFS Nowcast data from a station file on an S3 bucket on the running event loop.
+    The result is the same as the one of get_station_nowcast_data.
+    
+    Parameters:
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name 
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - steps (int): Number of steps to slice as the nowcast period in each STOFS file
+    - cycles (list of str): List of cycles (e.g., ['00', '12'])
+    - max_concurrency (int): Maximum number of object reads in flight
+    - return_failures (bool): Also return the files that could not be read instead of warning about them
+    - s3: Optional asynchronous S3 filesystem (defaults to the session of the running loop)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
+    
+    Returns:
+    - xarray.Dataset: Dataset containing the STOFS Nowcast data
+    - list of dict: Files that could not be read (only if return_failures is True)
+    """
+    start_date = datetime.strptime(daterange[0], '%Y%m%d')
+    end_date = datetime.strptime(daterange[1], '%Y%m%d') + timedelta(days=1)  # Include the last day
+
+    nowcast_all_list, failures = await fetch_station_cycles_async(filename, modelname, directoryname, bucketname,
+                                                                  nowcast_dates(daterange), cycles, steps=steps,
+                                                                  max_concurrency=max_concurrency, s3=s3,
+                                                                  stations=stations)
+    if failures and not return_failures:
+        warnings.warn(f'{len(failures)} STOFS file(s) could not be read from S3: '
+                      + ', '.join(failure['key'] for failure in failures))
 
     # Concatenate all nowcast data and filter by date range
     nowcast_all_out_of_range = xr.concat(nowcast_all_list, dim='time')
     nowcast_all = nowcast_all_out_of_range.sel(time=slice(start_date, end_date))  # Filtered dataset
 
+    if return_failures:
+        return nowcast_all, failures
     return nowcast_all
 
 
-def get_station_data(filename, modelname, directoryname, bucketname, date, cycle):
+def get_station_data(filename, modelname, directoryname, bucketname, date, cycle, s3=None, stations=None):
     """
     Function to read STOFS data for a particular date and cycle from a station file on an S3 bucket.
     
@@ -90,20 +508,156 @@ def get_station_data(filename, modelname, directoryname, bucketname, date, cycle
     - bucketname (str): The name of the S3 bucket
     - date (str): date in 'YYYYMMDD' format
     - cycle (str): cycle of the data (e.g.'12')
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
     
     Returns:
     - xarray.Dataset: Dataset containing the STOFS nowcast+forecast data from one cycle
     """
     
 
-    base_key = f'{modelname}.{date}'
-    dataname = f't{cycle}z.{filename}.nc'
-    if directoryname:
-       key = f'{directoryname}/{base_key}/{modelname}.{dataname}'
-    else:
-       key = f'{base_key}/{modelname}.{dataname}'
+    key = station_key(filename, modelname, directoryname, date, cycle)
     try:
-       dataset = read_STOFS_from_s3(bucketname, key)
+       dataset = read_STOFS_from_s3(bucketname, key, s3=s3, stations=stations)
     except Exception as e:
                 print(f'Error reading file {key} from S3: {str(e)}')
-    return dataset
\ No newline at end of file
+    return dataset
+
+def get_station_forecast_cube(filename, modelname, directoryname, bucketname, daterange, cycles, variables=('zeta',),
+                              lead_steps=None, dtype=None, max_workers=1, s3=None, stations=None, store=None,
+                              return_failures=False):
+    """
+    Function to read the STOFS forecasts of many cycles from station files on an S3 bucket into one
+    (cycle, lead_time, station) cube per variable.
+    
+    Parameters:
+    - filename (str): The base filename for STOFS data
+    - modelname (str): The STOFS model name 
+    - directoryname (str): Optional directory name in the S3 bucket
+    - bucketname (str): The name of the S3 bucket
+    - daterange (list of two str): Start and end dates in 'YYYYMMDD' format
+    - cycles (list of str): List of cycles (e.g., ['00', '06', '12', '18'])
+    - variables (list of str): Time-dependent variables to read (e.g. ['zeta'])
+    - lead_steps (int): Optional number of time steps to keep from each cycle (default: all of them)
+    - dtype (str): Optional dtype of the cube (e.g. 'float32' halves the memory of float64 output)
+    - max_workers (int): Maximum number of files read concurrently from S3 (1 reads them one at a time)
+    - s3: Optional S3 filesystem (defaults to the shared package session)
+    - stations (list of str or int): Optional station names or indices to read (all stations by default)
+    - store (str): Optional path of a Zarr store; each cycle is then written to disk as soon as it is read
+      instead of being kept in memory
+    - return_failures (bool): Also return the files that could not be read instead of warning about them
+    
+    Returns:
+    - xarray.Dataset: Dataset with dimensions (cycle, lead_time, station), the stations labelled by name; cycles that
+      could not be read are NaN (the _FillValue of integer variables)
+    - list of dict: Files that could not be read (only if return_failures is True)
+    """
+    s3 = get_s3_filesystem(s3)
+    start_date = datetime.strptime(daterange[0], '%Y%m%d')
+    end_date = datetime.strptime(daterange[1], '%Y%m%d')
+    pairs = []
+    current_date = start_date
+    while current_date <= end_date:
+        pairs.extend((current_date.strftime('%Y%m%d'), cycle) for cycle in cycles)
+        current_date += timedelta(days=1)
+    cycle_times = np.array([datetime.strptime(date, '%Y%m%d') + timedelta(hours=int(cycle)) for date, cycle in pairs],
+                           dtype='datetime64[ns]')
+
+    # The lead time axis and the station metadata come from the first cycle that can be opened
+    template, template_index, failures = None, None, []
+    for i, (date, cycle) in enumerate(pairs):
+        key = station_key(filename, modelname, directoryname, date, cycle)
+        try:
+            template = read_STOFS_from_s3(bucketname, key, s3=s3, stations=stations)
+            template_index = i
+            break
+        except Exception as e:
+            failures.append({'date': date, 'cycle': cycle, 'key': key, 'error': str(e)})
+    if template is None:
+        raise FileNotFoundError(f'No {modelname} {filename} file could be read between {daterange[0]} and {daterange[1]}')
+
+    lead_times = template['time'].values[:lead_steps] - cycle_times[template_index]
+    station_coords = {name: template[name].load().variable for name in template.variables
+                      if template[name].dims == ('station',)}
+    if 'station_name' in template.variables:
+        # The (station, namelen) character array is decoded into the labels of the stations
+        station_coords['station'] = _station_names(template)
+    dtypes = {name: np.dtype(dtype) if dtype is not None else template[name].dtype for name in variables}
+    fill_values = {name: _fill_value(dtypes[name], name) for name in variables}
+    shape = (len(pairs), len(lead_times), template.sizes['station'])
+    # Missing values of integer variables are marked by their _FillValue (NaN for floats)
+    attrs = {name: {'_FillValue': fill_values[name]} if dtypes[name].kind in 'iu' else {} for name in variables}
+
+    coords = {'cycle': cycle_times, 'lead_time': lead_times, **station_coords}
+    if store is None:
+        cube = {name: np.full(shape, fill_values[name], dtype=dtypes[name]) for name in variables}
+    else:
+        # Lazily filled template, only the metadata is written; each cycle is one chunk
+        import dask.array as da
+        chunks = (1, len(lead_times), template.sizes['station'])
+        empty = xr.Dataset(
+            {name: (('cycle', 'lead_time', 'station'),
+                    da.full(shape, fill_values[name], dtype=dtypes[name], chunks=chunks))
+             for name in variables},
+            coords=coords)
+        empty.to_zarr(store, mode='w', compute=False, consolidated=False, encoding=attrs)
+
+    def write(i, values):
+        if store is None:
+            for name in variables:
+                cube[name][i] = values[name]
+        else:
+            region = xr.Dataset({name: (('cycle', 'lead_time', 'station'), values[name][None]) for name in variables})
+            region.to_zarr(store, region={'cycle': slice(i, i + 1)}, consolidated=False)
+
+    def read(i, dataset=None):
+        date, cycle = pairs[i]
+        key = station_key(filename, modelname, directoryname, date, cycle)
+        try:
+            if dataset is None:
+                dataset = read_STOFS_from_s3(bucketname, key, prefetch=max_workers > 1 and stations is None, s3=s3,
+                                             stations=stations)
+            # Time steps are placed by their lead time, so cycles with shorter files still line up
+            positions, inside = _window_positions(lead_times, dataset['time'].values - cycle_times[i])
+            forecast = dataset[list(variables)].isel(time=np.flatnonzero(inside)).load()
+            dataset.close()
+        except Exception as e:
+            if store is not None:
+                write(i, missing)
+            return {'date': date, 'cycle': cycle, 'key': key, 'error': str(e)}
+
+        values = {name: np.full(shape[1:], fill_values[name], dtype=dtypes[name]) for name in variables}
+        for name in variables:
+            values[name][positions[inside]] = forecast[name].transpose('time', 'station').values
+        write(i, values)
+        return None
+
+    # Cycles that could not be read are written too in a store: unwritten Zarr chunks read back as the fill value
+    # of the array, which is not the _FillValue in every Zarr format
+    missing = {name: np.full(shape[1:], fill_values[name], dtype=dtypes[name]) for name in variables}
+    if store is not None:
+        for i in range(template_index):
+            write(i, missing)
+
+    # The template cycle is already open, it is not read a second time
+    results = [read(template_index, template)]
+    indices = range(template_index + 1, len(pairs))
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results.extend(executor.map(read, indices))
+    else:
+        results.extend(read(i) for i in indices)
+    failures.extend(failure for failure in results if failure is not None)
+    if failures and not return_failures:
+        warnings.warn(f'{len(failures)} STOFS file(s) could not be read from S3: '
+                      + ', '.join(failure['key'] for failure in failures))
+
+    if store is None:
+        forecast_cube = xr.Dataset({name: (('cycle', 'lead_time', 'station'), cube[name], attrs[name])
+                                    for name in variables}, coords=coords)
+    else:
+        forecast_cube = xr.open_zarr(store, consolidated=False)
+
+    if return_failures:
+        return forecast_cube, failures
+    return forecast_cube
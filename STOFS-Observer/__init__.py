@@ -1,5 +1,14 @@
+from . import _S3
+from . import _CACHE
 from . import _STOFS
+from . import _ARCHIVE
+from . import _REFERENCE
+from . import _GRIB
+from . import _INTERP
+from . import _POINTS
+from . import _CHUNKS
 from . import _GFS
 from . import _HRRR
+from . import _FIELDS
 
-__all__ = ['_STOFS','_GFS','_HRRR']
\ No newline at end of file
+__all__ = ['_S3','_CACHE','_STOFS','_ARCHIVE','_REFERENCE','_GRIB','_INTERP','_POINTS','_CHUNKS','_GFS','_HRRR','_FIELDS']
\ No newline at end of file
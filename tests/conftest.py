@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are imported on their own, the name of the package directory is not a valid identifier
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'STOFS-Observer'))
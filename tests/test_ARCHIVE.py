@@ -0,0 +1,116 @@
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import _ARCHIVE
+
+STEPS = 12
+ARGS = ('points.cwl', 'stofs_2d_glo', '', 'bucket')
+
+
+def synthetic_nowcast(date, cycle):
+    # Nowcast window of a cycle, six-minute steps ending at the cycle time
+    end = pd.Timestamp(date) + pd.Timedelta(hours=int(cycle))
+    times = pd.date_range(end=end, periods=STEPS, freq='6min')
+    zeta = np.add.outer(np.arange(STEPS), np.arange(3) * 100.0) + int(date) % 100 + int(cycle)
+    return xr.Dataset({'zeta': (('time', 'station'), zeta),
+                       'station_name': ('station', np.array(['a', 'b', 'c']))},
+                      coords={'time': times})
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    # Cycles are built locally instead of being read from S3
+    calls = []
+
+    def fetch_station_pairs(filename, modelname, directoryname, bucketname, pairs, **kwargs):
+        calls.append(list(pairs))
+        time.sleep(0.01)
+        return [(date, cycle, synthetic_nowcast(date, cycle)) for date, cycle in pairs], []
+
+    monkeypatch.setattr(_ARCHIVE, 'fetch_station_pairs', fetch_station_pairs)
+    return calls
+
+
+def read(archive_dir):
+    return _ARCHIVE.read_nowcast_archive(archive_dir, *ARGS[:2], ['20240901', '20240930']).load()
+
+
+def test_update_appends_only_missing_cycles(tmp_path, fetched):
+    appended, failures = _ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240922'], STEPS,
+                                                         ['00', '12'])
+    assert appended == [('20240922', '00'), ('20240922', '12'), ('20240923', '00'), ('20240923', '12')]
+    assert failures == []
+
+    appended, _ = _ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240923'], STEPS,
+                                                  ['00', '12'])
+    assert appended == [('20240924', '00'), ('20240924', '12')]
+    assert read(tmp_path).sizes['time'] == 6 * STEPS
+
+
+def test_interrupted_update_resumes_without_duplicates(tmp_path, fetched, monkeypatch):
+    write_cycles = _ARCHIVE._write_cycles
+    commits = []
+
+    def killed(path, held, length):
+        # The process dies after appending the second cycle, before it is recorded
+        if len(commits) == 1:
+            raise KeyboardInterrupt
+        commits.append(length)
+        write_cycles(path, held, length)
+
+    monkeypatch.setattr(_ARCHIVE, '_write_cycles', killed)
+    with pytest.raises(KeyboardInterrupt):
+        _ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240922'], STEPS, ['00', '12'])
+    assert _ARCHIVE.archived_cycles(str(tmp_path), *ARGS[:2]) == {('20240922', '00')}
+    # The uncommitted time steps are not visible to readers
+    assert read(tmp_path).sizes['time'] == STEPS
+
+    monkeypatch.setattr(_ARCHIVE, '_write_cycles', write_cycles)
+    appended, _ = _ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240922'], STEPS,
+                                                  ['00', '12'])
+    assert appended == [('20240922', '12'), ('20240923', '00'), ('20240923', '12')]
+
+    resumed = read(tmp_path)
+    assert resumed.sizes['time'] == 4 * STEPS
+    assert resumed.indexes['time'].is_unique
+    expected = xr.concat([synthetic_nowcast(date, cycle)['zeta'] for date, cycle in
+                          [('20240922', '00'), ('20240922', '12'), ('20240923', '00'), ('20240923', '12')]], 'time')
+    np.testing.assert_array_equal(resumed['zeta'].values, expected.values)
+
+
+def test_interrupted_creation_is_written_again(tmp_path, fetched, monkeypatch):
+    write_cycles = _ARCHIVE._write_cycles
+
+    def killed(path, held, length):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(_ARCHIVE, '_write_cycles', killed)
+    with pytest.raises(KeyboardInterrupt):
+        _ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240922'], STEPS, ['00'])
+    assert _ARCHIVE.archived_cycles(str(tmp_path), *ARGS[:2]) == set()
+
+    monkeypatch.setattr(_ARCHIVE, '_write_cycles', write_cycles)
+
+    _ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240922'], STEPS, ['00'])
+    assert read(tmp_path).sizes['time'] == 2 * STEPS
+
+
+def test_concurrent_updates_do_not_interleave(tmp_path, fetched):
+    results = []
+
+    def update():
+        results.append(_ARCHIVE.update_nowcast_archive(str(tmp_path), *ARGS, ['20240922', '20240922'], STEPS,
+                                                       ['00', '12'], batch_size=1)[0])
+
+    threads = [threading.Thread(target=update) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The second update finds every cycle already held
+    assert sorted(len(appended) for appended in results) == [0, 4]
+    assert read(tmp_path).indexes['time'].is_unique
@@ -0,0 +1,139 @@
+import os
+import uuid
+import fsspec
+import pytest
+import _CACHE
+
+
+@pytest.fixture
+def memory_objects():
+    # In-memory filesystem standing in for S3, with objects of 100 bytes
+    fs = fsspec.filesystem('memory')
+    prefix = f'memory://cache-{uuid.uuid4().hex}'
+
+    def url(name, size=100):
+        path = f'{prefix}/{name}'
+        if not fs.exists(path):
+            fs.pipe(path, name.encode()[:1] * size)
+        return path
+
+    yield fs, url
+    fs.rm(prefix, recursive=True)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    _CACHE.configure_cache(str(tmp_path), max_bytes=300)
+    _CACHE.clear_cache()
+    yield tmp_path
+    _CACHE.configure_cache(None)
+
+
+def test_cached_object_is_read_locally(cache, memory_objects):
+    fs, url = memory_objects
+    assert _CACHE.read_object(fs, url('a')) == b'a' * 100
+    assert _CACHE.read_object(fs, url('a')) == b'a' * 100
+    stats = _CACHE.cache_stats()
+    assert (stats['hits'], stats['misses'], stats['bytes_downloaded']) == (1, 1, 100)
+
+
+def test_least_recently_used_object_is_evicted_first(cache, memory_objects):
+    fs, url = memory_objects
+    paths = {name: _CACHE.cached_path(fs, url(name)) for name in 'abc'}
+    for age, name in enumerate('abc'):
+        os.utime(paths[name], (1000 + age, 1000 + age))
+
+    # A hit makes 'a' the most recently used object, 'b' is then the oldest one
+    _CACHE.cached_path(fs, url('a'))
+    path_d = _CACHE.cached_path(fs, url('d'))
+
+    assert not os.path.exists(paths['b'])
+    assert all(os.path.exists(path) for path in (paths['a'], paths['c'], path_d))
+    assert _CACHE.cache_stats()['evictions'] == 1
+
+
+def test_cache_size_stays_within_max_bytes(cache, memory_objects):
+    fs, url = memory_objects
+    for name in 'abcdefg':
+        _CACHE.cached_path(fs, url(name))
+        assert _CACHE.cache_stats()['size'] <= 300
+    stats = _CACHE.cache_stats()
+    assert (stats['entries'], stats['evictions']) == (3, 4)
+
+
+def test_object_larger_than_max_bytes_is_kept_until_the_next_one(cache, memory_objects):
+    fs, url = memory_objects
+    _CACHE.cached_path(fs, url('a'))
+    large = _CACHE.cached_path(fs, url('L', size=500))
+    assert os.path.exists(large)
+    assert _CACHE.cache_stats()['entries'] == 1
+
+    _CACHE.cached_path(fs, url('b'))
+    assert not os.path.exists(large)
+
+
+def test_evicted_entry_is_downloaded_again(cache, memory_objects):
+    fs, url = memory_objects
+    calls = []
+
+    def opener(path):
+        # Another process evicts the object between the lookup and the first open
+        if not calls:
+            os.remove(path)
+        calls.append(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    assert _CACHE.open_cached(fs, url('a'), opener) == b'a' * 100
+    assert len(calls) == 2
+
+
+def test_byte_ranges_are_cached_as_one_entry(cache, memory_objects):
+    fs, url = memory_objects
+    source = url('r')
+    fs.pipe(source.split('://')[1], bytes(range(100)))
+    assert _CACHE.read_object_ranges(fs, source, [(0, 2), (10, 12)]) == bytes([0, 1, 10, 11])
+    assert _CACHE.read_object_ranges(fs, source, [(0, 2), (10, 12)]) == bytes([0, 1, 10, 11])
+    assert _CACHE.cache_stats()['hits'] == 1
+
+
+def test_failed_atomic_write_leaves_no_file(tmp_path):
+    def fail(tmp_file):
+        tmp_file.write(b'partial')
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        _CACHE.atomic_write(str(tmp_path / 'artifact.bin'), fail)
+    assert list(tmp_path.iterdir()) == []
+
+    _CACHE.atomic_write(str(tmp_path / 'artifact.bin'), lambda tmp_file: tmp_file.write(b'complete'))
+    assert [path.name for path in tmp_path.iterdir()] == ['artifact.bin']
+
+
+def test_memoized_artifact_is_built_once(cache):
+    builds = []
+
+    def build():
+        builds.append(1)
+        return 'geometry'
+
+    def load(path):
+        with open(path) as f:
+            return f.read()
+
+    def save(artifact, tmp_file):
+        tmp_file.write(artifact)
+
+    memory = {}
+    args = ('grid', 'grids', 'grid.txt', build, load, save)
+    assert _CACHE.memoized_artifact(memory, *args, mode='w') == 'geometry'
+    assert _CACHE.memoized_artifact(memory, *args, mode='w') == 'geometry'
+    # Another process finds it on disk
+    assert _CACHE.memoized_artifact({}, *args, mode='w') == 'geometry'
+    assert len(builds) == 1
+
+
+def test_coordinates_id_depends_on_the_points():
+    assert _CACHE.coordinates_id([1.0, 2.0], [3.0, 4.0]) == _CACHE.coordinates_id([1, 2], [3, 4])
+    assert _CACHE.coordinates_id([1.0, 2.0], [3.0, 4.0]) != _CACHE.coordinates_id([2.0, 1.0], [4.0, 3.0])
+    assert len(_CACHE.coordinates_id([1.0], [2.0])) == 32
@@ -0,0 +1,133 @@
+import uuid
+import fsspec
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import _CHUNKS
+
+
+def test_coalesce_overlapping_and_close_ranges():
+    starts, ends, groups = _CHUNKS.coalesce_ranges([0, 50, 300, 120], [100, 80, 400, 200], max_gap=20)
+    # [0, 100) holds [50, 80), [120, 200) is 20 bytes away, [300, 400) is 100 bytes away
+    np.testing.assert_array_equal(starts, [0, 300])
+    np.testing.assert_array_equal(ends, [200, 400])
+    np.testing.assert_array_equal(groups, [0, 0, 1, 0])
+
+
+def test_coalesce_gap_limit():
+    starts, ends, _ = _CHUNKS.coalesce_ranges([0, 110], [100, 200], max_gap=10)
+    assert list(zip(starts, ends)) == [(0, 200)]
+    starts, ends, _ = _CHUNKS.coalesce_ranges([0, 111], [100, 200], max_gap=10)
+    assert list(zip(starts, ends)) == [(0, 100), (111, 200)]
+    # A gap after a long range is measured from the furthest end so far
+    starts, ends, groups = _CHUNKS.coalesce_ranges([0, 10, 500], [1000, 20, 1005], max_gap=0)
+    assert list(zip(starts, ends)) == [(0, 1005)]
+    np.testing.assert_array_equal(groups, [0, 0, 0])
+
+
+def test_coalesce_without_ranges():
+    starts, ends, groups = _CHUNKS.coalesce_ranges([], [])
+    assert len(starts) == len(ends) == len(groups) == 0
+
+
+@pytest.fixture
+def chunked_file(tmp_path):
+    # netCDF4 file with compressed, uncompressed and contiguous variables, on an in-memory filesystem standing in
+    # for S3
+    rng = np.random.default_rng(0)
+    shape = (10, 30, 40)
+    ds = xr.Dataset(
+        {'compressed': (('time', 'y', 'x'), rng.random(shape).astype('f4')),
+         'uncompressed': (('time', 'y', 'x'), rng.random(shape)),
+         'contiguous': (('y', 'x'), rng.random(shape[1:]).astype('f4')),
+         'sparse': (('time', 'y', 'x'), np.full(shape, np.nan, dtype='f4'))},
+        coords={'time': pd.date_range('2024-09-22', periods=shape[0], freq='h')})
+    encoding = {'compressed': {'chunksizes': (4, 8, 8), 'zlib': True, 'shuffle': True},
+                'uncompressed': {'chunksizes': (3, 7, 9)},
+                'sparse': {'chunksizes': (10, 15, 20), '_FillValue': np.float32(-1)}}
+    path = tmp_path / 'file.nc'
+    ds.to_netcdf(path, engine='h5netcdf', encoding=encoding)
+
+    fs = fsspec.filesystem('memory')
+    url = f'memory://chunks-{uuid.uuid4().hex}/file.nc'
+    fs.pipe(url, path.read_bytes())
+    yield fs, url, xr.open_dataset(path, engine='h5netcdf').load()
+    fs.rm(url.rsplit('/', 1)[0], recursive=True)
+
+
+def points(n=25, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 30, n), rng.integers(0, 40, n)
+
+
+def test_points_match_a_vectorized_isel(chunked_file):
+    fs, url, expected = chunked_file
+    y, x = points()
+    variables = ['compressed', 'uncompressed', 'contiguous']
+    got = _CHUNKS.read_chunk_points(url, variables, {'time': slice(2, 9), 'y': y, 'x': x}, s3=fs)
+    reference = expected[variables].isel(time=slice(2, 9), y=xr.DataArray(y, dims='point'),
+                                         x=xr.DataArray(x, dims='point'))
+    for name in variables:
+        assert got[name].dims == reference[name].dims
+        np.testing.assert_array_equal(got[name].values, reference[name].values)
+    np.testing.assert_array_equal(got['time'].values, reference['time'].values)
+
+
+def test_leading_point_dimension(chunked_file):
+    # Points along the first dimension, the grid sliced: the point dimension keeps its place in the output
+    fs, url, expected = chunked_file
+    time = np.array([7, 0, 3, 3, 9])
+    got = _CHUNKS.read_chunk_points(url, ['compressed'], {'time': time, 'y': slice(5, 20)}, s3=fs)
+    reference = expected['compressed'].isel(time=xr.DataArray(time, dims='point'), y=slice(5, 20))
+    assert got['compressed'].dims == ('point', 'y', 'x')
+    np.testing.assert_array_equal(got['compressed'].values, reference.values)
+
+
+def test_whole_variables_and_unwritten_chunks(chunked_file):
+    fs, url, expected = chunked_file
+    got = _CHUNKS.read_chunk_points(url, ['compressed', 'sparse'], {}, s3=fs)
+    np.testing.assert_array_equal(got['compressed'].values, expected['compressed'].values)
+    assert np.isnan(got['sparse'].values).all()
+
+
+def test_chunks_are_fetched_with_coalesced_ranges(chunked_file, monkeypatch):
+    fs, url, _ = chunked_file
+    requests = []
+    cat_ranges = fs.cat_ranges
+
+    def recorded(paths, starts, ends, **kwargs):
+        requests.append(list(zip(starts, ends)))
+        return cat_ranges(paths, starts, ends, **kwargs)
+
+    monkeypatch.setattr(fs, 'cat_ranges', recorded)
+    _CHUNKS.chunk_references(url, s3=fs)
+    _CHUNKS.configure_chunk_cache(0)
+    try:
+        y, x = points()
+        # A negative gap keeps even adjacent chunks apart
+        separate = _CHUNKS.read_chunk_points(url, ['compressed'], {'y': y, 'x': x}, s3=fs, max_gap=-1)
+        coalesced = _CHUNKS.read_chunk_points(url, ['compressed'], {'y': y, 'x': x}, s3=fs)
+    finally:
+        _CHUNKS.configure_chunk_cache()
+
+    # One read call per selection; the default gap joins every chunk of this small file into one range
+    assert len(requests) == 2
+    assert len(requests[0]) > 1
+    assert len(requests[1]) == 1
+    np.testing.assert_array_equal(separate['compressed'].values, coalesced['compressed'].values)
+
+
+def test_cached_chunks_are_not_fetched_again(chunked_file, monkeypatch):
+    fs, url, expected = chunked_file
+    y, x = points()
+    first = _CHUNKS.read_chunk_points(url, ['compressed'], {'y': y, 'x': x}, s3=fs)
+    monkeypatch.setattr(fs, 'cat_ranges', lambda *args, **kwargs: pytest.fail('chunk fetched twice'))
+    second = _CHUNKS.read_chunk_points(url, ['compressed'], {'y': y[:5], 'x': x[:5]}, s3=fs)
+    np.testing.assert_array_equal(second['compressed'].values, first['compressed'].values[:, :5])
+
+
+def test_point_dimensions_must_be_adjacent(chunked_file):
+    fs, url, _ = chunked_file
+    with pytest.raises(ValueError):
+        _CHUNKS.read_chunk_points(url, ['compressed'], {'time': np.array([0, 1]), 'x': np.array([0, 1])}, s3=fs)
@@ -0,0 +1,27 @@
+import numpy as np
+import _FIELDS
+
+
+def layout(node_chunk, shape=(12, 100000, 49), dtype='f4'):
+    return {'shape': shape, 'chunks': (shape[0], node_chunk, shape[2]), 'dtype': np.dtype(dtype)}
+
+
+def test_windows_cover_the_nodes_in_whole_store_chunks():
+    windows = list(_FIELDS._rechunk_windows([layout(1000)], 100000, 8192, 64 * 1024**2))
+    assert windows[0][0] == 0 and windows[-1][1] == 100000
+    assert all(stop == start for (_, stop), (start, _) in zip(windows, windows[1:]))
+    assert all(start % 8192 == 0 for start, _ in windows)
+
+
+def test_windows_account_for_the_source_chunks_they_touch():
+    row_bytes = 12 * 49 * 4
+    max_bytes = 20000 * row_bytes
+    # Small source chunks: the window values and the chunks around them fit in max_bytes
+    small = list(_FIELDS._rechunk_windows([layout(1000)], 100000, 1024, max_bytes))
+    for start, stop in small[:-1]:
+        touched = -(-stop // 1000) * 1000 - start // 1000 * 1000
+        assert (stop - start + touched) * row_bytes <= max_bytes
+        assert stop - start >= 8 * 1024
+    # Source chunks larger than max_bytes: each window is a single store chunk
+    large = list(_FIELDS._rechunk_windows([layout(50000)], 100000, 1024, max_bytes))
+    assert all(stop - start == 1024 for start, stop in large[:-1])
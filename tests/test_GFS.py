@@ -0,0 +1,98 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fsspec
+import numpy as np
+import pandas as pd
+import _CACHE
+import _GFS
+import _S3
+
+VARIABLES = _GFS.GFS_FORCING_VARIABLES
+
+
+def source(time, values):
+    # Decoded file at one time: the same station vector for every variable, offset per variable
+    return pd.Timestamp(time), {name: np.asarray(values, dtype=float) + 1000 * i for i, name in enumerate(VARIABLES)}
+
+
+def expected(sources, output_times):
+    # Linear interpolation in time of every station, rounded like the GFS output
+    source_times = np.array([time.value for time, _ in sources], dtype=float)
+    result = {}
+    for name in VARIABLES:
+        fields = np.array([values[name] for _, values in sources])
+        result[name] = np.round(np.column_stack([
+            np.interp(pd.DatetimeIndex(output_times).values.astype('datetime64[ns]').astype(float), source_times, fields[:, station])
+            for station in range(fields.shape[1])]), 2)
+    return result
+
+
+def test_six_minute_output_across_hourly_blocks():
+    sources = [source('2024-09-22 00:00', [0.0, 10.0]), source('2024-09-22 01:00', [6.0, 4.0]),
+               source('2024-09-22 02:00', [0.0, 1.0])]
+    output_times = pd.date_range('2024-09-22 00:00', '2024-09-22 02:00', freq='6min')
+    blocks = list(_GFS._resampled_blocks(iter(sources), output_times))
+
+    # The first file only gives its own time, each following file closes the block (previous time, its time]
+    assert [(start, end) for start, end, _ in blocks] == [(0, 1), (1, 11), (11, 21)]
+    data = _GFS.resample_station_forcing(sources, output_times, 2)
+    for name in VARIABLES:
+        np.testing.assert_array_equal(np.concatenate([block[name] for _, _, block in blocks]), data[name])
+        np.testing.assert_allclose(data[name], expected(sources, output_times)[name])
+    np.testing.assert_allclose(data[VARIABLES[0]][:11, 0], np.arange(11) * 0.6)
+
+
+def test_irregular_source_spacing():
+    # Hourly then 3-hourly files, as in the GFS forecast
+    sources = [source('2024-09-22 00:00', [1.0]), source('2024-09-22 01:00', [2.0]),
+               source('2024-09-22 04:00', [5.0]), source('2024-09-22 07:00', [-1.0])]
+    output_times = pd.date_range('2024-09-22 00:00', '2024-09-22 07:00', freq='6min')
+    data = _GFS.resample_station_forcing(sources, output_times, 1)
+    for name in VARIABLES:
+        np.testing.assert_allclose(data[name], expected(sources, output_times)[name])
+
+
+def test_output_times_between_source_times():
+    sources = [source('2024-09-22 00:00', [0.0]), source('2024-09-22 01:00', [1.0]),
+               source('2024-09-22 02:00', [2.0])]
+    output_times = pd.date_range('2024-09-22 00:03', '2024-09-22 01:57', freq='6min')
+    blocks = list(_GFS._resampled_blocks(iter(sources), output_times))
+
+    # No output time at the first file, the blocks end on either side of 01:00
+    assert [(start, end) for start, end, _ in blocks] == [(0, 10), (10, 20)]
+    np.testing.assert_allclose(blocks[0][2][VARIABLES[0]][:, 0], np.round(np.arange(10) * 0.1 + 0.05, 2))
+
+
+def test_blocks_are_yielded_as_soon_as_their_second_file_is_read():
+    read = []
+
+    def sources():
+        for hour in range(4):
+            read.append(hour)
+            yield source(f'2024-09-22 {hour:02d}:00', [float(hour)])
+
+    output_times = pd.date_range('2024-09-22 00:00', '2024-09-22 03:00', freq='6min')
+    blocks = _GFS._resampled_blocks(sources(), output_times)
+    next(blocks)
+    assert read == [0]
+    start, end, block = next(blocks)
+    assert read == [0, 1]
+    assert (start, end) == (1, 11)
+    assert block[VARIABLES[0]][-1, 0] == 1.0
+
+
+def _worker_filesystem():
+    return type(_S3.get_s3_filesystem()).__name__, _S3.injected_s3_filesystem() is not None
+
+
+def test_workers_keep_an_injected_filesystem():
+    # A spawned worker starts from the default session, the filesystem injected in this process must replace it
+    _S3.set_s3_filesystem(fsspec.filesystem('memory'))
+    try:
+        initargs = (_S3.s3_session_configuration(), _S3.injected_s3_filesystem(), _CACHE.cache_configuration(),
+                    'pygrib')
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=_GFS._configure_worker,
+                                 initargs=initargs) as executor:
+            assert executor.submit(_worker_filesystem).result() == ('MemoryFileSystem', True)
+    finally:
+        _S3.set_s3_filesystem(None)
@@ -0,0 +1,139 @@
+import uuid
+import fsspec
+import numpy as np
+import pytest
+import _GFS
+import _GRIB
+
+
+def grib2_message(payload):
+    # Section 0 of GRIB2 (total length on 8 bytes), the payload and the end section
+    length = 16 + len(payload) + 4
+    return b'GRIB' + b'\x00\x00' + b'\x00' + b'\x02' + length.to_bytes(8, 'big') + payload + b'7777'
+
+
+def grib1_message(payload):
+    # Section 0 of GRIB1 (total length on 3 bytes, then the edition)
+    length = 8 + len(payload) + 4
+    return b'GRIB' + length.to_bytes(3, 'big') + b'\x01' + payload + b'7777'
+
+
+# Inventory of a synthetic GFS file: (variable, level) of each message, the last one ends with the file
+MESSAGES = [('TMP', '2 m above ground'), ('PRES', 'surface'), ('UGRD', '10 m above ground'),
+            ('VGRD', '10 m above ground'), ('RH', '2 m above ground')]
+
+
+@pytest.fixture
+def gfs_file():
+    # GRIB2 file and its .idx inventory on an in-memory filesystem standing in for S3
+    fs = fsspec.filesystem('memory')
+    url = f'memory://gfs-{uuid.uuid4().hex}/gfs.t00z.sfluxgrbf006.grib2'
+    messages = [grib2_message(bytes([i]) * (50 + 10 * i)) for i in range(len(MESSAGES))]
+    lines, offset = [], 0
+    for i, ((variable, level), message) in enumerate(zip(MESSAGES, messages)):
+        lines.append(f'{i + 1}:{offset}:d=2024092200:{variable}:{level}:6 hour fcst:')
+        offset += len(message)
+    fs.pipe(url, b''.join(messages))
+    fs.pipe(f'{url}.idx', '\n'.join(lines).encode())
+    yield fs, url, messages
+    fs.rm(url.rsplit('/', 1)[0], recursive=True)
+
+
+def test_split_grib2_messages():
+    messages = [grib2_message(b'a' * 10), grib2_message(b''), grib2_message(b'b' * 300)]
+    assert _GRIB.split_grib_messages(b''.join(messages)) == messages
+
+
+def test_split_mixed_editions_and_leading_bytes():
+    messages = [grib1_message(b'c' * 20), grib2_message(b'd' * 5)]
+    assert _GRIB.split_grib_messages(b'\x00' * 7 + b''.join(messages)) == messages
+
+
+def test_grib_marker_inside_a_message_is_not_a_split():
+    messages = [grib2_message(b'xxGRIBxx' * 4), grib2_message(b'y')]
+    assert _GRIB.split_grib_messages(b''.join(messages)) == messages
+
+
+def test_index_offsets_delimit_the_messages(gfs_file):
+    fs, url, messages = gfs_file
+    entries = _GFS.read_grib_index(url, s3=fs)
+    data = fs.cat_file(url)
+    assert [(entry['variable'], entry['level']) for entry in entries] == MESSAGES
+    assert entries[-1]['end'] is None
+    for entry, message in zip(entries, messages):
+        assert data[entry['start']:entry['end']] == message
+        assert _GRIB.split_grib_messages(data[entry['start']:entry['end']]) == [message]
+
+
+def test_sub_messages_share_the_end_of_their_message():
+    fs = fsspec.filesystem('memory')
+    url = f'memory://gfs-{uuid.uuid4().hex}/file.grib2'
+    fs.pipe(f'{url}.idx', b'1:0:d=2024092200:UGRD:10 m above ground:6 hour fcst:\n'
+                          b'1.2:0:d=2024092200:VGRD:10 m above ground:6 hour fcst:\n'
+                          b'2:120:d=2024092200:PRES:surface:6 hour fcst:\n')
+    entries = _GFS.read_grib_index(url, s3=fs)
+    assert [(entry['start'], entry['end']) for entry in entries] == [(0, 120), (0, 120), (120, None)]
+
+
+def test_only_the_forcing_messages_are_fetched(gfs_file, monkeypatch):
+    fs, url, messages = gfs_file
+    requested = []
+    cat_ranges = fs.cat_ranges
+
+    def recorded(paths, starts, ends, **kwargs):
+        requested.extend(zip(starts, ends))
+        return cat_ranges(paths, starts, ends, **kwargs)
+
+    monkeypatch.setattr(fs, 'cat_ranges', recorded)
+    data = _GFS.fetch_gfs_grib_messages(url, s3=fs)
+
+    # PRES, UGRD and VGRD are adjacent in the file, they are fetched with one range request
+    start = len(messages[0])
+    assert requested == [(start, start + sum(len(message) for message in messages[1:4]))]
+    assert _GRIB.split_grib_messages(data) == messages[1:4]
+
+
+def test_last_message_is_read_to_the_end_of_the_file(gfs_file):
+    fs, url, messages = gfs_file
+    data = _GFS.fetch_gfs_grib_messages(url, messages=['PRES:surface', 'RH:2 m above ground'], s3=fs)
+    assert _GRIB.split_grib_messages(data) == [messages[1], messages[4]]
+
+
+def test_whole_file_is_fetched_without_a_complete_index(gfs_file):
+    fs, url, messages = gfs_file
+    data = _GFS.fetch_gfs_grib_messages(url, messages=['PRES:surface', 'APCP:surface'], s3=fs)
+    assert data == b''.join(messages)
+    fs.rm(f'{url}.idx')
+    assert _GFS.fetch_gfs_grib_messages(url, s3=fs) == b''.join(messages)
+
+
+def brute_force_nearest(geometry, latitudes, longitudes):
+    # Haversine of the distance from each location to every grid point, and the closest one
+    grid_latitudes, grid_longitudes = np.meshgrid(geometry['latitudes'], geometry['longitudes'], indexing='ij')
+    distance = _GRIB._haversine(latitudes[:, None], longitudes[:, None], grid_latitudes.reshape(-1)[None],
+                                grid_longitudes.reshape(-1)[None])
+    return distance, np.argmin(distance, axis=1)
+
+
+@pytest.mark.parametrize('latitudes, longitudes', [
+    (np.arange(90, -90.1, -2.5), np.arange(0, 360, 2.5)),  # Global, descending latitudes as in GFS
+    (np.linspace(20, 50, 61), np.linspace(-130, -60, 141))])  # Regional, longitudes in [-180, 180)
+def test_nearest_grid_points_are_the_closest_on_the_sphere(latitudes, longitudes):
+    geometry = {'latitudes': latitudes, 'longitudes': longitudes}
+    rng = np.random.default_rng(0)
+    stations_latitudes = rng.uniform(max(latitudes.min(), -89), min(latitudes.max(), 89), 2000)
+    stations_longitudes = rng.uniform(longitudes.min(), longitudes.max(), 2000) + rng.choice([-360, 0, 360], 2000)
+    y, x = _GRIB.nearest_grid_points(geometry, stations_latitudes, stations_longitudes)
+    distance, nearest = brute_force_nearest(geometry, stations_latitudes, stations_longitudes)
+    # Equally distant points (e.g. all the points of a pole row) may be taken in any order
+    chosen = distance[np.arange(len(nearest)), y * len(longitudes) + x]
+    np.testing.assert_array_equal(chosen, distance[np.arange(len(nearest)), nearest])
+
+
+def test_nearest_grid_points_snap_across_the_dateline():
+    geometry = {'latitudes': np.array([10.0, 0.0, -10.0]), 'longitudes': np.arange(0, 360, 0.25)}
+    y, x = _GRIB.nearest_grid_points(geometry, [0.0, 0.0, 0.0, 0.0], [359.9, -0.05, -179.9, 180.1])
+    np.testing.assert_array_equal(x, [0, 0, 720, 720])
+    geometry = {'latitudes': np.array([10.0, 0.0, -10.0]), 'longitudes': np.arange(-180, 180, 0.25)}
+    y, x = _GRIB.nearest_grid_points(geometry, [0.0, 0.0, 0.0], [179.95, 180.05, 359.9])
+    np.testing.assert_array_equal(x, [0, 0, 720])
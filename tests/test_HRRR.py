@@ -0,0 +1,99 @@
+import uuid
+import warnings
+import fsspec
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import _HRRR
+
+
+FILENAME, MODELNAME, DIRECTORY, SUBDIRECTORY = 't12z.hrrr.prc', 'stofs_3d_atl', 'STOFS-3D-Atl', 'rerun'
+SHAPE = (12, 15)
+STEPS = 25
+
+# Grid points of the stations, (row, column)
+POINTS = [(0, 0), (5, 7), (11, 14), (3, 12)]
+
+
+def hrrr_file(path, date, grid_latitudes, grid_longitudes):
+    # HRRR forcing of a date: 25 hourly steps from 12z, the last one is the first step of the next file.
+    # uwind is 1000 * day + step + flat grid index / 100, so each value tells the file, step and point it comes from
+    times = pd.date_range(f'{date} 12:00', periods=STEPS, freq='h')
+    flat = np.arange(SHAPE[0] * SHAPE[1]).reshape(SHAPE) / 100
+    uwind = (1000 * int(date[-2:]) + np.arange(STEPS)[:, None, None] + flat).astype('f4')
+    dims = ('time', 'ny_grid', 'nx_grid')
+    ds = xr.Dataset({'uwind': (dims, uwind), 'vwind': (dims, -uwind), 'prmsl': (dims, 1e5 + uwind),
+                     'lat': (('ny_grid', 'nx_grid'), grid_latitudes), 'lon': (('ny_grid', 'nx_grid'), grid_longitudes)},
+                    coords={'time': times})
+    chunks = {'chunksizes': (1, 6, 8), 'zlib': True}
+    ds.to_netcdf(path, engine='h5netcdf', encoding={name: chunks for name in ('uwind', 'vwind', 'prmsl')})
+
+
+@pytest.fixture
+def hrrr_files(tmp_path):
+    # Daily files of 2024-09-20, 22 and 23 (21 is missing) on an in-memory filesystem standing in for S3, on a
+    # rotated curvilinear grid
+    j, i = np.indices(SHAPE)
+    grid_latitudes = (30 + 0.03 * i + 0.02 * j).astype('f4')
+    grid_longitudes = (-80 + 0.03 * i - 0.015 * j).astype('f4')
+    fs = fsspec.filesystem('memory')
+    bucket = f'hrrr-{uuid.uuid4().hex}'
+    for date in ('20240920', '20240922', '20240923'):
+        path = tmp_path / f'{date}.nc'
+        hrrr_file(path, date, grid_latitudes, grid_longitudes)
+        fs.pipe(f's3://{bucket}/{_HRRR.HRRR_key(FILENAME, MODELNAME, DIRECTORY, SUBDIRECTORY, date)}',
+                path.read_bytes())
+    stations = pd.DataFrame({'lat': [float(grid_latitudes[point]) for point in POINTS],
+                             'lon': [float(grid_longitudes[point]) for point in POINTS],
+                             'nos_id': [8410140 + k for k in range(len(POINTS))]})
+    yield fs, bucket, stations
+    fs.rm(f's3://{bucket}', recursive=True)
+
+
+def fetch(hrrr_files, daterange=('20240921', '20240923'), **kwargs):
+    fs, bucket, stations = hrrr_files
+    return _HRRR.fetch_saved_HRRR_Nowcast_dataset(FILENAME, MODELNAME, DIRECTORY, SUBDIRECTORY, bucket,
+                                                  list(daterange), stations, STEPS, s3=fs, **kwargs)
+
+
+def test_files_fill_their_time_steps(hrrr_files):
+    ds, failures = fetch(hrrr_files, return_failures=True)
+    assert [failure['key'] for failure in failures] == \
+        [_HRRR.HRRR_key(FILENAME, MODELNAME, DIRECTORY, SUBDIRECTORY, '20240921')]
+
+    # Time steps of the files read, the 22nd and 23rd files share 2024-09-23 12:00
+    dates = ('20240920', '20240922', '20240923')
+    file_times = [pd.date_range(f'{date} 12:00', periods=STEPS, freq='h') for date in dates]
+    expected_times = np.unique(np.concatenate([times.values for times in file_times])).astype('datetime64[ns]')
+    np.testing.assert_array_equal(ds['time'].values, expected_times)
+    assert len(ds['time']) == 3 * STEPS - 1
+
+    flat = np.array([np.ravel_multi_index(point, SHAPE) for point in POINTS]) / 100
+    for date, times in zip(dates, file_times):
+        if date == '20240922':
+            times = times[:-1]  # Its last step is overwritten by the next file
+        expected = 1000 * int(date[-2:]) + np.arange(len(times))[:, None] + flat
+        np.testing.assert_allclose(ds['uwind'].sel(time=times).values, expected, rtol=1e-6)
+        np.testing.assert_allclose(ds['prmsl'].sel(time=times).values, 1e5 + expected, rtol=1e-6)
+    np.testing.assert_allclose(ds['uwind'].sel(time='2024-09-23 12:00').values, 23000 + flat, rtol=1e-6)
+    assert list(ds['station'].values) == list(hrrr_files[2]['nos_id'])
+
+
+def test_concurrent_reads_match_serial_reads(hrrr_files):
+    serial, _ = fetch(hrrr_files, max_workers=1, return_failures=True)
+    concurrent, _ = fetch(hrrr_files, max_workers=4, return_failures=True)
+    xr.testing.assert_identical(serial, concurrent)
+
+
+def test_missing_files_are_reported(hrrr_files):
+    with pytest.warns(UserWarning, match='1 HRRR file'):
+        fetch(hrrr_files)
+    with pytest.raises(FileNotFoundError):
+        fetch(hrrr_files, daterange=('20240925', '20240927'))
+    # The legacy wrapper returns None when nothing could be read
+    fs, bucket, stations = hrrr_files
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        assert _HRRR.fetch_saved_HRRR_Nowcast_data(FILENAME, MODELNAME, DIRECTORY, SUBDIRECTORY, bucket,
+                                                   ['20240925', '20240927'], stations, STEPS, s3=fs) is None
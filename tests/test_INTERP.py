@@ -0,0 +1,164 @@
+import os
+import numpy as np
+import pytest
+import _CACHE
+import _INTERP
+
+
+def rectilinear(latitudes, longitudes):
+    return {'grid_id': _CACHE.coordinates_id(latitudes, longitudes), 'grid_type': 'rectilinear',
+            'latitudes': np.asarray(latitudes, dtype=float), 'longitudes': np.asarray(longitudes, dtype=float)}
+
+
+def curvilinear(latitudes, longitudes):
+    return {'grid_id': _CACHE.coordinates_id(latitudes, longitudes), 'grid_type': 'curvilinear',
+            'latitudes': latitudes, 'longitudes': longitudes}
+
+
+def rotated_grid(center_latitude, center_longitude, angle=25, spacing=0.25, shape=(30, 40)):
+    # Regular grid rotated by angle degrees around its center, longitudes in [-180, 180)
+    j, i = np.meshgrid(np.arange(shape[0]) - shape[0] / 2, np.arange(shape[1]) - shape[1] / 2, indexing='ij')
+    rotation = np.radians(angle)
+    longitudes = center_longitude + spacing * (i * np.cos(rotation) - j * np.sin(rotation))
+    latitudes = center_latitude + spacing * (i * np.sin(rotation) + j * np.cos(rotation))
+    return curvilinear(latitudes, np.mod(longitudes + 180, 360) - 180)
+
+
+def local_linear_fields(grid_latitudes, grid_longitudes, latitudes, longitudes):
+    # One field per station, linear in latitude and in the longitude measured from the station (so it does not
+    # break at the dateline around the station), and the exact value of each field at its station
+    offsets = np.mod(grid_longitudes[np.newaxis] - longitudes[:, np.newaxis, np.newaxis] + 180, 360) - 180
+    fields = 2.0 * grid_latitudes[np.newaxis] + 3.0 * offsets + 7.0
+    return fields, 2.0 * latitudes + 7.0
+
+
+def interpolate(weights, fields):
+    # Value of the field of each station at that station
+    return np.diagonal(_INTERP.apply_weights(weights, fields))
+
+
+def test_bilinear_is_exact_for_linear_fields_on_a_rectilinear_grid():
+    # Global grid with descending latitudes (as in GFS) and longitudes in [0, 360); a station sits across 0/360
+    geometry = rectilinear(np.arange(60, -60.1, -0.5), np.arange(0, 360, 0.5))
+    latitudes = np.array([10.1, -33.3, 0.0, 45.2, 12.7])
+    longitudes = np.array([-70.3, 181.1, 359.8, -0.2, 0.25])
+    weights = _INTERP.interpolation_weights(geometry, latitudes, longitudes, method='bilinear')
+    grid_latitudes, grid_longitudes = np.meshgrid(geometry['latitudes'], geometry['longitudes'], indexing='ij')
+    fields, expected = local_linear_fields(grid_latitudes, grid_longitudes, latitudes, longitudes)
+    np.testing.assert_allclose(interpolate(weights, fields), expected, atol=1e-9)
+    np.testing.assert_allclose(np.asarray(weights.sum(axis=1)).ravel(), 1.0)
+
+
+def test_bilinear_takes_the_closest_edge_outside_a_regional_grid():
+    geometry = rectilinear(np.linspace(20, 50, 121), np.linspace(-130, -60, 281))
+    grid_latitudes, grid_longitudes = np.meshgrid(geometry['latitudes'], geometry['longitudes'], indexing='ij')
+    field = 2.0 * grid_latitudes + 3.0 * grid_longitudes
+    latitudes = np.array([55.0, 10.0, 30.1, 30.1])
+    longitudes = np.array([-100.1, -100.1, -59.0, -140.0])
+    weights = _INTERP.interpolation_weights(geometry, latitudes, longitudes, method='bilinear')
+    edge_latitudes = np.clip(latitudes, 20, 50)
+    edge_longitudes = np.clip(longitudes, -130, -60)
+    np.testing.assert_allclose(_INTERP.apply_weights(weights, field), 2.0 * edge_latitudes + 3.0 * edge_longitudes,
+                               atol=1e-9)
+
+
+@pytest.mark.parametrize('center_longitude', [-75.0, 180.0])
+def test_bilinear_is_exact_for_linear_fields_on_a_rotated_curvilinear_grid(center_longitude):
+    geometry = rotated_grid(35.0, center_longitude)
+    rng = np.random.default_rng(0)
+    latitudes = 35.0 + rng.uniform(-2, 2, 20)
+    longitudes = np.mod(center_longitude + rng.uniform(-2, 2, 20) + 180, 360) - 180
+    weights = _INTERP.interpolation_weights(geometry, latitudes, longitudes, method='bilinear')
+    fields, expected = local_linear_fields(geometry['latitudes'], geometry['longitudes'], latitudes, longitudes)
+    np.testing.assert_allclose(interpolate(weights, fields), expected, atol=1e-6)
+    # Four grid points per station, weights in [0, 1]
+    assert np.all(np.diff(weights.indptr) <= 4)
+    assert weights.data.min() >= 0 and weights.data.max() <= 1
+
+
+def test_stations_outside_a_curvilinear_grid_take_their_nearest_point():
+    geometry = rotated_grid(35.0, -75.0)
+    weights = _INTERP.interpolation_weights(geometry, [50.0], [-75.0], method='bilinear')
+    nearest = np.ravel_multi_index(_INTERP.nearest_points(geometry, [50.0], [-75.0]), geometry['latitudes'].shape)
+    assert weights.nnz == 1 and weights[0, int(nearest[0])] == 1.0
+
+
+@pytest.mark.parametrize('geometry', [rectilinear(np.arange(-10, 10.1, 1.0), np.arange(170, 190.1, 1.0) % 360),
+                                      rotated_grid(0.0, 180.0)])
+def test_idw_rows_sum_to_one(geometry):
+    latitudes = np.array([0.3, -5.55, 2.0])
+    longitudes = np.array([179.7, -179.2, 181.0])
+    if geometry['grid_type'] == 'rectilinear':
+        # The last station is on a grid point and takes its value
+        latitudes[-1], longitudes[-1] = geometry['latitudes'][12], geometry['longitudes'][11]
+    weights = _INTERP.interpolation_weights(geometry, latitudes, longitudes, method='idw')
+    np.testing.assert_allclose(np.asarray(weights.sum(axis=1)).ravel(), 1.0)
+    assert weights.data.min() >= 0
+    if geometry['grid_type'] == 'rectilinear':
+        assert weights[2].nnz == 1 and weights[2, 12 * len(geometry['longitudes']) + 11] == 1.0
+
+
+def haversine_nearest(grid_latitudes, grid_longitudes, latitudes, longitudes):
+    # Flat index of the grid point closest to each location, by brute force
+    latitudes, longitudes = np.radians(latitudes)[:, None], np.radians(longitudes)[:, None]
+    grid_latitudes, grid_longitudes = np.radians(grid_latitudes.reshape(-1)), np.radians(grid_longitudes.reshape(-1))
+    distance = np.sin((grid_latitudes - latitudes) / 2) ** 2 + \
+        np.cos(latitudes) * np.cos(grid_latitudes) * np.sin((grid_longitudes - longitudes) / 2) ** 2
+    return np.argmin(distance, axis=1)
+
+
+def distorted_grid(center_longitude):
+    # Rotated grid with curved rows and columns, as a projected (e.g. Lambert conformal) grid
+    geometry = rotated_grid(40.0, center_longitude, shape=(40, 50))
+    j, i = np.indices(geometry['latitudes'].shape)
+    latitudes = geometry['latitudes'] + 0.002 * (i - 25) ** 2
+    longitudes = np.mod(geometry['longitudes'] + 0.003 * (j - 20) ** 2 + 180, 360) - 180
+    return curvilinear(latitudes, longitudes)
+
+
+@pytest.mark.parametrize('center_longitude', [-97.5, 180.0])
+def test_nearest_points_on_a_curvilinear_grid(center_longitude):
+    geometry = distorted_grid(center_longitude)
+    rng = np.random.default_rng(1)
+    latitudes = 40.0 + rng.uniform(-4, 4, 500)
+    # Longitudes in [-180, 180) and in [0, 360)
+    longitudes = center_longitude + rng.uniform(-4, 4, 500) + rng.choice([-360, 0, 360], 500)
+    longitudes = np.where((longitudes < -180) | (longitudes >= 360), np.mod(longitudes, 360), longitudes)
+    y, x = _INTERP.nearest_points(geometry, latitudes, longitudes)
+    expected = haversine_nearest(geometry['latitudes'], geometry['longitudes'], latitudes, longitudes)
+    np.testing.assert_array_equal(np.ravel_multi_index((y, x), geometry['latitudes'].shape), expected)
+
+
+def test_nearest_points_on_a_rectilinear_grid():
+    geometry = rectilinear(np.arange(50, 19.9, -0.5), np.arange(230, 300.1, 0.5))
+    rng = np.random.default_rng(2)
+    latitudes = rng.uniform(20, 50, 500)
+    longitudes = rng.uniform(-130, -60, 500)
+    y, x = _INTERP.nearest_points(geometry, latitudes, longitudes)
+    grid_latitudes, grid_longitudes = np.meshgrid(geometry['latitudes'], geometry['longitudes'], indexing='ij')
+    expected = haversine_nearest(grid_latitudes, grid_longitudes, latitudes, longitudes)
+    np.testing.assert_array_equal(y * len(geometry['longitudes']) + x, expected)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    _CACHE.configure_cache(str(tmp_path))
+    yield tmp_path
+    _CACHE.configure_cache(None)
+
+
+def test_curvilinear_tree_round_trip_through_the_cache(cache, monkeypatch):
+    geometry = distorted_grid(-97.5)
+    _INTERP._trees.pop(geometry['grid_id'], None)
+    built = _INTERP.curvilinear_tree(geometry)
+    assert os.listdir(cache / 'trees') == [f"{geometry['grid_id']}.pkl"]
+
+    # A new process finds the tree on disk, it is not built again
+    _INTERP._trees.pop(geometry['grid_id'])
+    monkeypatch.setattr(_INTERP, 'cKDTree', None)
+    loaded = _INTERP.curvilinear_tree(geometry)
+    assert loaded is not built
+    np.testing.assert_array_equal(loaded.data, built.data)
+    points = _INTERP._unit_vectors(np.array([38.2, 41.7]), np.array([-99.0, -96.1]))
+    np.testing.assert_array_equal(loaded.query(points)[1], built.query(points)[1])
+    assert _INTERP.curvilinear_tree(geometry) is loaded
@@ -0,0 +1,164 @@
+import uuid
+from datetime import datetime
+import fsspec
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import _CACHE
+import _STOFS
+
+
+def window(start, steps, value, stations=2):
+    # Nowcast window of a cycle: hourly steps from start, every value set to the id of the cycle
+    times = pd.date_range(start, periods=steps, freq='h')
+    return xr.Dataset({'zeta': (('time', 'station'), np.full((steps, stations), float(value))),
+                       'station_name': ('station', [f's{i}' for i in range(stations)])},
+                      coords={'time': times, 'x': ('station', np.arange(stations, dtype=float))})
+
+
+@pytest.fixture
+def overlapping():
+    # Cycle 1 covers 00:00-05:00, cycle 2 covers 03:00-08:00, cycle 3 covers 10:00-11:00 (after a gap)
+    return [window('2024-09-22 00:00', 6, 1), window('2024-09-22 03:00', 6, 2), window('2024-09-22 10:00', 2, 3)]
+
+
+def test_window_positions():
+    times = pd.date_range('2024-09-22', periods=5, freq='h').values
+    window_times = pd.to_datetime(['2024-09-21 23:00', '2024-09-22 01:00', '2024-09-22 01:30',
+                                   '2024-09-22 04:00', '2024-09-22 05:00']).values
+    positions, inside = _STOFS._window_positions(times, window_times)
+    np.testing.assert_array_equal(inside, [False, True, False, True, False])
+    np.testing.assert_array_equal(positions[inside], [1, 4])
+
+
+def test_newest_cycle_owns_the_overlap(overlapping):
+    stitched = _STOFS.stitch_nowcast(overlapping)
+    assert stitched.sizes['time'] == 9 + 2
+    assert stitched.indexes['time'].is_monotonic_increasing
+    np.testing.assert_array_equal(stitched['zeta'].values[:, 0], [1, 1, 1, 2, 2, 2, 2, 2, 2, 3, 3])
+    assert list(stitched['station_name'].values) == ['s0', 's1']
+    np.testing.assert_array_equal(stitched['x'].values, [0, 1])
+
+
+def test_oldest_cycle_owns_the_overlap(overlapping):
+    stitched = _STOFS.stitch_nowcast(overlapping, overlap='oldest')
+    np.testing.assert_array_equal(stitched['zeta'].values[:, 0], [1, 1, 1, 1, 1, 1, 2, 2, 2, 3, 3])
+
+
+def test_order_of_the_cycles_does_not_matter(overlapping):
+    assert _STOFS.stitch_nowcast(overlapping[::-1]).identical(_STOFS.stitch_nowcast(overlapping))
+
+
+def test_date_range_is_applied(overlapping):
+    stitched = _STOFS.stitch_nowcast(overlapping, start_date=datetime(2024, 9, 22, 2),
+                                     end_date=datetime(2024, 9, 22, 10))
+    assert stitched['time'].values[0] == np.datetime64('2024-09-22T02:00')
+    assert stitched['time'].values[-1] == np.datetime64('2024-09-22T10:00')
+    np.testing.assert_array_equal(stitched['zeta'].values[:, 1], [1, 2, 2, 2, 2, 2, 2, 3])
+
+
+def test_lazy_cycles_are_stitched_like_eager_ones(overlapping):
+    lazy = [nowcast.chunk({'time': 2}) for nowcast in overlapping]
+    assert _STOFS.stitch_nowcast(lazy, max_workers=2).identical(_STOFS.stitch_nowcast(overlapping))
+
+
+def test_empty_cycles_are_skipped(overlapping):
+    empty = overlapping[0].isel(time=slice(0, 0))
+    assert _STOFS.stitch_nowcast(overlapping + [empty]).identical(_STOFS.stitch_nowcast(overlapping))
+    with pytest.raises(ValueError):
+        _STOFS.stitch_nowcast([empty])
+
+
+def test_unknown_overlap_policy(overlapping):
+    with pytest.raises(ValueError):
+        _STOFS.stitch_nowcast(overlapping, overlap='mean')
+
+
+NAMES = ['8410140 Eastport, ME', '8413320 Bar Harbor, ME', '8418150 Portland, ME', '8443970 Boston, MA']
+
+
+@pytest.fixture
+def station_files(tmp_path):
+    # Station files of the 2024-09-22 00z and 12z cycles (06z is missing) on an in-memory filesystem standing in for
+    # S3; zeta is 100 * cycle hour + station + step / 100, the station names are a (station, namelen) character array
+    fs = fsspec.filesystem('memory')
+    bucket = f'stofs-{uuid.uuid4().hex}'
+    for cycle in ('00', '12'):
+        times = pd.date_range(f'2024-09-22 {cycle}:00', periods=6, freq='h')
+        steps = np.arange(len(times))[:, None]
+        stations = np.arange(len(NAMES))[None, :]
+        names = np.array([list(name.ljust(50)) for name in NAMES], dtype='S1')
+        ds = xr.Dataset({'zeta': (('time', 'station'), 100.0 * int(cycle) + stations + steps / 100),
+                         'count': (('time', 'station'), (steps * 10 + stations).astype('i4')),
+                         'station_name': (('station', 'namelen'), names),
+                         'x': ('station', np.linspace(-67.0, -71.0, len(NAMES)))},
+                        coords={'time': times})
+        path = tmp_path / f'{cycle}.nc'
+        ds.to_netcdf(path, engine='h5netcdf')
+        fs.pipe(f's3://{bucket}/{_STOFS.station_key("points.cwl", "stofs_2d_glo", "", "20240922", cycle)}',
+                path.read_bytes())
+    yield fs, bucket
+    fs.rm(f's3://{bucket}', recursive=True)
+
+
+def forecast_cube(station_files, cycles=('00', '06', '12'), **kwargs):
+    fs, bucket = station_files
+    return _STOFS.get_station_forecast_cube('points.cwl', 'stofs_2d_glo', '', bucket, ['20240922', '20240922'],
+                                            list(cycles), s3=fs, return_failures=True, **kwargs)
+
+
+def test_forecast_cube_labels_the_stations_by_name(station_files):
+    cube, failures = forecast_cube(station_files, variables=['zeta'])
+    assert list(cube['station'].values) == NAMES
+    assert [failure['cycle'] for failure in failures] == ['06']
+    np.testing.assert_allclose(cube['zeta'].sel(cycle='2024-09-22T12').values[:, 2], 1202 + np.arange(6) / 100)
+    assert np.isnan(cube['zeta'].sel(cycle='2024-09-22T06').values).all()
+
+
+def test_forecast_cube_fills_integer_variables(station_files, tmp_path):
+    cube, _ = forecast_cube(station_files, variables=['zeta', 'count'])
+    fill_value = cube['count'].attrs['_FillValue']
+    assert cube['count'].dtype == np.int32 and fill_value == np.iinfo(np.int32).min
+    assert (cube['count'].sel(cycle='2024-09-22T06').values == fill_value).all()
+    np.testing.assert_array_equal(cube['count'].sel(cycle='2024-09-22T00').values,
+                                  np.arange(6)[:, None] * 10 + np.arange(len(NAMES)))
+    # In a store the missing cycle reads back as NaN, also when it comes before the first cycle read
+    stored, _ = forecast_cube(station_files, cycles=('06', '12'), variables=['count'],
+                              store=str(tmp_path / 'cube.zarr'))
+    assert np.isnan(stored['count'].sel(cycle='2024-09-22T06').values).all()
+    np.testing.assert_array_equal(stored['count'].sel(cycle='2024-09-22T12').values,
+                                  cube['count'].sel(cycle='2024-09-22T12').values)
+
+
+def test_forecast_cube_rejects_non_numeric_variables(station_files):
+    with pytest.raises(ValueError, match='numeric'):
+        forecast_cube(station_files, variables=['zeta'], dtype='U8')
+
+
+@pytest.fixture(params=[False, True], ids=['ranges', 'cached'])
+def station_file(request, station_files, tmp_path):
+    # One station file, read with range requests or through the local cache
+    fs, bucket = station_files
+    if request.param:
+        _CACHE.configure_cache(str(tmp_path / 'cache'))
+    yield fs, bucket, _STOFS.station_key('points.cwl', 'stofs_2d_glo', '', '20240922', '12')
+    _CACHE.configure_cache(None)
+
+
+@pytest.mark.parametrize('stations, positions', [
+    (['8443970 Boston, MA', '8410140 Eastport, ME'], [3, 0]),  # Full names
+    (['8418150', '8413320'], [2, 1]),  # Leading station ids
+    ([3, 0, 2], [3, 0, 2]),  # Unsorted indices
+    ([np.int64(1), ' 8443970 ', '8410140 Eastport, ME'], [1, 3, 0])])  # Mixed
+def test_station_subset_matches_a_selection_of_the_full_file(station_file, stations, positions):
+    fs, bucket, key = station_file
+    full = _STOFS.read_STOFS_from_s3(bucket, key, s3=fs).load()
+    subset = _STOFS.read_STOFS_from_s3(bucket, key, s3=fs, stations=stations).load()
+    xr.testing.assert_identical(subset, full.isel(station=positions))
+
+
+def test_unknown_station(station_file):
+    fs, bucket, key = station_file
+    with pytest.raises(KeyError, match='9999999'):
+        _STOFS.read_STOFS_from_s3(bucket, key, s3=fs, stations=['8410140', '9999999'])